@@ -1,65 +1,381 @@
 import sqlite3
 import os
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from datetime import datetime
 from dotenv import load_dotenv
+from app import metrics
 
 load_dotenv()
 
 DB_PATH = os.getenv("DB_PATH", "/data/app.db")
+# Idle connections kept per database file
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+# How long a writer waits on the other container's lock before failing
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that records how long each statement takes to execute."""
+    def execute(self, sql, parameters=()):
+        start = time.monotonic()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            metrics.observe("db_query_seconds", time.monotonic() - start, statement=statement_type(sql))
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.monotonic()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            metrics.observe("db_query_seconds", time.monotonic() - start, statement=statement_type(sql))
+
+def statement_type(sql):
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ""
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to its pool."""
+    pool = None
+
+    def cursor(self, factory=TimedCursor):
+        # Connection.execute() goes through here too
+        return super().cursor(factory)
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+class ConnectionPool:
+    """
+    Reuses tuned connections to one database file. Each connection is lent to
+    one caller at a time, so it may move between FastAPI's worker threads.
+    """
+    def __init__(self, path, size=DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        # Ensure directory exists
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            factory=PooledConnection,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        # WAL lets the UI read while the worker writes
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def release(self, conn):
+        # Match close(): uncommitted work is discarded
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        sqlite3.Connection.close(conn)
+
+    def close_all(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            sqlite3.Connection.close(conn)
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(path=None):
+    """Returns the connection pool for path (DB_PATH by default)."""
+    path = path or DB_PATH
+    with _pools_lock:
+        if path not in _pools:
+            _pools[path] = ConnectionPool(path)
+        return _pools[path]
 
 def get_db_connection():
-    """Establishes a connection to the SQLite database."""
-    # Ensure directory exists
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def init_db():
-    """Initializes the database with the required schema."""
+    """Borrows a connection from the pool; close() returns it."""
+    return get_pool().acquire()
+
+@contextmanager
+def db_session():
+    """Yields a pooled connection, committing on success and rolling back on error."""
     conn = get_db_connection()
-    cursor = conn.cursor()
-    
-    # Candidates table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS candidates (
-        post_id TEXT PRIMARY KEY,
-        subreddit TEXT,
-        title TEXT,
-        op TEXT,
-        upvotes INTEGER,
-        comments INTEGER,
-        fetched_at TIMESTAMP,
-        age_hours REAL,
-        score REAL,
-        raw_path TEXT
-    );
-    """)
-    
-    # Scripts table
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        conn.close()
+
+def add_created_utc(cursor):
+    """
+    Adds candidates.created_utc, backfilled from the fetch-time age. fetched_at
+    was written with datetime.now(), i.e. naive host-local time, so it is
+    converted with 'utc' (which assumes the same host time zone) first.
+    """
+    columns = [row['name'] for row in cursor.execute("PRAGMA table_info(candidates)")]
+    if "created_utc" in columns:
+        return
+    cursor.execute("ALTER TABLE candidates ADD COLUMN created_utc REAL")
     cursor.execute("""
-    CREATE TABLE IF NOT EXISTS scripts (
-        post_id TEXT PRIMARY KEY,
-        tone TEXT,
-        pacing TEXT,
-        cta TEXT,
-        caption_style TEXT,
-        generated_at TIMESTAMP,
-        script_json TEXT
-    );
+        UPDATE candidates SET created_utc = strftime('%s', fetched_at, 'utc') - age_hours * 3600
+        WHERE fetched_at IS NOT NULL AND age_hours IS NOT NULL
     """)
-    
-    # Flagged table
-    cursor.execute("""
-    CREATE TABLE IF NOT EXISTS flagged (
-        post_id TEXT PRIMARY KEY,
-        reason TEXT,
-        flagged_at TIMESTAMP,
-        data_path TEXT
+
+# Schema history, applied in order and recorded in schema_version. Each step is
+# a list of SQL statements or a function taking a cursor. Append new steps;
+# never edit one that has shipped. Early steps use IF NOT EXISTS because
+# databases created before versioning already have those tables.
+MIGRATIONS = [
+    (1, "base tables", [
+        """
+        CREATE TABLE IF NOT EXISTS candidates (
+            post_id TEXT PRIMARY KEY,
+            subreddit TEXT,
+            title TEXT,
+            op TEXT,
+            upvotes INTEGER,
+            comments INTEGER,
+            fetched_at TIMESTAMP,
+            age_hours REAL,
+            score REAL,
+            raw_path TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS scripts (
+            post_id TEXT PRIMARY KEY,
+            tone TEXT,
+            pacing TEXT,
+            cta TEXT,
+            caption_style TEXT,
+            generated_at TIMESTAMP,
+            script_json TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS flagged (
+            post_id TEXT PRIMARY KEY,
+            reason TEXT,
+            flagged_at TIMESTAMP,
+            data_path TEXT
+        );
+        """,
+    ]),
+    # Stage ledger: which (post, stage) has completed for which input content
+    (2, "stage ledger", [
+        """
+        CREATE TABLE IF NOT EXISTS stage_state (
+            post_id TEXT,
+            stage TEXT,
+            input_hash TEXT,
+            completed_at TIMESTAMP,
+            PRIMARY KEY (post_id, stage)
+        );
+        """,
+    ]),
+    (3, "candidates.created_utc", add_created_utc),
+    # Score-ranked work selection; downstream stages only take these posts
+    (4, "work selection", [
+        """
+        CREATE TABLE IF NOT EXISTS selection (
+            post_id TEXT PRIMARY KEY,
+            rank INTEGER,
+            selected_at TIMESTAMP
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_candidates_score ON candidates (score DESC)",
+    ]),
+    (5, "hot query indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_flagged_flagged_at ON flagged (flagged_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_candidates_subreddit ON candidates (subreddit)",
+        "CREATE INDEX IF NOT EXISTS idx_candidates_fetched_at ON candidates (fetched_at)",
+    ]),
+    # Leased per-post stage jobs shared by every worker on the /data volume
+    (6, "job queue", [
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            stage TEXT NOT NULL,
+            post_id TEXT NOT NULL,
+            input_hash TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            available_at REAL NOT NULL DEFAULT 0,
+            worker_id TEXT,
+            lease_expires REAL,
+            last_error TEXT,
+            created_at TIMESTAMP,
+            updated_at TIMESTAMP,
+            UNIQUE (stage, post_id, input_hash)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (stage, status, available_at)",
+    ]),
+    # Latest metrics snapshot per process, published for the UI's /metrics
+    (7, "metrics", [
+        """
+        CREATE TABLE IF NOT EXISTS metrics (
+            source TEXT,
+            name TEXT,
+            labels TEXT,
+            kind TEXT,
+            data TEXT,
+            updated_at TIMESTAMP,
+            PRIMARY KEY (source, name, labels)
+        );
+        """,
+    ]),
+    # Last selection run, so an empty selection can be told apart from selection being off
+    (8, "selection runs", [
+        """
+        CREATE TABLE IF NOT EXISTS selection_runs (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            top_k INTEGER,
+            selected INTEGER,
+            ran_at TIMESTAMP
+        );
+        """,
+    ]),
+]
+
+def get_schema_version(conn):
+    """Returns the highest applied migration version (0 for a fresh database)."""
+    row = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+def init_db(migrations=MIGRATIONS):
+    """Brings the database schema up to date by applying pending migrations."""
+    conn = get_db_connection()
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name TEXT,
+        applied_at TIMESTAMP
     );
     """)
-    
     conn.commit()
+    
+    try:
+        for version, name, step in migrations:
+            # IMMEDIATE takes the write lock first, so the worker and UI can't both apply a step
+            conn.execute("BEGIN IMMEDIATE")
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+            
+            cursor = conn.cursor()
+            if callable(step):
+                step(cursor)
+            else:
+                for statement in step:
+                    cursor.execute(statement)
+            cursor.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (version, name, datetime.now())
+            )
+            conn.commit()
+            print(f"Applied migration {version}: {name}")
+    finally:
+        conn.close()
+
+# Stages that must never see a flagged post
+POST_MODERATION_STAGES = ("script", "tts", "render")
+
+def work_id(raw_path):
+    """
+    Stages key posts by raw file name ({timestamp}_{reddit id}), not by the
+    candidates post_id; this maps a candidate's raw_path to that key.
+    """
+    return os.path.splitext(os.path.basename(raw_path or ""))[0]
+
+def rank_selected(post_ids):
+    """
+    Restricts post_ids to the current selection, in rank order. If selection
+    has never run or ran disabled (top_k 0), post_ids are returned unchanged;
+    if it ran and picked nothing, nothing is returned.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT top_k FROM selection_runs WHERE id = 1")
+    run = cursor.fetchone()
+    ranked = []
+    if run is not None and run['top_k'] > 0:
+        cursor.execute("SELECT post_id FROM selection ORDER BY rank")
+        ranked = [row['post_id'] for row in cursor.fetchall()]
+    conn.close()
+    if run is None or run['top_k'] <= 0:
+        return list(post_ids)
+    wanted = set(post_ids)
+    return [post_id for post_id in ranked if post_id in wanted]
+
+def hash_files(*paths):
+    """Returns a sha256 hex digest over the contents of the given files."""
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+        h.update(b"\0")
+    return h.hexdigest()
+
+def flagged_ids():
+    """Post ids moderation has flagged; they never go past the moderate stage."""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT post_id FROM flagged")
+    flagged = {row['post_id'] for row in cursor.fetchall()}
     conn.close()
+    return flagged
+
+def get_pending(stage, inputs):
+    """
+    Filters {post_id: input_hash} down to the post_ids that have not completed
+    `stage` with the same input hash, restricted to and ordered by the current
+    selection (input order if there is none). Flagged posts are left out of
+    every stage after moderation.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT post_id, input_hash FROM stage_state WHERE stage = ?", (stage,))
+    done = {row['post_id']: row['input_hash'] for row in cursor.fetchall()}
+    conn.close()
+    flagged = flagged_ids() if stage in POST_MODERATION_STAGES else set()
+    pending = [post_id for post_id, input_hash in inputs.items()
+               if done.get(post_id) != input_hash and post_id not in flagged]
+    if len(pending) < len(inputs):
+        metrics.inc("items_total", len(inputs) - len(pending), stage=stage, outcome="skipped")
+    return rank_selected(pending)
+
+def mark_done(stage, post_id, input_hash):
+    """Records that `stage` completed for post_id with the given input hash."""
+    metrics.inc("items_total", stage=stage, outcome="processed")
+    with db_session() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO stage_state (post_id, stage, input_hash, completed_at)
+            VALUES (?, ?, ?, ?)
+        """, (post_id, stage, input_hash, datetime.now()))
 
 if __name__ == "__main__":
     init_db()
@@ -2,6 +2,7 @@ import json
 import os
 import re
 from dotenv import load_dotenv
+from app.db import rank_selected, flagged_ids
 
 load_dotenv()
 
@@ -68,19 +69,21 @@ def extract_canonical(post_id, workspace_dir=WORKSPACE_DIR):
     return canonical_path
 
 def run_extraction():
-    """Iterates over all raw files and creates canonical versions."""
+    """Creates canonical versions of the selected raw files, best first."""
     raw_dir = os.path.join(WORKSPACE_DIR, "raw")
     if not os.path.exists(raw_dir):
         print("No raw directory found.")
         return
 
     files = [f for f in os.listdir(raw_dir) if f.endswith(".json")]
-    print(f"Extracting {len(files)} files...")
+    # Flagged posts stay in flagged/; re-extracting would put them back in front of moderation
+    flagged = flagged_ids()
+    post_ids = [post_id for post_id in rank_selected(f.replace(".json", "") for f in files) if post_id not in flagged]
+    print(f"Extracting {len(post_ids)} of {len(files)} files...")
     
-    for filename in files:
-        post_id = filename.replace(".json", "")
+    for post_id in post_ids:
         try:
-            path = extract_canonical(post_id)
+            path = extract_canonical(post_id, WORKSPACE_DIR)
             if path:
                 print(f"Extracted {post_id} -> {path}")
         except Exception as e:
@@ -0,0 +1,122 @@
+import os
+from app.genai_client import client
+from app import metrics
+from app.db import hash_files, get_pending, mark_done
+from app.moderate import PLATFORM_RULES, MODERATION_PREFILTER, prefilter, load_canonical, format_content, apply_moderation
+from app.script_gen import validate_script, save_script
+
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
+# Opt-in: moderate and script each post in one LLM round trip
+FUSED_GEN = os.getenv("FUSED_GEN", "0") == "1"
+
+FUSED_PROMPT = """
+You are a safety classifier and short-video copywriter. First judge the following content (Reddit post title, OP username, top comments) against the short platform rules for TikTok/Instagram/YouTube. Be conservative — if borderline, flag and give reasons. Only if the content is safe, also write a short-video script for it.
+
+""" + PLATFORM_RULES + """
+Content:
+{content}
+
+Answer in strict JSON:
+{
+ "flag": true|false,
+ "reasons": ["..."],
+ "script": null if flagged, otherwise {
+   "tone": "energetic|funny|informative|dry|sardonic",
+   "pacing": "slow|medium|fast",
+   "cta": "max 6 words",
+   "caption_style": "one of: bold-large / minimal / italic",
+   "length_seconds": 30,
+   "scenes": [
+     {"text":"caption line here","start":0.0,"duration":5.0,"visual":"suggestion (image/card)"},
+     ...
+   ]
+ }
+}
+Decide creative options automatically based on content. Keep total durations ≈ length_seconds.
+"""
+
+def validate_fused(result):
+    """
+    Raises ValueError unless the response carries a usable verdict. A bad script
+    alone is fine: the verdict still counts and run_script_gen retries the script.
+    """
+    if not isinstance(result, dict) or not isinstance(result.get("flag"), bool):
+        raise ValueError("Malformed fused response")
+
+def apply_fused_result(post_id, result, canonical_path):
+    """
+    Routes a fused verdict: flagged posts go to flag_post, clean posts have their
+    script saved. Returns (moderated, scripted).
+    """
+    validate_fused(result)
+
+    apply_moderation(post_id, {"flag": result["flag"], "reasons": result.get("reasons") or []}, canonical_path)
+    if result["flag"]:
+        return True, False
+
+    script_json = result.get("script")
+    try:
+        if not isinstance(script_json, dict):
+            raise ValueError("Missing script in fused response")
+        validate_script(script_json)
+    except ValueError as e:
+        # Verdict still counts; run_script_gen picks the script up later
+        print(f"Fused script rejected for {post_id}: {e}")
+        return True, False
+
+    save_script(post_id, script_json)
+    print(f"Script generated for {post_id}")
+    return True, True
+
+def run_fused_gen():
+    """
+    Moderates and scripts every unmoderated canonical post in a single request
+    each. Posts it cannot finish are left pending for run_moderation and
+    run_script_gen.
+    """
+    canonical_dir = os.path.join(WORKSPACE_DIR, "canonical")
+    if not os.path.exists(canonical_dir):
+        print("No canonical directory found.")
+        return
+
+    files = [f for f in os.listdir(canonical_dir) if f.endswith(".json")]
+    inputs = {f.replace(".json", ""): hash_files(os.path.join(canonical_dir, f)) for f in files}
+    pending = get_pending("moderate", inputs)
+    print(f"Fused moderation + script gen for {len(pending)} of {len(files)} files...")
+
+    posts = {}
+    for post_id in pending:
+        loaded = load_canonical(post_id)
+        if not loaded:
+            continue
+        data, canonical_path = loaded
+        # Hard pre-filter hits don't need a script
+        if MODERATION_PREFILTER:
+            decision, reasons = prefilter.check(data)
+            if decision == "flag":
+                print(f"Pre-filter flag {post_id}")
+                apply_moderation(post_id, {"flag": True, "reasons": reasons}, canonical_path)
+                mark_done("moderate", post_id, inputs[post_id])
+                continue
+        posts[post_id] = loaded
+
+    prompts = [FUSED_PROMPT.replace("{content}", format_content(data)) for data, _ in posts.values()]
+    results = client.generate_json_many(prompts, stage="fused", validate=validate_fused)
+
+    for (post_id, (_, canonical_path)), result in zip(posts.items(), results):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            moderated, scripted = apply_fused_result(post_id, result, canonical_path)
+            if moderated:
+                mark_done("moderate", post_id, inputs[post_id])
+            if scripted:
+                mark_done("script", post_id, inputs[post_id])
+        except Exception as e:
+            print(f"Error in fused generation for {post_id}: {e}")
+            metrics.inc("items_total", stage="fused", outcome="failed")
+
+    print(f"Fused gen {client.cache.format_stats('fused')}")
+
+if __name__ == "__main__":
+    run_fused_gen()
@@ -2,17 +2,171 @@ import os
 import json
 import time
 import random
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 import google.generativeai as genai
+from google.ai import generativelanguage as glm
 from google.api_core import exceptions
 from dotenv import load_dotenv
+from app.llm_cache import ResponseCache, cache_key
+from app import metrics, profiling
 
 load_dotenv()
 
+# Per-key limits for concurrent dispatch
+GEMINI_MAX_CONCURRENCY_PER_KEY = int(os.getenv("GEMINI_MAX_CONCURRENCY_PER_KEY", "2"))
+GEMINI_RPM_PER_KEY = float(os.getenv("GEMINI_RPM_PER_KEY", "15"))
+# Seconds a key rests after a quota error (doubling while they repeat), or after other errors
+GEMINI_QUOTA_COOLDOWN = float(os.getenv("GEMINI_QUOTA_COOLDOWN", "10"))
+GEMINI_ERROR_COOLDOWN = float(os.getenv("GEMINI_ERROR_COOLDOWN", "1"))
+GEMINI_MAX_COOLDOWN = float(os.getenv("GEMINI_MAX_COOLDOWN", "600"))
+# When every key is cooling down, wait for the first to come back unless that takes
+# longer than this; otherwise KeysCoolingDown is raised and the stage retries next cycle
+GEMINI_COOLDOWN_WAIT = float(os.getenv("GEMINI_COOLDOWN_WAIT", "5"))
+
+class TokenBucket:
+    """
+    Thread-safe token bucket. Refills `rate` tokens per second up to `capacity`;
+    acquire() blocks until a token is available.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class KeysCoolingDown(Exception):
+    """Every key is cooling down for longer than the scheduler is willing to wait."""
+    def __init__(self, retry_after):
+        super().__init__(f"All Gemini keys are cooling down; next one is free in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class KeyScheduler:
+    """
+    Picks the healthiest key for each request instead of cycling blindly.
+    Tracks per key: requests in flight, latency (EWMA), consecutive failures
+    and a cooldown that quota errors and other errors start. Keys that are
+    cooling down are skipped; among the rest the one with the lowest
+    (in flight + 1) * latency * (1 + failures) wins, least recently used first.
+    """
+    def __init__(self, quota_cooldown=GEMINI_QUOTA_COOLDOWN, error_cooldown=GEMINI_ERROR_COOLDOWN,
+                 max_cooldown=GEMINI_MAX_COOLDOWN, max_wait=GEMINI_COOLDOWN_WAIT):
+        self.quota_cooldown = quota_cooldown
+        self.error_cooldown = error_cooldown
+        self.max_cooldown = max_cooldown
+        self.max_wait = max_wait
+        self.health = {}
+        self.lock = threading.Lock()
+
+    def _health(self, key):
+        if key not in self.health:
+            self.health[key] = {"in_flight": 0, "ok": 0, "quota_errors": 0, "errors": 0, "failures": 0,
+                                "latency": None, "cooldown_until": 0.0, "last_used": 0.0}
+        return self.health[key]
+
+    def _score(self, health, default_latency):
+        latency = health["latency"] if health["latency"] is not None else default_latency
+        return ((health["in_flight"] + 1) * latency * (1 + health["failures"]), health["last_used"])
+
+    def acquire(self, keys):
+        """
+        Returns the best key not cooling down and counts a request in flight on it.
+        If every key is cooling down, waits for the first one to come back, or
+        raises KeysCoolingDown if that is more than max_wait away.
+        """
+        if not keys:
+            raise Exception("No API keys available.")
+        waited_until = 0.0
+        while True:
+            with self.lock:
+                now = max(time.monotonic(), waited_until)
+                healths = {key: self._health(key) for key in keys}
+                ready = [key for key in keys if healths[key]["cooldown_until"] <= now]
+                if ready:
+                    known = [h["latency"] for h in healths.values() if h["latency"] is not None]
+                    default_latency = sum(known) / len(known) if known else 1.0
+                    key = min(ready, key=lambda k: self._score(healths[k], default_latency))
+                    healths[key]["in_flight"] += 1
+                    healths[key]["last_used"] = time.monotonic()
+                    return key
+                soonest = min(h["cooldown_until"] for h in healths.values())
+            wait = soonest - now
+            if wait > self.max_wait:
+                raise KeysCoolingDown(wait)
+            waited_until = soonest
+            time.sleep(wait)
+
+    def release(self, key, status, seconds=None):
+        """
+        Records how a request on key ended ("ok", "quota" or "error").
+        Returns the cooldown it started, in seconds (0 if none).
+        """
+        with self.lock:
+            health = self._health(key)
+            health["in_flight"] = max(0, health["in_flight"] - 1)
+            if status == "ok":
+                health["ok"] += 1
+                health["failures"] = 0
+                if seconds is not None:
+                    health["latency"] = seconds if health["latency"] is None else 0.8 * health["latency"] + 0.2 * seconds
+                return 0
+            health["quota_errors" if status == "quota" else "errors"] += 1
+            health["failures"] += 1
+            base = self.quota_cooldown if status == "quota" else self.error_cooldown
+            cooldown = min(self.max_cooldown, base * 2 ** (health["failures"] - 1))
+            health["cooldown_until"] = max(health["cooldown_until"], time.monotonic() + cooldown)
+            return cooldown
+
+    def stats(self, keys):
+        """Returns [per-key dict] in key order, with seconds of cooldown remaining."""
+        now = time.monotonic()
+        with self.lock:
+            return [dict({k: v for k, v in self._health(key).items() if k not in ("cooldown_until", "last_used")},
+                         cooldown_remaining=max(0.0, self._health(key)["cooldown_until"] - now))
+                    for key in keys]
+
+def bind_service_client(model, service_client):
+    """
+    Points a GenerativeModel at the given service client. google-generativeai has
+    no public per-model client option: it fills the private `_client` from the
+    genai.configure() globals on first use, so setting it first is the only way
+    to give each key its own client. tests/test_genai_client.py checks that
+    requests still go through it.
+    """
+    if not hasattr(model, "_client"):
+        raise RuntimeError("google-generativeai no longer exposes GenerativeModel._client; per-key clients need updating")
+    model._client = service_client
+    return model
+
 class GeminiClient:
     def __init__(self):
         self.keys = self._load_keys()
-        self.current_key_index = 0
+        self.scheduler = KeyScheduler()
         self.model_name = "gemini-2.0-flash" # Default model
+        self.tts_model_name = "gemini-2.5-flash-preview-tts"
+        self.max_concurrency_per_key = GEMINI_MAX_CONCURRENCY_PER_KEY
+        self.rpm_per_key = GEMINI_RPM_PER_KEY
+        self._lock = threading.Lock()
+        # Per-key state, created lazily so `keys` can be swapped after init
+        self._service_clients = {}
+        self._key_slots = {}
+        self._key_buckets = {}
+        # Persistent cache of JSON responses
+        self.cache = ResponseCache()
         
     def _load_keys(self):
         # Load from GEMINI_API_KEYS env var (JSON list)
@@ -28,56 +182,138 @@ class GeminiClient:
         raise ValueError("No Gemini API keys found. Set GEMINI_API_KEYS (JSON list) in .env")
 
     def _get_next_key(self):
-        if not self.keys:
-            raise Exception("No API keys available.")
-        
-        key = self.keys[self.current_key_index]
-        self.current_key_index = (self.current_key_index + 1) % len(self.keys)
-        return key
+        """Healthiest key for the next request; pair every call with _release."""
+        return self.scheduler.acquire(self.keys)
+
+    def _release(self, key, kind, status, seconds=None, retrying=False):
+        cooldown = self.scheduler.release(key, status, seconds)
+        self._record(key, kind, status, seconds, retrying)
+        if cooldown:
+            metrics.inc("gemini_key_cooldowns_total", key=self._key_label(key), reason=status)
+        return cooldown
+
+    def _finish(self, key, kind, status, seconds, can_retry):
+        """Releases a request's key once it ended with status ("ok", "quota" or "error")."""
+        cooldown = self._release(key, kind, status, seconds if status == "ok" else None,
+                                 retrying=status != "ok" and can_retry)
+        if status == "quota":
+            print(f"Quota exceeded for key ending in ...{key[-4:]}. Cooling it down for {cooldown:.0f}s...")
+
+    def key_stats(self):
+        """Per-key health, labelled like the metrics (key0, key1, ...)."""
+        return {self._key_label(key): stats for key, stats in zip(self.keys, self.scheduler.stats(self.keys))}
 
-    def configure_genai(self, key):
-        genai.configure(api_key=key)
+    def _get_model(self, key, model_name):
+        """
+        Builds a model bound to its own per-key service client instead of the
+        process-global genai.configure(), so keys can be used concurrently.
+        """
+        with self._lock:
+            service_client = self._service_clients.get(key)
+            if service_client is None:
+                service_client = glm.GenerativeServiceClient(client_options={"api_key": key})
+                self._service_clients[key] = service_client
+        return bind_service_client(genai.GenerativeModel(model_name), service_client)
+
+    def _key_label(self, key):
+        """Metrics label for a key: its position in the key list, never the key itself."""
+        return f"key{self.keys.index(key)}" if key in self.keys else "unknown"
 
-    def generate_content(self, prompt, retries=3):
+    def _record(self, key, kind, status, seconds=None, retrying=False):
+        label = self._key_label(key)
+        metrics.inc("gemini_requests_total", key=label, kind=kind, status=status)
+        if seconds is not None:
+            metrics.observe("gemini_request_seconds", seconds, key=label, kind=kind)
+        if retrying:
+            metrics.inc("gemini_retries_total", key=label)
+
+    @contextmanager
+    def _key_slot(self, key):
+        """Holds one of the key's concurrency slots after taking a rate-limit token."""
+        with self._lock:
+            if key not in self._key_slots:
+                self._key_slots[key] = threading.BoundedSemaphore(self.max_concurrency_per_key)
+                self._key_buckets[key] = TokenBucket(self.rpm_per_key / 60.0, self.max_concurrency_per_key)
+            slot = self._key_slots[key]
+            bucket = self._key_buckets[key]
+        with slot:
+            bucket.acquire()
+            yield
+
+    def generate_content(self, prompt, retries=3, generation_config=None):
         """
-        Generates content with key rotation and backoff.
+        Generates content on the healthiest key, moving to another key on failure
+        (or waiting out the cooldown when every key is cooling down).
         """
         for attempt in range(retries):
+            key = self._get_next_key()
+            # Released exactly once, in finally, with the request's final status
+            status, seconds = "error", None
             try:
-                key = self._get_next_key()
-                self.configure_genai(key)
-                model = genai.GenerativeModel(self.model_name)
-                
-                response = model.generate_content(prompt)
-                return response.text
+                model = self._get_model(key, self.model_name)
+                with self._key_slot(key):
+                    start = time.monotonic()
+                    if generation_config:
+                        response = model.generate_content(prompt, generation_config=generation_config)
+                    else:
+                        response = model.generate_content(prompt)
+                    seconds = time.monotonic() - start
+                # Raises on blocked or empty candidates, which count as errors
+                text = response.text
+                status = "ok"
+                return text
                 
             except exceptions.ResourceExhausted:
-                print(f"Quota exceeded for key ending in ...{key[-4:]}. Rotating...")
-                time.sleep(2 ** attempt) # Exponential backoff
+                status = "quota"
                 continue
             except Exception as e:
                 print(f"Error generating content: {e}")
                 if attempt == retries - 1:
                     raise e
-                time.sleep(1)
+            finally:
+                self._finish(key, "text", status, seconds, attempt < retries - 1)
                 
         raise Exception("Failed to generate content after retries.")
 
-    def generate_json(self, prompt, retries=3):
+    def generate_json(self, prompt, retries=3, generation_config=None, stage=None, use_cache=True, validate=None):
         """
         Helper to generate JSON content.
+        Responses are cached by (model, prompt, generation config); pass
+        use_cache=False to force regeneration (the fresh response is still stored).
+        validate(result) should raise on a reply the caller can't use; such
+        replies are never cached, so the next call asks the model again.
         """
         full_prompt = f"{prompt}\n\nOutput strictly valid JSON."
-        text = self.generate_content(full_prompt, retries)
+        key = cache_key(self.model_name, full_prompt, generation_config)
+        
+        if use_cache and self.cache:
+            cached = self.cache.get(key, stage)
+            if cached is not None:
+                result = json.loads(cached)
+                try:
+                    if validate:
+                        validate(result)
+                    return result
+                except Exception as e:
+                    print(f"Dropping cached response that fails validation: {e}")
+                    self.cache.delete(key)
+        
+        text = self.generate_content(full_prompt, retries, generation_config)
         
         # Clean up markdown code blocks if present
         text = text.replace("```json", "").replace("```", "").strip()
         
         try:
-            return json.loads(text)
+            result = json.loads(text)
         except json.JSONDecodeError:
             print(f"Failed to parse JSON: {text}")
             raise
+        
+        if validate:
+            validate(result)
+        if self.cache:
+            self.cache.put(key, self.model_name, text)
+        return result
 
     def generate_audio(self, text, retries=3):
         """
@@ -93,39 +329,82 @@ class GeminiClient:
         prompt = f"Read the following text clearly and naturally:\n\n{text}"
         
         for attempt in range(retries):
+            key = self._get_next_key()
+            status, seconds = "error", None
             try:
-                key = self._get_next_key()
-                self.configure_genai(key)
-                
                 # Use specific TTS model
-                model = genai.GenerativeModel("gemini-2.5-flash-preview-tts")
+                model = self._get_model(key, self.tts_model_name)
                 
                 # We need to request audio output if supported, or just check response parts
                 # Some models might need specific config
-                response = model.generate_content(prompt, generation_config={"response_modalities": ["AUDIO"]})
+                with self._key_slot(key):
+                    start = time.monotonic()
+                    response = model.generate_content(prompt, generation_config={"response_modalities": ["AUDIO"]})
+                    seconds = time.monotonic() - start
                 
                 # Check for audio parts
+                audio = None
                 for part in response.parts:
                     if hasattr(part, "inline_data") and part.inline_data.mime_type.startswith("audio"):
                         print(f"Found audio part: {part.inline_data.mime_type}, length: {len(part.inline_data.data)}")
-                        return part.inline_data.data
+                        audio = part.inline_data.data
+                        break
+                status = "ok"
                 
                 # If no audio part, maybe it's not supported by this model/prompt
                 # For the sake of the exercise, if we can't get audio, we might mock it or fail.
                 # Let's try to see if we can force it.
-                print("No audio part found in response.")
-                return None
+                if audio is None:
+                    print("No audio part found in response.")
+                return audio
                 
             except exceptions.ResourceExhausted:
-                print(f"Quota exceeded for key ending in ...{key[-4:]}. Rotating...")
-                time.sleep(2 ** attempt)
+                status = "quota"
                 continue
             except Exception as e:
                 print(f"Error generating audio: {e}")
                 if attempt == retries - 1:
                     raise e
-                time.sleep(1)
+            finally:
+                self._finish(key, "audio", status, seconds, attempt < retries - 1)
         
         raise Exception("Failed to generate audio after retries.")
 
+    def _map(self, fn, items, max_workers=None):
+        """
+        Runs fn over items on a thread pool sized to the total per-key concurrency.
+        Results keep input order; a failed item yields its exception instead.
+        """
+        items = list(items)
+        if not items:
+            return []
+        if max_workers is None:
+            max_workers = max(1, len(self.keys) * self.max_concurrency_per_key)
+        
+        def call(item):
+            # Pool threads are invisible to the stage's profiler unless they attach themselves
+            with profiling.thread_profile():
+                try:
+                    return fn(item)
+                except Exception as e:
+                    return e
+        
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as pool:
+            return list(pool.map(call, items))
+
+    def generate_json_many(self, prompts, retries=3, max_workers=None, stage=None, use_cache=True, validate=None):
+        """
+        Concurrent generate_json over a list of prompts.
+        """
+        return self._map(
+            lambda prompt: self.generate_json(prompt, retries, stage=stage, use_cache=use_cache, validate=validate),
+            prompts, max_workers
+        )
+
+    def generate_audio_many(self, texts, retries=3, max_workers=None):
+        """
+        Concurrent generate_audio over a list of texts.
+        """
+        return self._map(lambda text: self.generate_audio(text, retries), texts, max_workers)
+
 client = GeminiClient()
@@ -2,9 +2,13 @@ import praw
 import os
 import json
 import time
-from datetime import datetime
+import math
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
-from app.db import get_db_connection, init_db
+from app.db import get_db_connection, init_db, work_id
 
 load_dotenv()
 
@@ -12,6 +16,17 @@ REDDIT_CLIENT_ID = os.getenv("REDDIT_CLIENT_ID")
 REDDIT_CLIENT_SECRET = os.getenv("REDDIT_CLIENT_SECRET")
 REDDIT_USER_AGENT = os.getenv("REDDIT_USER_AGENT")
 WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
+# Posts whose comments are fetched concurrently (1 = serial)
+HARVEST_WORKERS = int(os.getenv("HARVEST_WORKERS", "4"))
+TOP_COMMENTS = 10
+# Reddit rate-limit windows are 10 minutes long; only used when no reset time was reported
+RATE_LIMIT_WINDOW = 600
+# reddit.info accepts at most 100 fullnames per request
+INFO_BATCH_SIZE = 100
+# Only candidates fetched this recently are refreshed; matches the workspace retention window
+REFRESH_MAX_AGE_HOURS = float(os.getenv("REFRESH_MAX_AGE_HOURS", "168"))
+# Above this many candidates, known ids are held in a Bloom filter instead of a set
+BLOOM_THRESHOLD = int(os.getenv("HARVEST_BLOOM_THRESHOLD", "1000000"))
 
 def get_reddit_client():
     return praw.Reddit(
@@ -20,8 +35,150 @@ def get_reddit_client():
         user_agent=REDDIT_USER_AGENT
     )
 
-def save_raw_post(post, workspace_dir):
-    """Saves raw post data to JSON file."""
+class BloomFilter:
+    """Fixed-size Bloom filter over strings, using double hashing on one blake2b digest."""
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hash_count)]
+
+    def add(self, item):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+class KnownPostIds:
+    """
+    Post ids already in candidates, preloaded in one query. Small tables use a
+    set; large ones a Bloom filter whose "maybe" answers are confirmed in the DB.
+    """
+    def __init__(self, cursor, bloom_threshold=BLOOM_THRESHOLD):
+        self.cursor = cursor
+        cursor.execute("SELECT COUNT(*) FROM candidates")
+        count = cursor.fetchone()[0]
+        
+        self.ids = None
+        self.bloom = None
+        cursor.execute("SELECT post_id FROM candidates")
+        if count <= bloom_threshold:
+            self.ids = {row[0] for row in cursor}
+        else:
+            # Headroom for this run's additions
+            self.bloom = BloomFilter(count * 2)
+            for row in cursor:
+                self.bloom.add(row[0])
+            self.added = set()
+
+    def __contains__(self, post_id):
+        if self.ids is not None:
+            return post_id in self.ids
+        if post_id not in self.bloom:
+            return False
+        if post_id in self.added:
+            return True
+        self.cursor.execute("SELECT 1 FROM candidates WHERE post_id = ?", (post_id,))
+        return self.cursor.fetchone() is not None
+
+    def add(self, post_id):
+        if self.ids is not None:
+            self.ids.add(post_id)
+        else:
+            self.bloom.add(post_id)
+            self.added.add(post_id)
+
+_thread_local = threading.local()
+
+def get_thread_reddit_client():
+    """PRAW isn't thread-safe, so each harvest worker thread gets its own client."""
+    if not hasattr(_thread_local, "reddit"):
+        _thread_local.reddit = get_reddit_client()
+    return _thread_local.reddit
+
+class RateLimitGate:
+    """
+    Shares Reddit's x-ratelimit-remaining across worker threads (each PRAW client
+    only sees its own responses). Workers stop once the shared budget is down
+    to `reserve` requests and wait until the reported reset time.
+    """
+    def __init__(self, reserve=1):
+        self.reserve = reserve
+        self.remaining = None
+        self.reset_at = None
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            if self.remaining is not None and self.remaining <= self.reserve:
+                if self.reset_at is not None:
+                    sleep_seconds = max(0.0, self.reset_at - time.time()) + 1
+                else:
+                    sleep_seconds = RATE_LIMIT_WINDOW - (time.time() % RATE_LIMIT_WINDOW)
+                print(f"Reddit rate limit nearly exhausted, sleeping {sleep_seconds:.0f}s...")
+                time.sleep(sleep_seconds)
+                self.remaining = None
+                self.reset_at = None
+            elif self.remaining is not None:
+                # Reserve a request for the caller
+                self.remaining -= 1
+
+    def update(self, limits):
+        """Takes the latest server-reported budget, which grows again once a new window starts."""
+        with self.lock:
+            if limits.get("remaining") is not None:
+                self.remaining = limits["remaining"]
+            if limits.get("reset_timestamp") is not None:
+                self.reset_at = limits["reset_timestamp"]
+
+def fetch_top_comments(post):
+    """
+    Fetches only the top-sorted slice of a post's comments instead of the whole
+    forest; Reddit applies the sort and limit server side.
+    """
+    post.comment_sort = "top"
+    post.comment_limit = TOP_COMMENTS
+    post.comments.replace_more(limit=0)
+    comments = []
+    for comment in post.comments.list()[:TOP_COMMENTS]:
+        comments.append({
+            "body": comment.body,
+            "author": str(comment.author),
+            "score": comment.score
+        })
+    return comments
+
+def fetch_comments_concurrently(post_ids, workers=HARVEST_WORKERS):
+    """
+    Fetches top comments for many posts on a bounded thread pool.
+    Returns {post_id: comments}; posts that fail are left out.
+    """
+    gate = RateLimitGate(reserve=workers)
+    
+    def fetch(post_id):
+        gate.wait()
+        reddit = get_thread_reddit_client()
+        try:
+            return post_id, fetch_top_comments(reddit.submission(id=post_id))
+        except Exception as e:
+            print(f"Error fetching comments for {post_id}: {e}")
+            return post_id, None
+        finally:
+            gate.update(reddit.auth.limits)
+    
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = pool.map(fetch, post_ids)
+        return {post_id: comments for post_id, comments in results if comments is not None}
+
+def save_raw_post(post, workspace_dir, comments=None):
+    """Saves raw post data to JSON file. Top comments are fetched unless given."""
     raw_dir = os.path.join(workspace_dir, "raw")
     os.makedirs(raw_dir, exist_ok=True)
     
@@ -39,14 +196,8 @@ def save_raw_post(post, workspace_dir):
     }
     
     # Fetch top comments
-    post.comments.replace_more(limit=0)
-    comments = []
-    for comment in post.comments.list()[:10]:
-        comments.append({
-            "body": comment.body,
-            "author": str(comment.author),
-            "score": comment.score
-        })
+    if comments is None:
+        comments = fetch_top_comments(post)
     post_data["comments_data"] = comments
 
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -56,36 +207,38 @@ def save_raw_post(post, workspace_dir):
     
     return file_path
 
-def harvest(subreddits=["AskReddit", "Showerthoughts", "LifeProTips"], limit=10):
+def harvest(subreddits=["AskReddit", "Showerthoughts", "LifeProTips"], limit=10, workers=HARVEST_WORKERS):
     """Fetches posts from subreddits and saves them."""
     reddit = get_reddit_client()
     conn = get_db_connection()
     cursor = conn.cursor()
     
     print(f"Harvesting from {subreddits}...")
+    known = KnownPostIds(cursor)
     
     for sub_name in subreddits:
         subreddit = reddit.subreddit(sub_name)
-        # Fetch hot and top posts
+        # Fetch hot and top posts, deduplicated before any comment fetching
+        new_posts = {}
         for post in list(subreddit.hot(limit=limit)) + list(subreddit.top("day", limit=limit)):
+            if post.id not in known and post.id not in new_posts:
+                new_posts[post.id] = post
+        new_posts = list(new_posts.values())
+        
+        # Comment fetches dominate harvest time, so run them in parallel
+        comments_by_id = {}
+        if workers > 1 and new_posts:
+            comments_by_id = fetch_comments_concurrently([post.id for post in new_posts], workers)
+        
+        rows = []
+        for post in new_posts:
             try:
-                # Check if already exists
-                cursor.execute("SELECT post_id FROM candidates WHERE post_id = ?", (post.id,))
-                if cursor.fetchone():
-                    continue
-                
                 print(f"Processing {post.id}: {post.title[:50]}...")
                 
                 # Save raw JSON
-                raw_path = save_raw_post(post, WORKSPACE_DIR)
+                raw_path = save_raw_post(post, WORKSPACE_DIR, comments_by_id.get(post.id))
                 
-                # Insert into DB
-                cursor.execute("""
-                    INSERT INTO candidates (
-                        post_id, subreddit, title, op, upvotes, comments, 
-                        fetched_at, age_hours, score, raw_path
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
+                rows.append((
                     post.id,
                     str(post.subreddit),
                     post.title,
@@ -95,16 +248,71 @@ def harvest(subreddits=["AskReddit", "Showerthoughts", "LifeProTips"], limit=10)
                     datetime.now(),
                     (time.time() - post.created_utc) / 3600.0,
                     0.0, # Initial score, will be updated by scorer
-                    raw_path
+                    raw_path,
+                    post.created_utc
                 ))
-                conn.commit()
                 
             except Exception as e:
                 print(f"Error processing {post.id}: {e}")
+        
+        # One transaction per subreddit
+        if rows:
+            cursor.executemany("""
+                INSERT OR IGNORE INTO candidates (
+                    post_id, subreddit, title, op, upvotes, comments, 
+                    fetched_at, age_hours, score, raw_path, created_utc
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+            conn.commit()
+            for row in rows:
+                known.add(row[0])
     
     conn.close()
     print("Harvest complete.")
 
+def get_unprocessed_candidates(cursor, max_age_hours=REFRESH_MAX_AGE_HOURS):
+    """
+    Returns post_ids of candidates fetched within max_age_hours that have been
+    neither scripted nor flagged. Older ones have had their raw files removed
+    by retention, so refreshing them would only cost reddit.info calls.
+    """
+    cursor.execute("SELECT post_id FROM scripts UNION SELECT post_id FROM flagged")
+    processed = {row[0] for row in cursor.fetchall()}
+    cutoff = datetime.now() - timedelta(hours=max_age_hours)
+    cursor.execute("SELECT post_id, raw_path FROM candidates WHERE fetched_at >= ?", (cutoff,))
+    return [
+        row[0] for row in cursor.fetchall()
+        if work_id(row[1]) not in processed
+    ]
+
+def refresh_candidates(batch_size=INFO_BATCH_SIZE):
+    """
+    Re-fetches score, comment count and age for every unprocessed candidate,
+    `batch_size` fullnames per reddit.info request, and writes them back in one
+    transaction.
+    """
+    reddit = get_reddit_client()
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    
+    post_ids = get_unprocessed_candidates(cursor)
+    print(f"Refreshing {len(post_ids)} candidates...")
+    
+    rows = []
+    now = time.time()
+    for start in range(0, len(post_ids), batch_size):
+        fullnames = [f"t3_{post_id}" for post_id in post_ids[start:start + batch_size]]
+        try:
+            for post in reddit.info(fullnames=fullnames):
+                rows.append((post.score, post.num_comments, (now - post.created_utc) / 3600.0, post.id))
+        except Exception as e:
+            print(f"Error refreshing batch at {start}: {e}")
+    
+    cursor.executemany("UPDATE candidates SET upvotes = ?, comments = ?, age_hours = ? WHERE post_id = ?", rows)
+    conn.commit()
+    conn.close()
+    print(f"Refreshed {len(rows)} candidates.")
+
 if __name__ == "__main__":
     init_db()
     harvest()
@@ -0,0 +1,200 @@
+import os
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from app import metrics, profiling
+from app.db import init_db, db_session, hash_files, rank_selected
+from app.pipeline import moderate_step, script_step, tts_step, render_step
+
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
+# A job whose worker stops heartbeating for this long is handed to another worker
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "120"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# First retry delay; doubles with every further attempt
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", "30"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "5"))
+# A job that used up its attempts can be queued again this long after it last failed
+JOB_FAILED_RETRY_SECONDS = float(os.getenv("JOB_FAILED_RETRY_SECONDS", "3600"))
+# Stages this worker takes, in priority order (later stages first so started posts finish)
+JOB_STAGES = os.getenv("JOB_STAGES", "render,tts,script,moderate").split(",")
+
+STEPS = {"moderate": moderate_step, "script": script_step, "tts": tts_step, "render": render_step}
+NEXT_STAGE = {"moderate": "script", "script": "tts", "tts": "render"}
+
+def stage_input_hash(stage, post_id):
+    """Hash of the files a stage reads for post_id, matching the stage ledger."""
+    if stage in ("moderate", "script"):
+        return hash_files(os.path.join(WORKSPACE_DIR, "canonical", f"{post_id}.json"))
+    script_path = os.path.join(WORKSPACE_DIR, "scripts", f"{post_id}.json")
+    if stage == "tts":
+        return hash_files(script_path)
+    return hash_files(script_path, os.path.join(WORKSPACE_DIR, "output", f"{post_id}.wav"))
+
+def enqueue(stage, post_id, input_hash=None, retry_failed_after=JOB_FAILED_RETRY_SECONDS):
+    """
+    Queues a stage job. The same (stage, post, input) is only queued once, unless
+    it failed for good at least retry_failed_after seconds ago; then it is
+    requeued with fresh attempts, so a transient outage doesn't fail the post forever.
+    """
+    input_hash = input_hash or stage_input_hash(stage, post_id)
+    now = datetime.now()
+    with db_session() as conn:
+        cursor = conn.execute("""
+            INSERT INTO jobs (stage, post_id, input_hash, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (stage, post_id, input_hash) DO UPDATE SET
+                status = 'queued', attempts = 0, available_at = 0, worker_id = NULL,
+                lease_expires = NULL, updated_at = excluded.updated_at
+            WHERE jobs.status = 'failed' AND jobs.updated_at <= ?
+        """, (stage, post_id, input_hash, now, now, now - timedelta(seconds=retry_failed_after)))
+        return cursor.rowcount == 1
+
+def enqueue_selected():
+    """Queues moderation for every extracted post in the current selection, best first."""
+    canonical_dir = os.path.join(WORKSPACE_DIR, "canonical")
+    if not os.path.exists(canonical_dir):
+        return 0
+    post_ids = rank_selected(f.replace(".json", "") for f in os.listdir(canonical_dir) if f.endswith(".json"))
+    queued = sum(1 for post_id in post_ids if enqueue("moderate", post_id))
+    print(f"Queued {queued} new moderation jobs ({len(post_ids)} selected posts).")
+    return queued
+
+def reclaim_expired(conn, now):
+    """Requeues running jobs whose lease lapsed; their worker is presumed dead."""
+    conn.execute("""
+        UPDATE jobs SET
+            status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END,
+            worker_id = NULL, lease_expires = NULL, last_error = 'lease expired', updated_at = ?
+        WHERE status = 'running' AND lease_expires < ?
+    """, (JOB_MAX_ATTEMPTS, datetime.now(), now))
+
+def claim(worker_id, stages=JOB_STAGES, lease_seconds=JOB_LEASE_SECONDS):
+    """
+    Atomically leases the next runnable job, trying stages in order.
+    Returns the job as a dict, or None if nothing is runnable.
+    """
+    now = time.time()
+    with db_session() as conn:
+        # Write lock up front: no other worker can pick the same row between SELECT and UPDATE
+        conn.execute("BEGIN IMMEDIATE")
+        reclaim_expired(conn, now)
+        for stage in stages:
+            row = conn.execute("""
+                SELECT * FROM jobs WHERE stage = ? AND status = 'queued' AND available_at <= ?
+                ORDER BY id LIMIT 1
+            """, (stage, now)).fetchone()
+            if row:
+                conn.execute("""
+                    UPDATE jobs SET status = 'running', worker_id = ?, lease_expires = ?,
+                        attempts = attempts + 1, updated_at = ?
+                    WHERE id = ?
+                """, (worker_id, now + lease_seconds, datetime.now(), row['id']))
+                job = dict(row)
+                job["attempts"] += 1
+                return job
+    return None
+
+def heartbeat(job_id, worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """Extends a lease. Returns False if the job is no longer held by worker_id."""
+    with db_session() as conn:
+        cursor = conn.execute("""
+            UPDATE jobs SET lease_expires = ?, updated_at = ?
+            WHERE id = ? AND worker_id = ? AND status = 'running'
+        """, (time.time() + lease_seconds, datetime.now(), job_id, worker_id))
+        return cursor.rowcount == 1
+
+def complete(job_id, worker_id):
+    with db_session() as conn:
+        conn.execute("""
+            UPDATE jobs SET status = 'done', lease_expires = NULL, updated_at = ?
+            WHERE id = ? AND worker_id = ? AND status = 'running'
+        """, (datetime.now(), job_id, worker_id))
+
+def fail(job, worker_id, error):
+    """Requeues a failed job with exponential backoff, or gives up after JOB_MAX_ATTEMPTS."""
+    give_up = job["attempts"] >= JOB_MAX_ATTEMPTS
+    available_at = time.time() + JOB_RETRY_BACKOFF * 2 ** (job["attempts"] - 1)
+    with db_session() as conn:
+        conn.execute("""
+            UPDATE jobs SET status = ?, available_at = ?, worker_id = NULL, lease_expires = NULL,
+                last_error = ?, updated_at = ?
+            WHERE id = ? AND worker_id = ? AND status = 'running'
+        """, ("failed" if give_up else "queued", available_at, str(error), datetime.now(), job["id"], worker_id))
+
+@contextmanager
+def keep_leased(job_id, worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """Heartbeats the lease from a background thread while the body runs."""
+    stop = threading.Event()
+
+    def beat():
+        while not stop.wait(lease_seconds / 3):
+            if not heartbeat(job_id, worker_id, lease_seconds):
+                print(f"Lost lease on job {job_id}")
+                return
+
+    thread = threading.Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+def process_job(job, worker_id, lease_seconds=JOB_LEASE_SECONDS):
+    """Runs one leased job and queues the post's next stage. Returns True on success."""
+    stage, post_id = job["stage"], job["post_id"]
+    print(f"[{worker_id}] {stage} {post_id} (attempt {job['attempts']})")
+    with keep_leased(job["id"], worker_id, lease_seconds), metrics.timed("stage_item_seconds", stage=stage):
+        try:
+            with profiling.span(stage, post_id=post_id, job_id=job["id"], attempt=job["attempts"]):
+                passed = STEPS[stage](post_id)
+            # Moderation drops flagged posts on purpose; other stages only drop on failure
+            if not passed and stage != "moderate":
+                raise RuntimeError(f"{stage} did not complete")
+        except Exception as e:
+            print(f"Job {job['id']} ({stage} {post_id}) failed: {e}")
+            metrics.inc("items_total", stage=stage, outcome="failed")
+            fail(job, worker_id, e)
+            return False
+
+    # Queue before completing: a crash in between only repeats an idempotent step
+    if passed and stage in NEXT_STAGE:
+        enqueue(NEXT_STAGE[stage], post_id)
+    complete(job["id"], worker_id)
+    return True
+
+def queue_counts():
+    """Returns {stage: {status: count}} over the whole job table."""
+    counts = {}
+    with db_session() as conn:
+        for row in conn.execute("SELECT stage, status, COUNT(*) AS n FROM jobs GROUP BY stage, status"):
+            counts.setdefault(row['stage'], {})[row['status']] = row['n']
+    return counts
+
+def run_job_worker(stages=JOB_STAGES, worker_id=None, exit_when_idle=False, poll_seconds=JOB_POLL_SECONDS):
+    """
+    Claims and runs jobs until stopped (or, with exit_when_idle, until nothing
+    is runnable). Any number of these may share the /data volume.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    print(f"Job worker {worker_id} taking {stages}...")
+    processed = 0
+    while True:
+        job = claim(worker_id, stages)
+        if job is None:
+            if exit_when_idle:
+                break
+            time.sleep(poll_seconds)
+            continue
+        process_job(job, worker_id)
+        processed += 1
+    metrics.flush()
+    print(f"Job worker {worker_id} processed {processed} jobs; queue: {queue_counts()}")
+    return processed
+
+if __name__ == "__main__":
+    init_db()
+    metrics.start_flusher()
+    run_job_worker()
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DB_PATH = os.getenv("DB_PATH", "/data/app.db")
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", os.path.join(os.path.dirname(DB_PATH), "llm_cache.db"))
+LLM_CACHE_TTL_HOURS = float(os.getenv("LLM_CACHE_TTL_HOURS", "168"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+LLM_CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "0") == "1"
+
+def cache_key(model_name, prompt, generation_config=None):
+    """Content address for a request: sha256 over model, prompt and generation config."""
+    payload = json.dumps([model_name, prompt, generation_config or {}], sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    SQLite-backed cache of LLM text responses with TTL expiry and LRU eviction.
+    Tracks hit/miss counts per pipeline stage.
+    """
+    def __init__(self, path=LLM_CACHE_PATH, ttl_hours=LLM_CACHE_TTL_HOURS,
+                 max_entries=LLM_CACHE_MAX_ENTRIES, bypass=LLM_CACHE_BYPASS):
+        self.path = path
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_entries = max_entries
+        self.bypass = bypass
+        self.stats = {}
+        self._conn = None
+        self._disabled = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None and not self._disabled:
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                conn = sqlite3.connect(self.path, check_same_thread=False)
+                conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    model TEXT,
+                    response TEXT,
+                    created_at REAL,
+                    last_used REAL
+                );
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses (last_used)")
+                conn.commit()
+                self._conn = conn
+            except (OSError, sqlite3.Error) as e:
+                print(f"Warning: LLM cache disabled ({e})")
+                self._disabled = True
+        return self._conn
+
+    def _count(self, stage, field):
+        stage = stage or "default"
+        counts = self.stats.setdefault(stage, {"hits": 0, "misses": 0})
+        counts[field] += 1
+
+    def get(self, key, stage=None):
+        """Returns the cached response for key, or None on miss, expiry or bypass."""
+        with self._lock:
+            conn = self._connect()
+            if conn is None or self.bypass:
+                self._count(stage, "misses")
+                return None
+
+            now = time.time()
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row and now - row[1] <= self.ttl_seconds:
+                conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                conn.commit()
+                self._count(stage, "hits")
+                return row[0]
+
+            if row:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                conn.commit()
+            self._count(stage, "misses")
+            return None
+
+    def put(self, key, model_name, response):
+        """Stores a response and evicts least-recently-used entries over the size bound."""
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return
+
+            now = time.time()
+            conn.execute("""
+                INSERT OR REPLACE INTO responses (key, model, response, created_at, last_used)
+                VALUES (?, ?, ?, ?, ?)
+            """, (key, model_name, response, now, now))
+            conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+            conn.execute("""
+                DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+            conn.commit()
+
+    def delete(self, key):
+        """Drops one entry, e.g. a cached response that no longer validates."""
+        with self._lock:
+            conn = self._connect()
+            if conn is None:
+                return
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            conn.commit()
+
+    def format_stats(self, stage=None):
+        counts = self.stats.get(stage or "default", {"hits": 0, "misses": 0})
+        return f"cache hits: {counts['hits']}, misses: {counts['misses']}"
@@ -2,8 +2,9 @@ import os
 import json
 from fastapi import FastAPI, HTTPException
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from app.db import get_db_connection
+from app import metrics
 
 app = FastAPI(title="Reelsmith v2")
 
@@ -122,6 +123,14 @@ def resolve_flag(post_id: str):
     conn.close()
     return {"status": "resolved"}
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Prometheus scrape target: series published by the workers plus this process's own."""
+    series = metrics.load_published()
+    series += [(name, dict(labels, source=f"{metrics.METRICS_SOURCE}:ui"), kind, data)
+               for name, labels, kind, data in metrics.registry.snapshot()]
+    return PlainTextResponse(metrics.format_prometheus(series), media_type="text/plain; version=0.0.4")
+
 @app.get("/api/outputs")
 def get_outputs():
     files = []
@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# Identifies this process's series; each container has its own hostname
+METRICS_SOURCE = os.getenv("METRICS_SOURCE", socket.gethostname())
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "15"))
+METRIC_PREFIX = "reelsmith_"
+# Seconds; wide enough for both a DB query and a full harvest
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+HELP = {
+    "stage_seconds": "Wall time of one pipeline step over all posts",
+    "stage_item_seconds": "Time a streaming or queued stage spent on one post",
+    "items_total": "Posts per stage by outcome (processed, skipped, failed)",
+    "gemini_request_seconds": "Latency of one Gemini request",
+    "gemini_requests_total": "Gemini requests by key and status (ok, quota, error)",
+    "gemini_retries_total": "Gemini requests retried after a failure, by key",
+    "gemini_key_cooldowns_total": "Times a key was put in cooldown, by key and reason (quota, error)",
+    "ffmpeg_encode_seconds": "FFmpeg encode time per video",
+    "db_query_seconds": "SQLite statement execution time by statement type",
+}
+
+class Registry:
+    """
+    In-process counters and histograms keyed by (name, labels). Cumulative
+    for the life of the process, like Prometheus client counters.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        series = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[series] = self.counters.get(series, 0) + amount
+
+    def observe(self, name, value, **labels):
+        series = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(series)
+            if histogram is None:
+                histogram = self.histograms[series] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram["buckets"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def snapshot(self):
+        """Returns [(name, labels dict, kind, data)] for every series."""
+        with self.lock:
+            rows = [(name, dict(labels), "counter", value) for (name, labels), value in self.counters.items()]
+            rows += [(name, dict(labels), "histogram", dict(h, buckets=list(h["buckets"])))
+                     for (name, labels), h in self.histograms.items()]
+        return rows
+
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+
+@contextmanager
+def timed(name, **labels):
+    """Observes the wall time of the body, whether or not it raises."""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+def flush(source=METRICS_SOURCE):
+    """
+    Publishes this process's series to the metrics table, replacing its
+    previous snapshot, so the UI container can serve them.
+    """
+    # Imported here: app.db times its own queries through this module
+    from app.db import db_session
+    now = datetime.now()
+    rows = [(source, name, json.dumps(labels, sort_keys=True), kind, json.dumps(data), now)
+            for name, labels, kind, data in registry.snapshot()]
+    try:
+        with db_session() as conn:
+            conn.executemany("""
+                INSERT OR REPLACE INTO metrics (source, name, labels, kind, data, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+    except Exception as e:
+        print(f"Warning: failed to publish metrics: {e}")
+
+def start_flusher(interval=METRICS_FLUSH_SECONDS):
+    """Flushes from a daemon thread every `interval` seconds."""
+    def loop():
+        while True:
+            time.sleep(interval)
+            flush()
+    thread = threading.Thread(target=loop, daemon=True)
+    thread.start()
+    return thread
+
+def load_published(exclude_source=None):
+    """Reads every published series as [(name, labels dict, kind, data)], with a source label."""
+    from app.db import db_session
+    rows = []
+    with db_session() as conn:
+        for row in conn.execute("SELECT source, name, labels, kind, data FROM metrics ORDER BY name, source, labels"):
+            if row['source'] == exclude_source:
+                continue
+            labels = dict(json.loads(row['labels']), source=row['source'])
+            rows.append((row['name'], labels, row['kind'], json.loads(row['data'])))
+    return rows
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+def format_prometheus(series):
+    """Renders [(name, labels, kind, data)] in the Prometheus text exposition format."""
+    lines = []
+    by_name = {}
+    for name, labels, kind, data in series:
+        by_name.setdefault((name, kind), []).append((labels, data))
+
+    for (name, kind), entries in sorted(by_name.items()):
+        metric = METRIC_PREFIX + name
+        if name in HELP:
+            lines.append(f"# HELP {metric} {HELP[name]}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for labels, data in entries:
+            if kind == "counter":
+                lines.append(f"{metric}{format_labels(labels)} {data}")
+                continue
+            for bound, count in zip(BUCKETS, data["buckets"]):
+                lines.append(f"{metric}_bucket{format_labels(dict(labels, le=str(bound)))} {count}")
+            lines.append(f"{metric}_bucket{format_labels(dict(labels, le='+Inf'))} {data['count']}")
+            lines.append(f"{metric}_sum{format_labels(labels)} {data['sum']}")
+            lines.append(f"{metric}_count{format_labels(labels)} {data['count']}")
+    return "\n".join(lines) + "\n"
@@ -1,54 +1,218 @@
 import os
+import re
 import json
+import math
 import shutil
 from datetime import datetime
 from app.genai_client import client
-from app.db import get_db_connection
+from app import metrics, profiling
+from app.db import get_db_connection, hash_files, get_pending, mark_done
 
 WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
+# Posts packed into one moderation request (1 disables batching)
+MODERATION_BATCH_SIZE = int(os.getenv("MODERATION_BATCH_SIZE", "5"))
+# Local first-tier filter; rules can be overridden with a JSON file
+MODERATION_PREFILTER = os.getenv("MODERATION_PREFILTER", "1") == "1"
+MODERATION_RULES_PATH = os.getenv("MODERATION_RULES_PATH")
 
-MODERATION_PROMPT = """
-You are a safety classifier. Given the following content (Reddit post title, OP username, top comments) and the short platform rules for TikTok/Instagram/YouTube, answer in strict JSON: {"flag": true|false, "reasons": ["..."]}. Be conservative — if borderline, flag and give reasons. 
+# block_terms / deny_subreddits flag outright, with no second look, so they
+# must be unambiguous; words with ordinary meanings (e.g. "gore", as in
+# Al Gore) or that turn up in news and history posts (drug names) belong in
+# review_terms. Posts from allow_subreddits with no term hits pass without an
+# LLM call. Everything else (including any review_terms hit) escalates to Gemini.
+DEFAULT_PREFILTER_RULES = {
+    "block_terms": [
+        "nsfw", "porn", "porno", "nudes", "onlyfans",
+    ],
+    "review_terms": [
+        "kill", "killed", "murder", "suicide", "self harm", "die", "dead",
+        "gun", "shoot", "drug", "drugs", "sex", "naked", "blood", "abuse",
+        "racist", "hate", "gore", "cocaine", "heroin", "meth", "fentanyl",
+    ],
+    "deny_subreddits": ["nsfw", "gonewild", "watchpeopledie", "drugs"],
+    "allow_subreddits": ["Showerthoughts", "LifeProTips"],
+}
 
-Platform rules: 
+PLATFORM_RULES = """Platform rules: 
 - No hate speech or harassment
 - No sexually explicit content
 - No dangerous activities or self-harm
 - No graphic violence
 - No illegal goods or services
+"""
+
+MODERATION_PROMPT = """
+You are a safety classifier. Given the following content (Reddit post title, OP username, top comments) and the short platform rules for TikTok/Instagram/YouTube, answer in strict JSON: {"flag": true|false, "reasons": ["..."]}. Be conservative — if borderline, flag and give reasons. 
 
+""" + PLATFORM_RULES + """
 Content: 
 {content}
 """
 
-def moderate_post(post_id):
+MODERATION_BATCH_PROMPT = """
+You are a safety classifier. Below are several independent Reddit posts (title, OP username, top comments), each introduced by "### Post <post_id>", and the short platform rules for TikTok/Instagram/YouTube. Judge each post on its own. Answer in strict JSON with one verdict per post: [{"post_id": "...", "flag": true|false, "reasons": ["..."]}, ...]. Be conservative — if borderline, flag and give reasons. 
+
+""" + PLATFORM_RULES + """
+Posts: 
+{posts}
+"""
+
+def load_canonical(post_id):
+    """Returns (data, canonical_path) for a post, or None if it has no canonical file."""
     canonical_path = os.path.join(WORKSPACE_DIR, "canonical", f"{post_id}.json")
     if not os.path.exists(canonical_path):
         print(f"Canonical file not found: {canonical_path}")
-        return
+        return None
 
     with open(canonical_path, "r") as f:
-        data = json.load(f)
+        return json.load(f), canonical_path
 
-    # Construct content string
+def format_content(data):
+    """Flattens canonical post data into the text block sent to the classifier."""
     content = f"Title: {data['title']}\nOP: {data['op']}\nSelftext: {data['selftext']}\n"
     for c in data['comments']:
         content += f"Comment: {c['body']}\n"
+    return content
+
+def load_prefilter_rules(path=MODERATION_RULES_PATH):
+    """Loads pre-filter rules from a JSON file, falling back to the defaults."""
+    rules = dict(DEFAULT_PREFILTER_RULES)
+    if path:
+        try:
+            with open(path, "r") as f:
+                rules.update(json.load(f))
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Warning: Failed to load moderation rules from {path}: {e}")
+    return rules
+
+class PreFilter:
+    """
+    Local first moderation tier. All block and review terms are compiled into
+    one alternation so title, selftext and comments are scanned in a single pass.
+    """
+    def __init__(self, rules):
+        self.term_tiers = {}
+        for term in rules.get("review_terms", []):
+            self.term_tiers[term.lower()] = "review"
+        for term in rules.get("block_terms", []):
+            self.term_tiers[term.lower()] = "block"
+        self.deny_subreddits = {s.lower() for s in rules.get("deny_subreddits", [])}
+        self.allow_subreddits = {s.lower() for s in rules.get("allow_subreddits", [])}
+        
+        self.pattern = None
+        if self.term_tiers:
+            # Longest first so multi-word terms win over their prefixes
+            terms = sorted(self.term_tiers, key=len, reverse=True)
+            alternation = "|".join(re.escape(t) for t in terms)
+            self.pattern = re.compile(rf"(?<!\w)(?:{alternation})(?!\w)", re.IGNORECASE)
+
+    def check(self, data):
+        """
+        Returns ("flag", reasons), ("pass", []) or ("escalate", []) for canonical post data.
+        """
+        subreddit = str(data.get("subreddit", "")).lower()
+        if subreddit in self.deny_subreddits:
+            return "flag", [f"Denied subreddit: r/{data.get('subreddit')}"]
+        
+        blocked = set()
+        needs_review = False
+        if self.pattern:
+            text = "\n".join(
+                [data.get("title", ""), data.get("selftext", "")]
+                + [c.get("body", "") for c in data.get("comments", [])]
+            )
+            for match in self.pattern.finditer(text):
+                term = match.group(0).lower()
+                if self.term_tiers[term] == "block":
+                    blocked.add(term)
+                else:
+                    needs_review = True
+        
+        if blocked:
+            return "flag", [f"Blocked term: {term}" for term in sorted(blocked)]
+        if subreddit in self.allow_subreddits and not needs_review:
+            return "pass", []
+        return "escalate", []
+
+prefilter = PreFilter(load_prefilter_rules())
+
+def build_moderation_prompt(post_id):
+    """Returns (prompt, canonical_path) for a post, or None if it has no canonical file."""
+    loaded = load_canonical(post_id)
+    if not loaded:
+        return None
+    data, canonical_path = loaded
+    return MODERATION_PROMPT.replace("{content}", format_content(data)), canonical_path
 
-    prompt = MODERATION_PROMPT.replace("{content}", content)
+def build_batch_moderation_prompt(posts):
+    """Packs [(post_id, data), ...] into a single moderation prompt."""
+    blocks = [f"### Post {post_id}\n{format_content(data)}" for post_id, data in posts]
+    return MODERATION_BATCH_PROMPT.replace("{posts}", "\n".join(blocks))
+
+def parse_batch_verdicts(result, post_ids):
+    """
+    Splits a batch response into {post_id: verdict}. Verdicts that are malformed,
+    duplicated or for unknown posts are dropped, so their posts can be re-queued.
+    """
+    if not isinstance(result, list):
+        return {}
+
+    verdicts = {}
+    seen = set()
+    for item in result:
+        if not isinstance(item, dict) or not isinstance(item.get("flag"), bool):
+            continue
+        post_id = str(item.get("post_id", ""))
+        if post_id not in post_ids:
+            continue
+        if post_id in seen:
+            verdicts.pop(post_id, None)
+            continue
+        seen.add(post_id)
+        reasons = item.get("reasons") or []
+        verdicts[post_id] = {"flag": item["flag"], "reasons": reasons if isinstance(reasons, list) else [str(reasons)]}
+    return verdicts
+
+def validate_verdict(result):
+    """Raises ValueError unless result is a {"flag": bool, ...} verdict."""
+    if not isinstance(result, dict) or not isinstance(result.get("flag"), bool):
+        raise ValueError("Malformed moderation verdict")
+
+def validate_batch_verdicts(result):
+    """
+    Raises ValueError unless result is a list with at least one verdict that names
+    its post. Malformed items are left for parse_batch_verdicts to drop, so only
+    their posts are re-queued instead of the whole batch.
+    """
+    if not isinstance(result, list):
+        raise ValueError("Malformed batch moderation response")
+    if not any(isinstance(item, dict) and isinstance(item.get("flag"), bool) and item.get("post_id")
+               for item in result):
+        raise ValueError("Batch response has no usable verdicts")
+
+def apply_moderation(post_id, result, canonical_path):
+    """Flags or passes a post based on the classifier's JSON verdict."""
+    if result.get("flag"):
+        print(f"FLAGGED {post_id}: {result['reasons']}")
+        flag_post(post_id, result['reasons'], canonical_path)
+    else:
+        print(f"PASSED {post_id}")
+
+def moderate_post(post_id):
+    built = build_moderation_prompt(post_id)
+    if not built:
+        return
+    prompt, canonical_path = built
     
     try:
         print(f"Moderating {post_id}...")
-        result = client.generate_json(prompt)
-        
-        if result.get("flag"):
-            print(f"FLAGGED {post_id}: {result['reasons']}")
-            flag_post(post_id, result['reasons'], canonical_path)
-        else:
-            print(f"PASSED {post_id}")
+        result = client.generate_json(prompt, stage="moderate", validate=validate_verdict)
+        apply_moderation(post_id, result, canonical_path)
+        return True
             
     except Exception as e:
         print(f"Error moderating {post_id}: {e}")
+        return False
 
 def flag_post(post_id, reasons, source_path):
     """Moves flagged content to flagged folder and updates DB."""
@@ -67,6 +231,14 @@ def flag_post(post_id, reasons, source_path):
     conn.commit()
     conn.close()
 
+def is_flagged(post_id):
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM flagged WHERE post_id = ?", (post_id,))
+    flagged = cursor.fetchone() is not None
+    conn.close()
+    return flagged
+
 def run_moderation():
     canonical_dir = os.path.join(WORKSPACE_DIR, "canonical")
     if not os.path.exists(canonical_dir):
@@ -74,11 +246,68 @@ def run_moderation():
         return
 
     files = [f for f in os.listdir(canonical_dir) if f.endswith(".json")]
-    print(f"Moderating {len(files)} files...")
+    inputs = {f.replace(".json", ""): hash_files(os.path.join(canonical_dir, f)) for f in files}
+    pending = get_pending("moderate", inputs)
+    print(f"Moderating {len(pending)} of {len(files)} files...")
+    
+    posts = {}
+    for post_id in pending:
+        loaded = load_canonical(post_id)
+        if loaded:
+            posts[post_id] = loaded
+
+    def finish(post_id, result):
+        try:
+            with profiling.span("moderate", post_id=post_id):
+                if isinstance(result, Exception):
+                    raise result
+                apply_moderation(post_id, result, posts[post_id][1])
+                mark_done("moderate", post_id, inputs[post_id])
+        except Exception as e:
+            print(f"Error moderating {post_id}: {e}")
+            metrics.inc("items_total", stage="moderate", outcome="failed")
+
+    # Settle obvious cases locally; only ambiguous posts go to Gemini
+    if MODERATION_PREFILTER and posts:
+        total = len(posts)
+        resolved = 0
+        for post_id in list(posts):
+            decision, reasons = prefilter.check(posts[post_id][0])
+            if decision == "escalate":
+                continue
+            print(f"Pre-filter {decision} {post_id}")
+            finish(post_id, {"flag": decision == "flag", "reasons": reasons})
+            del posts[post_id]
+            resolved += 1
+        batch_size = MODERATION_BATCH_SIZE if MODERATION_BATCH_SIZE > 1 and total > 1 else 1
+        calls_saved = math.ceil(total / batch_size) - math.ceil(len(posts) / batch_size)
+        print(f"Pre-filter resolved {resolved} of {total} posts locally, saving {calls_saved} LLM calls")
+
+    # Pack K posts per request; anything the batch response doesn't cover is re-queued
+    requeue = list(posts)
+    if MODERATION_BATCH_SIZE > 1 and len(posts) > 1:
+        batches = [requeue[i:i + MODERATION_BATCH_SIZE] for i in range(0, len(requeue), MODERATION_BATCH_SIZE)]
+        prompts = [build_batch_moderation_prompt([(pid, posts[pid][0]) for pid in batch]) for batch in batches]
+        results = client.generate_json_many(prompts, stage="moderate", validate=validate_batch_verdicts)
+        
+        requeue = []
+        for batch, result in zip(batches, results):
+            verdicts = parse_batch_verdicts(result, batch)
+            for post_id in batch:
+                if post_id in verdicts:
+                    finish(post_id, verdicts[post_id])
+                else:
+                    requeue.append(post_id)
+        if requeue:
+            print(f"Re-queuing {len(requeue)} posts for individual moderation")
+    
+    # Dispatch remaining single-post prompts concurrently across the configured keys
+    prompts = [MODERATION_PROMPT.replace("{content}", format_content(posts[pid][0])) for pid in requeue]
+    results = client.generate_json_many(prompts, stage="moderate", validate=validate_verdict)
+    for post_id, result in zip(requeue, results):
+        finish(post_id, result)
     
-    for filename in files:
-        post_id = filename.replace(".json", "")
-        moderate_post(post_id)
+    print(f"Moderation {client.cache.format_stats('moderate')}")
 
 if __name__ == "__main__":
     run_moderation()
@@ -0,0 +1,213 @@
+import os
+import json
+import time
+import queue
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from app import metrics, profiling
+from app.db import hash_files, get_pending, mark_done, rank_selected
+from app.genai_client import client
+from app.extract import extract_canonical
+from app.moderate import MODERATION_PREFILTER, MODERATION_PROMPT, prefilter, load_canonical, format_content, apply_moderation, is_flagged, validate_verdict
+from app.script_gen import generate_script
+from app.fused_gen import FUSED_GEN, FUSED_PROMPT, apply_fused_result, validate_fused
+from app.tts_gen import generate_tts
+from app.render import RENDER_BACKEND, RENDER_JOBS, RENDER_TIMEOUT, render_job
+
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
+# Posts waiting between two stages; a full queue pauses the stage feeding it
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", "4"))
+# Worker threads per stage, e.g. {"moderate": 4, "script": 4}; render defaults to RENDER_JOBS
+STAGE_WORKERS = {"extract": 1, "moderate": 2, "script": 2, "tts": 2, "render": RENDER_JOBS}
+STAGE_WORKERS.update(json.loads(os.getenv("STAGE_WORKERS", "{}")))
+
+_DONE = object()
+
+class Stage:
+    """
+    One step of the streaming pipeline. fn(post_id) does the work and returns
+    truthy to pass the post on to the next stage.
+    """
+    def __init__(self, name, fn, workers=1, queue_size=STAGE_QUEUE_SIZE):
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.queue_size = queue_size
+
+def run_stages(post_ids, stages):
+    """
+    Streams post_ids through stages, each a pool of worker threads fed by a
+    bounded queue, so a post moves on as soon as its own work is done.
+    Returns per-stage counts {name: {"passed", "dropped", "failed", "seconds",
+    "first"}}, where "first" is when the stage first passed a post, measured
+    from the start of the run.
+    """
+    queues = [queue.Queue(maxsize=max(1, stage.queue_size)) for stage in stages]
+    stats = {stage.name: {"passed": 0, "dropped": 0, "failed": 0, "seconds": 0.0, "first": None} for stage in stages}
+    lock = threading.Lock()
+    run_start = time.monotonic()
+
+    def work(index):
+        with profiling.thread_profile():
+            consume(index)
+
+    def consume(index):
+        stage = stages[index]
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(stages) else None
+        while True:
+            post_id = inbox.get()
+            if post_id is _DONE:
+                # Let this stage's other workers see it too
+                inbox.put(_DONE)
+                return
+
+            start = time.monotonic()
+            try:
+                with profiling.span(stage.name, post_id=post_id):
+                    outcome = "passed" if stage.fn(post_id) else "dropped"
+            except Exception as e:
+                print(f"Error in {stage.name} for {post_id}: {e}")
+                outcome = "failed"
+                metrics.inc("items_total", stage=stage.name, outcome="failed")
+            metrics.observe("stage_item_seconds", time.monotonic() - start, stage=stage.name)
+            with lock:
+                counts = stats[stage.name]
+                counts[outcome] += 1
+                counts["seconds"] += time.monotonic() - start
+                if outcome == "passed" and counts["first"] is None:
+                    counts["first"] = time.monotonic() - run_start
+
+            if outcome == "passed" and outbox is not None:
+                outbox.put(post_id)
+
+    threads = []
+    for index, stage in enumerate(stages):
+        threads.append([threading.Thread(target=work, args=(index,), daemon=True) for _ in range(stage.workers)])
+        for thread in threads[-1]:
+            thread.start()
+
+    for post_id in post_ids:
+        queues[0].put(post_id)
+    queues[0].put(_DONE)
+
+    # Each stage closes once everything upstream of it has drained
+    for index in range(len(stages)):
+        for thread in threads[index]:
+            thread.join()
+        if index + 1 < len(stages):
+            queues[index + 1].put(_DONE)
+
+    return stats
+
+def extract_step(post_id):
+    if is_flagged(post_id):
+        return False
+    return bool(extract_canonical(post_id))
+
+def moderate_step(post_id):
+    """Moderates one post unless the ledger has it; passes posts that aren't flagged."""
+    loaded = load_canonical(post_id)
+    if not loaded:
+        return False
+    data, canonical_path = loaded
+    input_hash = hash_files(canonical_path)
+
+    if get_pending("moderate", {post_id: input_hash}):
+        decision = "escalate"
+        if MODERATION_PREFILTER:
+            decision, reasons = prefilter.check(data)
+        if decision == "escalate" and FUSED_GEN:
+            # Script comes back in the same response; script_step then finds it in the ledger
+            result = client.generate_json(FUSED_PROMPT.replace("{content}", format_content(data)), stage="fused", validate=validate_fused)
+            _, scripted = apply_fused_result(post_id, result, canonical_path)
+            if scripted:
+                mark_done("script", post_id, input_hash)
+        else:
+            if decision == "escalate":
+                result = client.generate_json(MODERATION_PROMPT.replace("{content}", format_content(data)), stage="moderate", validate=validate_verdict)
+            else:
+                print(f"Pre-filter {decision} {post_id}")
+                result = {"flag": decision == "flag", "reasons": reasons}
+            apply_moderation(post_id, result, canonical_path)
+        mark_done("moderate", post_id, input_hash)
+
+    return not is_flagged(post_id)
+
+def script_step(post_id):
+    canonical_path = os.path.join(WORKSPACE_DIR, "canonical", f"{post_id}.json")
+    input_hash = hash_files(canonical_path)
+    if get_pending("script", {post_id: input_hash}):
+        if not generate_script(post_id):
+            return False
+        mark_done("script", post_id, input_hash)
+    return True
+
+def tts_step(post_id):
+    script_path = os.path.join(WORKSPACE_DIR, "scripts", f"{post_id}.json")
+    input_hash = hash_files(script_path)
+    if get_pending("tts", {post_id: input_hash}):
+        if not generate_tts(post_id):
+            return False
+        mark_done("tts", post_id, input_hash)
+    return True
+
+def render_step(post_id, pool=None, threads=None):
+    """Renders one post, on `pool` if given so FFmpeg frame work stays off the calling thread."""
+    script_path = os.path.join(WORKSPACE_DIR, "scripts", f"{post_id}.json")
+    audio_path = os.path.join(WORKSPACE_DIR, "output", f"{post_id}.wav")
+    input_hash = hash_files(script_path, audio_path)
+    if not get_pending("render", {post_id: input_hash}):
+        return True
+
+    if pool is None:
+        _, path, seconds = render_job(post_id, threads, RENDER_TIMEOUT)
+    else:
+        _, path, seconds = pool.submit(render_job, post_id, threads, RENDER_TIMEOUT).result()
+    metrics.observe("ffmpeg_encode_seconds", seconds, backend=RENDER_BACKEND)
+    if not path:
+        return False
+    mark_done("render", post_id, input_hash)
+    print(f"Rendered {post_id} in {seconds:.1f}s")
+    return True
+
+def run_streaming(stage_workers=None):
+    """
+    Runs the selected raw posts through extract -> moderate -> script -> TTS ->
+    render as a stage graph, best-scored first.
+    """
+    workers = dict(STAGE_WORKERS, **(stage_workers or {}))
+    raw_dir = os.path.join(WORKSPACE_DIR, "raw")
+    if not os.path.exists(raw_dir):
+        print("No raw directory found.")
+        return
+
+    post_ids = rank_selected(f.replace(".json", "") for f in os.listdir(raw_dir) if f.endswith(".json"))
+    render_jobs = max(1, workers["render"])
+    # Split the cores between concurrent encoders to avoid oversubscription
+    threads = max(1, (os.cpu_count() or 1) // render_jobs) if render_jobs > 1 else None
+    print(f"Streaming {len(post_ids)} posts through the pipeline ({workers})...")
+
+    start = time.monotonic()
+    # Spawned, not forked: the stage threads may hold locks at fork time
+    with ProcessPoolExecutor(max_workers=render_jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+        stages = [
+            Stage("extract", extract_step, workers["extract"]),
+            Stage("moderate", moderate_step, workers["moderate"]),
+            Stage("script", script_step, workers["script"]),
+            Stage("tts", tts_step, workers["tts"]),
+            Stage("render", lambda post_id: render_step(post_id, pool, threads), render_jobs),
+        ]
+        stats = run_stages(post_ids, stages)
+
+    first_video = stats["render"]["first"]
+    print(f"Pipeline finished in {time.monotonic() - start:.1f}s"
+          + (f", first video after {first_video:.1f}s" if first_video is not None else ""))
+    for name, counts in stats.items():
+        print(f"  {name}: {counts['passed']} passed, {counts['dropped']} dropped, "
+              f"{counts['failed']} failed, {counts['seconds']:.1f}s busy")
+    return stats
+
+if __name__ == "__main__":
+    run_streaming()
@@ -0,0 +1,138 @@
+import os
+import io
+import json
+import time
+import uuid
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
+# Opt-in: cProfile + tracemalloc per stage and per-post trace spans
+PROFILE = os.getenv("PROFILE", "0") == "1"
+# Limit profiling to these stages (comma-separated); empty means every stage
+PROFILE_STAGES = [s for s in os.getenv("PROFILE_STAGES", "").split(",") if s]
+# Rows in the text reports
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "40"))
+
+_lock = threading.Lock()
+_run = {"id": None, "dir": None}
+# Stage currently under the profiler; worker threads attach their profiles to it
+_active = None
+
+def start_run(run_id=None):
+    """Starts a run; profiles and spans go to workspace/profiles/<run_id>/."""
+    run_id = run_id or f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    with _lock:
+        _run["id"] = run_id
+        _run["dir"] = os.path.join(WORKSPACE_DIR, "profiles", run_id)
+    if PROFILE:
+        os.makedirs(_run["dir"], exist_ok=True)
+        print(f"Profiling run {run_id} -> {_run['dir']}")
+    return run_id
+
+def current_run_id():
+    if _run["id"] is None:
+        start_run()
+    return _run["id"]
+
+def enabled(stage=None):
+    return PROFILE and (stage is None or not PROFILE_STAGES or stage in PROFILE_STAGES)
+
+@contextmanager
+def span(name, post_id=None, **attrs):
+    """Appends one trace span (run_id, name, post, timing, status) to traces.jsonl."""
+    if not PROFILE:
+        yield
+        return
+    run_id = current_run_id()
+    start = time.time()
+    status = "ok"
+    try:
+        yield
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        record = {"run_id": run_id, "span": name, "post_id": post_id, "start": start,
+                  "duration": time.time() - start, "status": status, "thread": threading.current_thread().name}
+        record.update(attrs)
+        with _lock:
+            os.makedirs(_run["dir"], exist_ok=True)
+            with open(os.path.join(_run["dir"], "traces.jsonl"), "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+@contextmanager
+def thread_profile():
+    """Profiles the calling worker thread into the active stage's report."""
+    session = _active
+    if session is None:
+        yield
+        return
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Python 3.12+ allows one active profiler per process
+        yield
+        return
+    try:
+        yield
+    finally:
+        profile.disable()
+        with _lock:
+            session["profiles"].append(profile)
+
+@contextmanager
+def stage_profile(stage):
+    """
+    Runs the body under cProfile and tracemalloc and writes <stage>.prof,
+    <stage>.txt (top functions) and <stage>.alloc.txt (top allocation sites).
+    Worker threads only appear if they use thread_profile().
+    """
+    global _active
+    if not enabled(stage):
+        yield
+        return
+
+    run_dir = os.path.join(WORKSPACE_DIR, "profiles", current_run_id())
+    os.makedirs(run_dir, exist_ok=True)
+    profile = cProfile.Profile()
+    session = {"profiles": [profile]}
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    _active = session
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        _active = None
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracemalloc:
+            tracemalloc.stop()
+        write_reports(run_dir, stage, session["profiles"], snapshot, peak)
+
+def write_reports(run_dir, stage, profiles, snapshot, peak):
+    stats = pstats.Stats(profiles[0])
+    for profile in profiles[1:]:
+        stats.add(profile)
+    stats.dump_stats(os.path.join(run_dir, f"{stage}.prof"))
+
+    out = io.StringIO()
+    pstats.Stats(os.path.join(run_dir, f"{stage}.prof"), stream=out).sort_stats("cumulative").print_stats(PROFILE_TOP)
+    with open(os.path.join(run_dir, f"{stage}.txt"), "w") as f:
+        f.write(f"Run {_run['id']}, stage {stage}, {len(profiles)} profiled thread(s)\n")
+        f.write(out.getvalue())
+
+    with open(os.path.join(run_dir, f"{stage}.alloc.txt"), "w") as f:
+        f.write(f"Run {_run['id']}, stage {stage}, peak traced memory {peak / 1024 / 1024:.1f} MiB\n")
+        for stat in snapshot.statistics("lineno")[:PROFILE_TOP]:
+            f.write(f"{stat}\n")
+    print(f"Profile for {stage} written to {run_dir}")
@@ -1,45 +1,194 @@
 import os
 import json
+import math
+import hashlib
+import wave
+import time
+import tempfile
+import threading
 import subprocess
-import textwrap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from PIL import Image, ImageDraw, ImageFont
+from app import metrics, profiling
+from app.db import hash_files, get_pending, mark_done
 
 WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
+# "pipe" streams raw frames into FFmpeg; "concat" writes PNGs for the concat demuxer;
+# "segments" encodes each scene once into a cached segment and stream-copies them together
+RENDER_BACKEND = os.getenv("RENDER_BACKEND", "pipe")
+# Timing resolution of piped cards; FFmpeg duplicates frames up to the profile's rate
+RENDER_PIPE_FPS = int(os.getenv("RENDER_PIPE_FPS", "5"))
+# Length of the cached segment that holds the last card until the narration ends
+RENDER_HOLD_SECONDS = float(os.getenv("RENDER_HOLD_SECONDS", "5"))
 
-def create_card(text, output_path, width=1080, height=1920):
-    """Creates a simple text card."""
-    img = Image.new('RGB', (width, height), color=(30, 30, 30))
+# Encoding profiles tuned for static cards with narration: low frame rates,
+# sparse keyframes and x264's stillimage tune instead of live-action defaults.
+RENDER_PROFILES = {
+    "draft": {"fps": 10, "keyint_seconds": 10, "preset": "ultrafast", "tune": "stillimage", "crf": 30, "audio_bitrate": "64k"},
+    "standard": {"fps": 15, "keyint_seconds": 5, "preset": "veryfast", "tune": "stillimage", "crf": 23, "audio_bitrate": "128k"},
+    "archive": {"fps": 30, "keyint_seconds": 2, "preset": "slow", "tune": "stillimage", "crf": 18, "audio_bitrate": "192k"},
+}
+RENDER_PROFILE = os.getenv("RENDER_PROFILE", "standard")
+# Concurrent FFmpeg jobs in run_render; cores are split evenly between them
+RENDER_JOBS = int(os.getenv("RENDER_JOBS", str(max(1, (os.cpu_count() or 1) // 4))))
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "600"))
+
+WIDTH = 1080
+HEIGHT = 1920
+
+FONT_DIR = "/usr/share/fonts/truetype/dejavu"
+
+# Card look per script caption_style; anything unknown renders as DEFAULT_STYLE
+CAPTION_STYLES = {
+    "bold-large": {"font": "DejaVuSans-Bold.ttf", "size": 72, "background": (30, 30, 30)},
+    "minimal": {"font": "DejaVuSans.ttf", "size": 56, "background": (30, 30, 30)},
+    "italic": {"font": "DejaVuSans-BoldOblique.ttf", "size": 60, "background": (30, 30, 30)},
+}
+DEFAULT_STYLE = {"font": "DejaVuSans-Bold.ttf", "size": 60, "background": (30, 30, 30)}
+CARD_MARGIN = 60
+
+# Module-level render caches: fonts are parsed once per (file, size), glyph
+# advances are measured once per font, backgrounds are built once per style.
+_fonts = {}
+_glyph_widths = {}
+_templates = {}
+
+def get_font(font_file, size):
+    """Loads a TrueType font once per (file, size), falling back to bold then the default font."""
+    key = (font_file, size)
+    if key not in _fonts:
+        font = None
+        for candidate in (font_file, DEFAULT_STYLE["font"]):
+            try:
+                # This path is common in some linux distros, but might fail in slim
+                font = ImageFont.truetype(os.path.join(FONT_DIR, candidate), size)
+                break
+            except IOError:
+                continue
+        if font is None:
+            # Default font is very small, but it's a fallback
+            font = ImageFont.load_default()
+        _fonts[key] = font
+    return _fonts[key]
+
+def text_width(font, text):
+    """Pixel width of text from memoized per-glyph advances."""
+    widths = _glyph_widths.setdefault(id(font), {})
+    total = 0.0
+    for char in text:
+        width = widths.get(char)
+        if width is None:
+            width = widths[char] = font.getlength(char)
+        total += width
+    return total
+
+def wrap_text(text, font, max_width):
+    """Greedy word wrap on measured widths; words wider than a line are split."""
+    space = text_width(font, " ")
+    lines = []
+    line = ""
+    line_width = 0.0
+    for word in text.split():
+        word_width = text_width(font, word)
+        if line and line_width + space + word_width <= max_width:
+            line += " " + word
+            line_width += space + word_width
+            continue
+        if line:
+            lines.append(line)
+        # Hard-break words that can't fit on a line of their own
+        while word_width > max_width and len(word) > 1:
+            cut = len(word) - 1
+            while cut > 1 and text_width(font, word[:cut]) > max_width:
+                cut -= 1
+            lines.append(word[:cut])
+            word = word[cut:]
+            word_width = text_width(font, word)
+        line, line_width = word, word_width
+    if line:
+        lines.append(line)
+    return lines
+
+def get_template(caption_style, width, height):
+    """Pre-built background for a caption style; callers must copy() before drawing."""
+    style = CAPTION_STYLES.get(caption_style, DEFAULT_STYLE)
+    key = (style["background"], width, height)
+    if key not in _templates:
+        _templates[key] = Image.new('RGB', (width, height), color=style["background"])
+    return _templates[key]
+
+def render_card(text, width=WIDTH, height=HEIGHT, caption_style=None):
+    """Draws a simple text card and returns it as an RGB image."""
+    style = CAPTION_STYLES.get(caption_style, DEFAULT_STYLE)
+    img = get_template(caption_style, width, height).copy()
     d = ImageDraw.Draw(img)
+    font = get_font(style["font"], style["size"])
     
-    # Try to load a better font, fallback to default
-    try:
-        # This path is common in some linux distros, but might fail in slim
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 60)
-    except IOError:
-        font = ImageFont.load_default()
-        # Default font is very small, but it's a fallback
-    
-    # Wrap text
-    # Estimate chars per line (very rough)
-    chars_per_line = 30 
-    lines = textwrap.wrap(text, width=chars_per_line)
+    # Wrap text on measured glyph widths
+    lines = wrap_text(text, font, width - 2 * CARD_MARGIN)
     
     # Draw text centered
     # Simple vertical centering
-    line_height = 70 # approx for 60pt font
+    line_height = int(style["size"] * 7 / 6) # ~70 for 60pt font
     total_height = len(lines) * line_height
     y = (height - total_height) / 2
     
     for line in lines:
-        # d.textbbox is better but let's stick to simple for now or use textlength
-        # d.text((x, y), line, font=font, fill=(255, 255, 255), anchor="mm") 
         # anchor="mm" centers it at x,y. 
         d.text((width/2, y), line, font=font, fill=(255, 255, 255), anchor="mm")
         y += line_height
         
-    img.save(output_path)
+    return img
+
+def create_card(text, output_path, width=WIDTH, height=HEIGHT, caption_style=None):
+    """Creates a simple text card."""
+    render_card(text, width, height, caption_style).save(output_path)
+
+def get_audio_duration(audio_path):
+    """Returns the duration of a WAV file in seconds, or 0 if it can't be read."""
+    try:
+        with wave.open(audio_path, "rb") as wav_file:
+            return wav_file.getnframes() / float(wav_file.getframerate())
+    except (wave.Error, EOFError, OSError):
+        return 0.0
+
+def get_profile(name=None):
+    """Looks up a render profile by name, defaulting to RENDER_PROFILE."""
+    name = name or RENDER_PROFILE
+    if name not in RENDER_PROFILES:
+        raise ValueError(f"Unknown render profile: {name}")
+    return RENDER_PROFILES[name]
+
+def build_video_args(profile, threads=None):
+    """FFmpeg video encoder options for a render profile."""
+    args = [
+        "-c:v", "libx264",
+        "-preset", profile["preset"],
+        "-tune", profile["tune"],
+        "-crf", str(profile["crf"]),
+        "-r", str(profile["fps"]),
+        "-g", str(profile["fps"] * profile["keyint_seconds"]),
+        "-pix_fmt", "yuv420p", # Ensure compatibility
+    ]
+    if threads:
+        # Cap encoder threads when several jobs share the machine
+        args += ["-threads", str(threads)]
+    return args
+
+def build_audio_args(profile):
+    """FFmpeg audio options for a render profile, ending the video with the shorter stream."""
+    return [
+        "-c:a", "aac",
+        "-b:a", profile["audio_bitrate"],
+        "-shortest", # Stop when shortest input ends (usually audio or video, whichever is shorter)
+    ]
 
-def generate_video(post_id):
+def build_output_args(profile, threads=None):
+    """FFmpeg output options for a render profile."""
+    return build_video_args(profile, threads) + build_audio_args(profile)
+
+def generate_video(post_id, threads=None, timeout=None, profile=None):
     scripts_dir = os.path.join(WORKSPACE_DIR, "scripts")
     output_dir = os.path.join(WORKSPACE_DIR, "output")
     script_path = os.path.join(scripts_dir, f"{post_id}.json")
@@ -55,6 +204,25 @@ def generate_video(post_id):
     with open(script_path, "r") as f:
         data = json.load(f)
 
+    output_video_path = os.path.join(output_dir, f"{post_id}.mp4")
+    scenes = data.get("scenes", [])
+    caption_style = data.get("caption_style")
+    
+    print(f"Rendering video for {post_id}...")
+    output_args = build_output_args(get_profile(profile), threads)
+    if RENDER_BACKEND == "segments":
+        ok = render_segments(scenes, audio_path, output_video_path, caption_style, get_profile(profile), threads, timeout)
+    elif RENDER_BACKEND == "concat":
+        ok = render_concat(post_id, scenes, audio_path, output_video_path, caption_style, output_args, timeout)
+    else:
+        ok = render_pipe(scenes, audio_path, output_video_path, caption_style, output_args, timeout)
+    
+    if ok:
+        print(f"Video saved to {output_video_path}")
+        return output_video_path
+
+def render_concat(post_id, scenes, audio_path, output_video_path, caption_style=None, output_args=(), timeout=None):
+    """Writes a PNG per scene and stitches them with FFmpeg's concat demuxer."""
     # Create temp dir for frames
     frames_dir = os.path.join(WORKSPACE_DIR, "frames", post_id)
     os.makedirs(frames_dir, exist_ok=True)
@@ -62,12 +230,12 @@ def generate_video(post_id):
     concat_list_path = os.path.join(frames_dir, "concat.txt")
     
     with open(concat_list_path, "w") as f:
-        for i, scene in enumerate(data.get("scenes", [])):
+        for i, scene in enumerate(scenes):
             text = scene.get("text", "")
             duration = scene.get("duration", 3.0)
             
             image_path = os.path.join(frames_dir, f"scene_{i:03d}.png")
-            create_card(text, image_path)
+            create_card(text, image_path, caption_style=caption_style)
             
             # FFmpeg concat format
             # file 'path'
@@ -80,14 +248,12 @@ def generate_video(post_id):
         # But usually just adding the last file again without duration helps, 
         # or just relying on the fact that we have audio.
         # Let's add the last file again to be safe if the audio is longer.
-        if data.get("scenes"):
-             last_image = os.path.join(frames_dir, f"scene_{len(data['scenes'])-1:03d}.png")
+        if scenes:
+             last_image = os.path.join(frames_dir, f"scene_{len(scenes)-1:03d}.png")
              abs_last_image = os.path.abspath(last_image)
              f.write(f"file '{abs_last_image}'\n")
 
     # Run FFmpeg
-    output_video_path = os.path.join(output_dir, f"{post_id}.mp4")
-    
     cmd = [
         "ffmpeg",
         "-y", # Overwrite
@@ -95,22 +261,238 @@ def generate_video(post_id):
         "-safe", "0",
         "-i", concat_list_path,
         "-i", audio_path,
-        "-c:v", "libx264",
-        "-pix_fmt", "yuv420p", # Ensure compatibility
-        "-c:a", "aac",
-        "-shortest", # Stop when shortest input ends (usually audio or video, whichever is shorter)
-        # Actually, if video is defined by duration, it might be shorter/longer than audio.
-        # If we want to match audio, we should ensure video is long enough.
-        # But -shortest is good practice if we want to clip silence or extra frames.
+        *output_args,
         output_video_path
     ]
     
-    print(f"Rendering video for {post_id}...")
     try:
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        print(f"Video saved to {output_video_path}")
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+        return True
     except subprocess.CalledProcessError as e:
         print(f"FFmpeg error: {e.stderr.decode()}")
+        return False
+    except subprocess.TimeoutExpired:
+        print(f"FFmpeg timed out after {timeout}s: {output_video_path}")
+        return False
+
+def scene_frame_counts(scenes, fps, min_duration=0.0):
+    """
+    Frames to emit per scene at `fps`. Rounds on cumulative time so durations
+    don't drift, and stretches the last scene to cover min_duration (the audio).
+    """
+    counts = []
+    elapsed = 0.0
+    emitted = 0
+    for scene in scenes:
+        elapsed += float(scene.get("duration", 3.0))
+        end = round(elapsed * fps)
+        counts.append(max(0, end - emitted))
+        emitted += counts[-1]
+    if counts:
+        counts[-1] += max(0, math.ceil(min_duration * fps) - emitted)
+    return counts
+
+def render_pipe(scenes, audio_path, output_video_path, caption_style=None, output_args=(), timeout=None):
+    """
+    Composites each card in memory and streams it to FFmpeg as rawvideo over
+    stdin, once per frame at RENDER_PIPE_FPS. No PNGs touch the disk.
+    """
+    cmd = [
+        "ffmpeg",
+        "-y", # Overwrite
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "-s", f"{WIDTH}x{HEIGHT}",
+        "-r", str(RENDER_PIPE_FPS),
+        "-i", "-",
+        "-i", audio_path,
+        *output_args,
+        output_video_path
+    ]
+    
+    counts = scene_frame_counts(scenes, RENDER_PIPE_FPS, get_audio_duration(audio_path))
+    
+    # stderr goes to a file so a chatty FFmpeg can't block while we write stdin
+    with tempfile.TemporaryFile() as stderr_file:
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr_file)
+        # Killing FFmpeg also unblocks a pending stdin write
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            proc.kill()
+        timer = threading.Timer(timeout, kill) if timeout else None
+        if timer:
+            timer.start()
+        try:
+            for scene, count in zip(scenes, counts):
+                if count == 0:
+                    continue
+                frame = render_card(scene.get("text", ""), caption_style=caption_style).tobytes()
+                for _ in range(count):
+                    proc.stdin.write(frame)
+        except BrokenPipeError:
+            pass
+        finally:
+            proc.stdin.close()
+        returncode = proc.wait()
+        
+        if timer:
+            timer.cancel()
+        if timed_out.is_set():
+            print(f"FFmpeg timed out after {timeout}s: {output_video_path}")
+            return False
+        if returncode != 0:
+            stderr_file.seek(0)
+            print(f"FFmpeg error: {stderr_file.read().decode(errors='replace')}")
+            return False
+    return True
+
+def segment_cache_path(key):
+    return os.path.join(WORKSPACE_DIR, "segments", key[:2], f"{key}.mp4")
+
+def segment_key(text, duration, caption_style, profile, hold=False):
+    """Cache key for an encoded scene: its text, duration, style and encoding profile."""
+    parts = [text, round(float(duration), 3), caption_style, profile, WIDTH, HEIGHT]
+    if hold:
+        parts.append("hold")
+    payload = json.dumps(parts, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def encode_segment(text, duration, caption_style, profile, threads=None, timeout=None, hold=False):
+    """
+    Returns the path of an independently decodable, video-only segment showing
+    one card for `duration` seconds, encoding it only if it isn't cached yet.
+    Hold segments are encoded without B-frames so the final mux can cut them
+    at any frame.
+    """
+    key = segment_key(text, duration, caption_style, profile, hold)
+    path = segment_cache_path(key)
+    if os.path.exists(path):
+        # Keep shared segments (e.g. CTAs) clear of retention
+        os.utime(path)
+        return path
+    
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Unique temp name: concurrent render jobs may encode the same segment
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    frames = max(1, round(float(duration) * profile["fps"]))
+    cmd = [
+        "ffmpeg",
+        "-y", # Overwrite
+        "-f", "rawvideo",
+        "-pix_fmt", "rgb24",
+        "-s", f"{WIDTH}x{HEIGHT}",
+        "-r", str(profile["fps"]),
+        "-i", "-",
+        # A single card frame, repeated for the whole scene
+        "-vf", f"loop=loop={frames - 1}:size=1:start=0",
+        *build_video_args(profile, threads),
+        *(["-bf", "0"] if hold else []),
+        "-an",
+        # Same timescale everywhere so segments stream-copy cleanly
+        "-video_track_timescale", "90000",
+        "-f", "mp4",
+        tmp_path
+    ]
+    frame = render_card(text, caption_style=caption_style).tobytes()
+    try:
+        subprocess.run(cmd, input=frame, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=timeout)
+        os.replace(tmp_path, path)
+        return path
+    except subprocess.CalledProcessError as e:
+        print(f"FFmpeg error: {e.stderr.decode(errors='replace')}")
+        return None
+    except subprocess.TimeoutExpired:
+        print(f"FFmpeg timed out after {timeout}s encoding segment {key[:12]}")
+        return None
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def render_segments(scenes, audio_path, output_video_path, caption_style, profile, threads=None, timeout=None):
+    """
+    Builds the video from cached per-scene segments joined by stream copy, so
+    only new or changed scenes are encoded; the audio is muxed in the same pass.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    def remaining():
+        return max(1.0, deadline - time.monotonic()) if deadline else None
+    
+    fps = profile["fps"]
+    parts = [(scene.get("text", ""), float(scene.get("duration", 3.0))) for scene in scenes]
+    segment_paths = []
+    for text, duration in parts:
+        path = encode_segment(text, duration, caption_style, profile, threads, remaining())
+        if not path:
+            return False
+        segment_paths.append(path)
+    
+    # Hold the last card until the narration ends: repeat one fixed-length (and
+    # so cacheable) hold segment, then cut the video at the exact frame count
+    encoded_frames = sum(max(1, round(duration * fps)) for _, duration in parts)
+    audio_frames = math.ceil(get_audio_duration(audio_path) * fps)
+    total_frames = audio_frames or encoded_frames
+    hold_frames = total_frames - encoded_frames
+    if parts and hold_frames > 0:
+        path = encode_segment(parts[-1][0], RENDER_HOLD_SECONDS, caption_style, profile, threads, remaining(), hold=True)
+        if not path:
+            return False
+        segment_frames = max(1, round(RENDER_HOLD_SECONDS * fps))
+        segment_paths += [path] * math.ceil(hold_frames / segment_frames)
+    
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        for path in segment_paths:
+            f.write(f"file '{os.path.abspath(path)}'\n")
+        concat_list_path = f.name
+    
+    cmd = [
+        "ffmpeg",
+        "-y", # Overwrite
+        "-f", "concat",
+        "-safe", "0",
+        "-i", concat_list_path,
+        "-i", audio_path,
+        "-map", "0:v",
+        "-map", "1:a",
+        "-c:v", "copy",
+        # Ends the video on the first frame past the narration; -shortest would drop it
+        "-frames:v", str(total_frames),
+        "-c:a", "aac",
+        "-b:a", profile["audio_bitrate"],
+        output_video_path
+    ]
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=remaining())
+        return True
+    except subprocess.CalledProcessError as e:
+        print(f"FFmpeg error: {e.stderr.decode(errors='replace')}")
+        return False
+    except subprocess.TimeoutExpired:
+        print(f"FFmpeg timed out after {timeout}s: {output_video_path}")
+        return False
+    finally:
+        os.remove(concat_list_path)
+
+def render_job(post_id, threads=None, timeout=None):
+    """Renders one video and returns (post_id, output_path or None, seconds)."""
+    start = time.monotonic()
+    try:
+        path = generate_video(post_id, threads=threads, timeout=timeout)
+    except Exception as e:
+        print(f"Error rendering {post_id}: {e}")
+        path = None
+    return post_id, path, time.monotonic() - start
+
+def print_render_summary(timings):
+    """Prints per-video encode times from [(post_id, path, seconds), ...]."""
+    if not timings:
+        return
+    done = [t for t in timings if t[1]]
+    total = sum(t[2] for t in timings)
+    print(f"Render summary: {len(done)} of {len(timings)} videos, {total:.1f}s encode time, "
+          f"mean {total / len(timings):.1f}s, max {max(t[2] for t in timings):.1f}s")
+    for post_id, path, seconds in sorted(timings, key=lambda t: -t[2]):
+        print(f"  {post_id}: {seconds:.1f}s{'' if path else ' (failed)'}")
 
 def run_render():
     scripts_dir = os.path.join(WORKSPACE_DIR, "scripts")
@@ -118,12 +500,55 @@ def run_render():
         print("No scripts directory found.")
         return
 
+    output_dir = os.path.join(WORKSPACE_DIR, "output")
     files = [f for f in os.listdir(scripts_dir) if f.endswith(".json")]
-    print(f"Rendering {len(files)} videos...")
     
+    # A video depends on both its script and its narration
+    inputs = {}
     for filename in files:
         post_id = filename.replace(".json", "")
-        generate_video(post_id)
+        audio_path = os.path.join(output_dir, f"{post_id}.wav")
+        if os.path.exists(audio_path):
+            inputs[post_id] = hash_files(os.path.join(scripts_dir, filename), audio_path)
+    pending = get_pending("render", inputs)
+    
+    jobs = max(1, min(RENDER_JOBS, len(pending)))
+    if profiling.enabled("render"):
+        # In-process when profiled: spawned workers are outside cProfile and tracemalloc
+        jobs = 1
+    # Split the cores between concurrent encoders to avoid oversubscription
+    threads = max(1, (os.cpu_count() or 1) // jobs) if jobs > 1 else None
+    print(f"Rendering {len(pending)} of {len(files)} videos ({jobs} jobs, {threads or 'default'} threads each)...")
+    
+    timings = []
+    def record(result):
+        timings.append(result)
+        post_id, path, seconds = result
+        metrics.observe("ffmpeg_encode_seconds", seconds, backend=RENDER_BACKEND)
+        if path:
+            mark_done("render", post_id, inputs[post_id])
+        else:
+            metrics.inc("items_total", stage="render", outcome="failed")
+    
+    if jobs == 1:
+        for post_id in pending:
+            with profiling.span("render", post_id=post_id):
+                record(render_job(post_id, threads, RENDER_TIMEOUT))
+    else:
+        # Spawned, not forked: the metrics flusher and Gemini threads may hold locks at fork time
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(render_job, post_id, threads, RENDER_TIMEOUT): post_id for post_id in pending}
+            for future in as_completed(futures):
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # e.g. BrokenProcessPool when a worker dies; the other posts still count
+                    print(f"Error rendering {futures[future]}: {e}")
+                    result = (futures[future], None, 0.0)
+                with profiling.span("render", post_id=result[0], encode_seconds=result[2]):
+                    record(result)
+    
+    print_render_summary(timings)
 
 if __name__ == "__main__":
     run_render()
@@ -1,6 +1,8 @@
 import os
 import time
 import logging
+from datetime import datetime, timedelta
+from app.db import db_session
 
 WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
 
@@ -11,7 +13,7 @@ def cleanup_workspace(max_age_hours=168):
     """
     logging.info(f"Starting workspace cleanup (max age: {max_age_hours} hours)...")
     
-    subdirs = ["raw", "canonical", "scripts", "frames", "output"]
+    subdirs = ["raw", "canonical", "scripts", "frames", "output", "tts_cache", "segments", "profiles"]
     now = time.time()
     cutoff = now - (max_age_hours * 3600)
     
@@ -46,9 +48,18 @@ def cleanup_workspace(max_age_hours=168):
 
     logging.info(f"Cleanup complete. Deleted {deleted_count} files.")
 
+def prune_jobs(max_age_hours=168):
+    """Deletes done and failed job queue rows untouched for max_age_hours."""
+    cutoff = datetime.now() - timedelta(hours=max_age_hours)
+    with db_session() as conn:
+        deleted = conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (cutoff,)).rowcount
+    logging.info(f"Pruned {deleted} finished jobs.")
+    return deleted
+
 def run_retention():
     # Default to 7 days
     cleanup_workspace(max_age_hours=168)
+    prune_jobs(max_age_hours=168)
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -1,6 +1,16 @@
+import os
 import math
 import time
-from app.db import get_db_connection
+import numpy as np
+from datetime import datetime
+from app.db import get_db_connection, work_id
+
+# Rows scored and written back per round trip
+SCORE_CHUNK_SIZE = int(os.getenv("SCORE_CHUNK_SIZE", "50000"))
+# Posts handed to the expensive stages per run (0 disables selection)
+SELECT_TOP_K = int(os.getenv("SELECT_TOP_K", "30"))
+# Most posts any one subreddit may take of the selection (0 = no cap)
+SELECT_PER_SUBREDDIT = int(os.getenv("SELECT_PER_SUBREDDIT", "10"))
 
 def compute_score(upvotes, comments, created_utc, subreddit_weight=1.0):
     """
@@ -23,68 +33,111 @@ def compute_score(upvotes, comments, created_utc, subreddit_weight=1.0):
     score = ((0.65 * s) + (0.25 * c) + (0.4 * v) + title_boost) * decay * subreddit_weight
     return score, age_hours
 
-def run_scoring():
-    """Updates scores for all candidates."""
+def compute_scores(upvotes, comments, created_utc, now=None, subreddit_weight=1.0):
+    """
+    Array version of compute_score: scores every candidate in one pass.
+    Missing upvotes/comments count as zero. Returns (scores, age_hours) arrays.
+    """
+    now = time.time() if now is None else now
+    upvotes = np.nan_to_num(np.asarray(upvotes, dtype=np.float64))
+    comments = np.nan_to_num(np.asarray(comments, dtype=np.float64))
+    age_hours = (now - np.asarray(created_utc, dtype=np.float64)) / 3600.0
+
+    s = np.log1p(np.maximum(0, upvotes))
+    c = np.log1p(np.maximum(0, comments))
+    v = comments / (age_hours + 1)
+    decay = np.exp(-age_hours / 48)
+
+    title_boost = 0.4
+
+    scores = ((0.65 * s) + (0.25 * c) + (0.4 * v) + title_boost) * decay * subreddit_weight
+    return scores, age_hours
+
+def run_scoring(chunk_size=SCORE_CHUNK_SIZE):
+    """
+    Updates scores and ages for all candidates. The table is streamed in rowid
+    chunks so memory stays bounded, and all updates commit in one transaction.
+    """
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    # Plain tuples convert straight into a NumPy array
+    cursor.row_factory = None
+
+    now = time.time()
+    last_rowid = 0
+    total = 0
+    print("Scoring candidates...")
+
+    while True:
+        cursor.execute("""
+            SELECT rowid, upvotes, comments, created_utc, age_hours FROM candidates
+            WHERE rowid > ? ORDER BY rowid LIMIT ?
+        """, (last_rowid, chunk_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+
+        data = np.array(rows, dtype=np.float64)
+        rowids = data[:, 0].astype(np.int64)
+        created_utc = data[:, 3]
+        # Rows without created_utc fall back to their fetch-time age
+        missing = np.isnan(created_utc)
+        created_utc[missing] = now - np.nan_to_num(data[missing, 4]) * 3600
+
+        scores, age_hours = compute_scores(data[:, 1], data[:, 2], created_utc, now=now)
+        cursor.executemany(
+            "UPDATE candidates SET score = ?, age_hours = ? WHERE rowid = ?",
+            zip(scores.tolist(), age_hours.tolist(), rowids.tolist())
+        )
+
+        total += len(rows)
+        last_rowid = int(rowids[-1])
+
+    conn.commit()
+    conn.close()
+    print(f"Scoring complete: {total} candidates.")
+
+def run_selection(top_k=SELECT_TOP_K, per_subreddit=SELECT_PER_SUBREDDIT):
+    """
+    Picks the top_k highest-scoring unfinished candidates, at most per_subreddit
+    from any one subreddit, and records them in rank order for downstream stages.
+    Walks the score index best-first and stops once the selection is full.
+    """
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    # Get all candidates
-    cursor.execute("SELECT post_id, upvotes, comments, age_hours FROM candidates")
-    candidates = cursor.fetchall()
-    
-    print(f"Scoring {len(candidates)} candidates...")
+    # Flagged or rendered posts don't need a slot
+    cursor.execute("SELECT post_id FROM flagged UNION SELECT post_id FROM stage_state WHERE stage = 'render'")
+    finished = {row[0] for row in cursor.fetchall()}
     
-    for row in candidates:
-        # We need created_utc to re-calculate age accurately, but for now we can approximate
-        # or just use the stored age_hours if we assume it's static from harvest (which is slightly wrong but okay for MVP)
-        # Better: fetch created_utc from raw file or store it in DB. 
-        # The prompt spec didn't have created_utc in DB, but compute_score needs it.
-        # Let's reverse engineer created_utc from age_hours for now, or just use age_hours directly if we modify compute_score.
-        # Actually, let's just use the current time and stored age to approximate "original creation time" 
-        # created_utc approx = now - (age_hours * 3600)
-        # But wait, age_hours in DB is "age at fetch time". 
-        # The compute_score function takes created_utc.
-        # Let's assume we want to re-score based on CURRENT time.
-        
-        # To do this right, we should probably have stored created_utc in the DB.
-        # But I must follow the schema. 
-        # Let's just use the logic: age_hours = (time.time() - created_utc) / 3600.0
-        # So created_utc = time.time() - (age_hours * 3600) (at fetch time)
-        # This is getting complicated. Let's look at the schema again.
-        # Schema: candidates table has `age_hours`.
-        # The `harvest.py` I wrote calculates `age_hours` at fetch time.
-        
-        # Let's just re-calculate score using the values we have.
-        # We will treat the stored `age_hours` as the age.
-        
-        # Wait, the `compute_score` function provided in the prompt takes `created_utc`.
-        # I should probably modify `compute_score` to take `age_hours` directly if I don't have `created_utc`.
-        # OR I should have added `created_utc` to the DB.
-        # The prompt schema didn't have `created_utc`.
-        # I will adapt `compute_score` to take `age_hours` or calculate `created_utc` from the stored `age_hours` (which is static).
-        # Actually, `age_hours` in DB is static (calculated at fetch).
-        # So the score will be static unless we update `age_hours`.
-        # For MVP, let's just calculate it once during harvest?
-        # No, the prompt says "Implement score.py algorithm and store results".
-        # This implies a separate step.
-        
-        # Let's assume for now we use the static age from fetch.
-        # I will calculate a "fake" created_utc to satisfy the function signature.
-        
-        current_age = row['age_hours'] # This is age at fetch.
-        # If we want dynamic scoring (decay over time), we need `fetched_at` to adjust `age_hours`.
-        # But let's stick to the prompt's function.
-        
-        # Let's just pass a created_utc that results in the stored age_hours.
-        created_utc = time.time() - (row['age_hours'] * 3600)
-        
-        score, _ = compute_score(row['upvotes'], row['comments'], created_utc)
-        
-        cursor.execute("UPDATE candidates SET score = ? WHERE post_id = ?", (score, row['post_id']))
+    selected = []
+    per_sub_counts = {}
+    if top_k > 0:
+        cursor.execute("SELECT subreddit, raw_path FROM candidates WHERE score IS NOT NULL ORDER BY score DESC")
+        for row in cursor:
+            post_id = work_id(row['raw_path'])
+            if not post_id or post_id in finished:
+                continue
+            if per_subreddit and per_sub_counts.get(row['subreddit'], 0) >= per_subreddit:
+                continue
+            per_sub_counts[row['subreddit']] = per_sub_counts.get(row['subreddit'], 0) + 1
+            selected.append(post_id)
+            if len(selected) >= top_k:
+                break
     
+    now = datetime.now()
+    cursor.execute("DELETE FROM selection")
+    cursor.executemany(
+        "INSERT INTO selection (post_id, rank, selected_at) VALUES (?, ?, ?)",
+        [(post_id, rank, now) for rank, post_id in enumerate(selected)]
+    )
+    cursor.execute(
+        "INSERT OR REPLACE INTO selection_runs (id, top_k, selected, ran_at) VALUES (1, ?, ?, ?)",
+        (top_k, len(selected), now)
+    )
     conn.commit()
     conn.close()
-    print("Scoring complete.")
+    print(f"Selected {len(selected)} candidates across {len(per_sub_counts)} subreddits.")
 
 if __name__ == "__main__":
     run_scoring()
@@ -2,7 +2,8 @@ import os
 import json
 from datetime import datetime
 from app.genai_client import client
-from app.db import get_db_connection
+from app import metrics, profiling
+from app.db import get_db_connection, hash_files, get_pending, mark_done
 
 WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
 
@@ -24,38 +25,49 @@ Output JSON only with keys:
 If user left creative options blank, decide them automatically based on content. Keep total durations ≈ length_seconds.
 """
 
-def generate_script(post_id):
+def build_script_prompt(post_id):
+    """Returns the script prompt for a post, or None if it has no canonical file."""
     canonical_path = os.path.join(WORKSPACE_DIR, "canonical", f"{post_id}.json")
     if not os.path.exists(canonical_path):
         print(f"Canonical file not found: {canonical_path}")
-        return
+        return None
 
     with open(canonical_path, "r") as f:
         data = json.load(f)
 
     # Construct prompt
     comments_text = "\n".join([f"- {c['body']}" for c in data['comments'][:5]])
-    prompt = SCRIPT_PROMPT.format(
+    return SCRIPT_PROMPT.format(
         title=data['title'],
         op=data['op'],
         comments=comments_text
     )
+
+def validate_script(script_json):
+    """Raises ValueError if the generated script is missing required keys."""
+    # Validate schema (basic check)
+    required_keys = ["tone", "pacing", "cta", "scenes"]
+    if not all(key in script_json for key in required_keys):
+        raise ValueError("Missing required keys in script JSON")
+
+def generate_script(post_id):
+    prompt = build_script_prompt(post_id)
+    if not prompt:
+        return
     
     try:
         print(f"Generating script for {post_id}...")
-        script_json = client.generate_json(prompt)
-        
-        # Validate schema (basic check)
-        required_keys = ["tone", "pacing", "cta", "scenes"]
-        if not all(key in script_json for key in required_keys):
-            raise ValueError("Missing required keys in script JSON")
+        script_json = client.generate_json(prompt, stage="script", validate=validate_script)
+        validate_script(script_json)
             
         # Save script
         save_script(post_id, script_json)
         print(f"Script generated for {post_id}")
+        return True
         
     except Exception as e:
         print(f"Error generating script for {post_id}: {e}")
+        return False
 
 def save_script(post_id, script_data):
     scripts_dir = os.path.join(WORKSPACE_DIR, "scripts")
@@ -91,12 +103,34 @@ def run_script_gen():
         return
 
     files = [f for f in os.listdir(canonical_dir) if f.endswith(".json")]
-    print(f"Generating scripts for {len(files)} files...")
+    # Only regenerate when the canonical content changed since the last script
+    inputs = {f.replace(".json", ""): hash_files(os.path.join(canonical_dir, f)) for f in files}
+    pending = get_pending("script", inputs)
+    print(f"Generating scripts for {len(pending)} of {len(files)} files...")
+    
+    prompts = {}
+    for post_id in pending:
+        prompt = build_script_prompt(post_id)
+        if prompt:
+            prompts[post_id] = prompt
+    
+    # Dispatch all prompts concurrently across the configured keys
+    results = client.generate_json_many(list(prompts.values()), stage="script", validate=validate_script)
+    
+    for post_id, script_json in zip(prompts, results):
+        try:
+            with profiling.span("script", post_id=post_id):
+                if isinstance(script_json, Exception):
+                    raise script_json
+                validate_script(script_json)
+                save_script(post_id, script_json)
+                mark_done("script", post_id, inputs[post_id])
+            print(f"Script generated for {post_id}")
+        except Exception as e:
+            print(f"Error generating script for {post_id}: {e}")
+            metrics.inc("items_total", stage="script", outcome="failed")
     
-    for filename in files:
-        post_id = filename.replace(".json", "")
-        # Check if already generated? (Optional, skipping for now to allow regeneration)
-        generate_script(post_id)
+    print(f"Script gen {client.cache.format_stats('script')}")
 
 if __name__ == "__main__":
     run_script_gen()
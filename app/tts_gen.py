@@ -1,53 +1,126 @@
 import os
 import json
 import wave
+import hashlib
+import unicodedata
 from app.genai_client import client
+from app import metrics, profiling
+from app.db import hash_files, get_pending, mark_done
 
 WORKSPACE_DIR = os.getenv("WORKSPACE_DIR", "workspace")
+# Silence inserted between separately synthesized scenes
+TTS_SCENE_GAP_MS = int(os.getenv("TTS_SCENE_GAP_MS", "150"))
 
-def generate_tts(post_id):
+# Gemini returns raw PCM (audio/L16;rate=24000)
+SAMPLE_RATE = 24000
+SAMPLE_WIDTH = 2
+
+def normalize_text(text):
+    """Normalizes scene text so trivially different spellings share a cache entry."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def audio_cache_key(text):
+    """Cache key for a line of narration: TTS model + normalized text."""
+    payload = f"{client.tts_model_name}\n{normalize_text(text)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def audio_cache_path(key):
+    return os.path.join(WORKSPACE_DIR, "tts_cache", key[:2], f"{key}.pcm")
+
+def get_scene_texts(post_id):
+    """Returns the non-empty scene texts of a post's script, or None if there are none."""
     scripts_dir = os.path.join(WORKSPACE_DIR, "scripts")
     script_path = os.path.join(scripts_dir, f"{post_id}.json")
     
     if not os.path.exists(script_path):
         print(f"Script file not found: {script_path}")
-        return
+        return None
 
     with open(script_path, "r") as f:
         data = json.load(f)
 
     # Extract text from scenes
-    narration_text = ""
-    for scene in data.get("scenes", []):
-        if "text" in scene:
-            narration_text += f"{scene['text']} "
-    
-    narration_text = narration_text.strip()
-    if not narration_text:
+    texts = [scene["text"] for scene in data.get("scenes", []) if normalize_text(scene.get("text", ""))]
+    if not texts:
         print(f"No text found in script for {post_id}")
+        return None
+    return texts
+
+def synthesize_scenes(texts):
+    """
+    Returns {cache_key: pcm_bytes} for the given scene texts. Cached lines are
+    read from disk; the rest are synthesized in parallel and stored. Lines that
+    fail to synthesize are missing from the result.
+    """
+    pcm_by_key = {}
+    missing = {}
+    for text in texts:
+        key = audio_cache_key(text)
+        if key in pcm_by_key or key in missing:
+            continue
+        path = audio_cache_path(key)
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                pcm_by_key[key] = f.read()
+            # Keep frequently reused lines (e.g. CTAs) clear of retention
+            os.utime(path)
+        else:
+            missing[key] = normalize_text(text)
+
+    if missing:
+        print(f"Synthesizing {len(missing)} scenes ({len(pcm_by_key)} cached)...")
+        results = client.generate_audio_many(list(missing.values()))
+        for key, audio_bytes in zip(missing, results):
+            if isinstance(audio_bytes, Exception) or not audio_bytes:
+                print(f"Failed to synthesize scene: {missing[key][:50]}")
+                continue
+            path = audio_cache_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(audio_bytes)
+            os.replace(tmp_path, path)
+            pcm_by_key[key] = audio_bytes
+
+    return pcm_by_key
+
+def save_audio(post_id, audio_bytes):
+    """Writes raw PCM to output/<post_id>.wav."""
+    output_dir = os.path.join(WORKSPACE_DIR, "output")
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"{post_id}.wav")
+    
+    # Write WAV file
+    with wave.open(output_path, "wb") as wav_file:
+        wav_file.setnchannels(1) # Mono
+        wav_file.setsampwidth(SAMPLE_WIDTH) # 16-bit = 2 bytes
+        wav_file.setframerate(SAMPLE_RATE)
+        wav_file.writeframes(audio_bytes)
+        
+    print(f"Audio saved to {output_path}")
+    return output_path
+
+def assemble_audio(post_id, texts, pcm_by_key):
+    """Concatenates per-scene PCM with short gaps and saves the narration."""
+    parts = []
+    for text in texts:
+        pcm = pcm_by_key.get(audio_cache_key(text))
+        if pcm is None:
+            print(f"Failed to generate audio for {post_id}")
+            return None
+        parts.append(pcm)
+    
+    gap = b"\0" * (SAMPLE_RATE * TTS_SCENE_GAP_MS // 1000 * SAMPLE_WIDTH)
+    return save_audio(post_id, gap.join(parts))
+
+def generate_tts(post_id):
+    texts = get_scene_texts(post_id)
+    if not texts:
         return
 
     try:
         print(f"Generating audio for {post_id}...")
-        audio_bytes = client.generate_audio(narration_text)
-        
-        if audio_bytes:
-            output_dir = os.path.join(WORKSPACE_DIR, "output")
-            os.makedirs(output_dir, exist_ok=True)
-            output_path = os.path.join(output_dir, f"{post_id}.wav")
-            
-            # Write WAV file
-            # Gemini returns raw PCM (audio/L16;rate=24000)
-            with wave.open(output_path, "wb") as wav_file:
-                wav_file.setnchannels(1) # Mono
-                wav_file.setsampwidth(2) # 16-bit = 2 bytes
-                wav_file.setframerate(24000)
-                wav_file.writeframes(audio_bytes)
-                
-            print(f"Audio saved to {output_path}")
-        else:
-            print(f"Failed to generate audio for {post_id}")
-            
+        return assemble_audio(post_id, texts, synthesize_scenes(texts))
     except Exception as e:
         print(f"Error generating TTS for {post_id}: {e}")
 
@@ -58,11 +131,27 @@ def run_tts():
         return
 
     files = [f for f in os.listdir(scripts_dir) if f.endswith(".json")]
-    print(f"Generating TTS for {len(files)} files...")
+    inputs = {f.replace(".json", ""): hash_files(os.path.join(scripts_dir, f)) for f in files}
+    pending = get_pending("tts", inputs)
+    print(f"Generating TTS for {len(pending)} of {len(files)} files...")
+    
+    scene_texts = {}
+    for post_id in pending:
+        texts = get_scene_texts(post_id)
+        if texts:
+            scene_texts[post_id] = texts
+    
+    # Synthesize every distinct scene across all posts at once
+    pcm_by_key = synthesize_scenes([text for texts in scene_texts.values() for text in texts])
     
-    for filename in files:
-        post_id = filename.replace(".json", "")
-        generate_tts(post_id)
+    for post_id, texts in scene_texts.items():
+        try:
+            with profiling.span("tts", post_id=post_id, scenes=len(texts)):
+                if assemble_audio(post_id, texts, pcm_by_key):
+                    mark_done("tts", post_id, inputs[post_id])
+        except Exception as e:
+            print(f"Error generating TTS for {post_id}: {e}")
+            metrics.inc("items_total", stage="tts", outcome="failed")
 
 if __name__ == "__main__":
     run_tts()
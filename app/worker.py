@@ -1,52 +1,86 @@
+import os
 import time
 import schedule
 import logging
-from app.harvest import harvest
-from app.score import run_scoring
+from app.harvest import harvest, refresh_candidates
+from app.score import run_scoring, run_selection
 from app.extract import run_extraction
 from app.moderate import run_moderation
+from app.fused_gen import FUSED_GEN, run_fused_gen
 from app.script_gen import run_script_gen
 from app.tts_gen import run_tts
 from app.render import run_render
 from app.retention import run_retention
+from app.pipeline import run_streaming
+from app.jobs import enqueue_selected, run_job_worker
+from app.genai_client import client
+from app.db import init_db
+from app import metrics, profiling
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
+# "batch" runs steps 3-7 one after another; "stream" moves each post through them as soon as it is
+# ready (first video sooner, but one LLM call per post: no batched moderation or cross-post TTS dedup);
+# "queue" hands steps 4-7 to the shared job queue so extra job workers (app/jobs.py) can help
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "batch")
+
+def run_step(description, stage, fn, *args, **kwargs):
+    """Logs and runs one pipeline step, recording its duration (and profile, if enabled)."""
+    logging.info(description)
+    with metrics.timed("stage_seconds", stage=stage), profiling.span(stage), profiling.stage_profile(stage):
+        return fn(*args, **kwargs)
+
 def run_pipeline():
-    logging.info("Starting pipeline run...")
+    run_id = profiling.start_run()
+    logging.info(f"Starting pipeline run {run_id}...")
     
     try:
-        logging.info("Step 1: Harvest")
-        harvest()
-        
-        logging.info("Step 2: Score")
-        run_scoring()
+        run_step("Step 1: Harvest", "harvest", harvest)
         
-        logging.info("Step 3: Extract")
-        run_extraction()
+        run_step("Step 1b: Refresh", "refresh", refresh_candidates)
         
-        logging.info("Step 4: Moderate")
-        run_moderation()
+        run_step("Step 2: Score", "score", run_scoring)
         
-        logging.info("Step 5: Script Gen")
-        run_script_gen()
+        run_step("Step 2b: Select", "select", run_selection)
         
-        logging.info("Step 6: TTS")
-        run_tts()
+        if PIPELINE_MODE == "stream":
+            run_step("Steps 3-7: Streaming Extract -> Moderate -> Script Gen -> TTS -> Render", "stream", run_streaming)
+        elif PIPELINE_MODE == "queue":
+            run_step("Step 3: Extract", "extract", run_extraction)
+            
+            run_step("Steps 4-7: Queue jobs", "enqueue", enqueue_selected)
+            run_step("Steps 4-7: Work through jobs", "jobs", run_job_worker, exit_when_idle=True)
+        else:
+            run_step("Step 3: Extract", "extract", run_extraction)
+            
+            if FUSED_GEN:
+                # Moderation and script gen below then only pick up leftovers
+                run_step("Step 4a: Fused Moderate + Script Gen", "fused", run_fused_gen)
+            
+            run_step("Step 4: Moderate", "moderate", run_moderation)
+            
+            run_step("Step 5: Script Gen", "script", run_script_gen)
+            
+            run_step("Step 6: TTS", "tts", run_tts)
+            
+            run_step("Step 7: Render", "render", run_render)
         
-        logging.info("Step 7: Render")
-        run_render()
-        
-        logging.info("Step 8: Retention")
-        run_retention()
+        run_step("Step 8: Retention", "retention", run_retention)
         
         logging.info("Pipeline run complete.")
+        for label, stats in client.key_stats().items():
+            logging.info(f"Gemini {label}: {stats['ok']} ok, {stats['quota_errors']} quota, {stats['errors']} errors, "
+                         f"cooldown {stats['cooldown_remaining']:.0f}s")
         
     except Exception as e:
         logging.error(f"Pipeline failed: {e}")
+    
+    metrics.flush()
 
 def start_worker():
     logging.info("Worker started. Scheduling pipeline every 1 hour.")
+    init_db()
+    metrics.start_flusher()
     # Run once immediately
     run_pipeline()
     
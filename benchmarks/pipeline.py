@@ -0,0 +1,269 @@
+"""
+Drives the whole worker pipeline (run_pipeline) over a synthetic corpus, with
+local stand-ins for praw.Reddit and the Gemini models, and reports per-step
+wall time, calls made and videos per hour. Needs ffmpeg on PATH; no network
+or API keys.
+
+    python -m benchmarks.pipeline [--posts 12] [--mode batch|stream|queue]
+        [--latency 0.2] [--error-rate 0.02] [--quota-rate 0.02] [--flag-rate 0.1]
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import threading
+from types import SimpleNamespace
+from unittest.mock import patch
+from google.api_core import exceptions
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SUBREDDITS = ["AskReddit", "Showerthoughts", "LifeProTips"]
+TITLES = [
+    "What's a small habit that changed your life?",
+    "What is something everyone should learn to cook?",
+    "What's the best advice you ever ignored?",
+    "Which everyday item is secretly brilliant?",
+    "What skill took you embarrassingly long to learn?",
+    "What is a hill you will absolutely die on?",
+]
+COMMENTS = [
+    "Making my bed every morning. It sounds silly but it sets the tone.",
+    "Drinking a glass of water before coffee.",
+    "Putting my phone in another room at night.",
+    "Walking for ten minutes after every meal.",
+    "Writing down three things I need to do tomorrow.",
+]
+
+class Counter:
+    """Thread-safe call counts by name."""
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+class FakeComments:
+    def __init__(self, comments):
+        self.comments = comments
+
+    def replace_more(self, limit=None):
+        pass
+
+    def list(self):
+        return self.comments
+
+def make_corpus(posts, seed):
+    """Returns {subreddit: [submission, ...]} with deterministic content."""
+    rng = random.Random(seed)
+    now = time.time()
+    corpus = {name: [] for name in SUBREDDITS}
+    for i in range(posts):
+        subreddit = SUBREDDITS[i % len(SUBREDDITS)]
+        corpus[subreddit].append(SimpleNamespace(
+            id=f"b{i:05d}",
+            title=f"{rng.choice(TITLES)} (#{i})",
+            author=f"user{rng.randint(1, 999)}",
+            subreddit=subreddit,
+            score=rng.randint(10, 50000),
+            num_comments=rng.randint(5, 3000),
+            created_utc=now - rng.uniform(0, 24) * 3600,
+            url=f"https://reddit.example/{i}",
+            selftext="",
+            permalink=f"/r/{subreddit}/comments/b{i:05d}",
+            comments=FakeComments([
+                SimpleNamespace(body=rng.choice(COMMENTS), author=f"c{j}", score=rng.randint(1, 500))
+                for j in range(5)
+            ]),
+        ))
+    return corpus
+
+class FakeReddit:
+    """praw.Reddit stand-in serving a fixed corpus with a per-request delay."""
+    def __init__(self, corpus, latency, calls):
+        self.corpus = corpus
+        self.by_id = {post.id: post for posts in corpus.values() for post in posts}
+        self.latency = latency
+        self.calls = calls
+        self.auth = SimpleNamespace(limits={"remaining": 1000, "used": 0})
+
+    def _request(self, name):
+        self.calls.add(name)
+        time.sleep(self.latency)
+
+    def subreddit(self, name):
+        posts = self.corpus.get(name, [])
+        reddit = self
+
+        class Listing:
+            def hot(self, limit=10):
+                reddit._request("reddit.hot")
+                return posts[:limit]
+
+            def top(self, time_filter="day", limit=10):
+                # Overlaps hot, as the real listings do
+                reddit._request("reddit.top")
+                return sorted(posts, key=lambda p: -p.score)[:limit]
+
+        return Listing()
+
+    def submission(self, id):
+        self._request("reddit.comments")
+        return self.by_id[id]
+
+    def info(self, fullnames):
+        self._request("reddit.info")
+        return [self.by_id[name[3:]] for name in fullnames if name[3:] in self.by_id]
+
+class FakeGemini:
+    """
+    Deterministic Gemini stand-in. Answers moderation, batch moderation, fused,
+    script and TTS requests by prompt shape, after `latency` seconds, and
+    injects ResourceExhausted and generic errors at the given rates.
+    """
+    def __init__(self, latency, error_rate, quota_rate, flag_rate, scenes, seed):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_rate = quota_rate
+        self.flag_rate = flag_rate
+        self.scenes = scenes
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+
+    def model(self, model_name):
+        fake = self
+        # _client mirrors the real GenerativeModel, which GeminiClient binds per key
+        return SimpleNamespace(_client=None, generate_content=lambda prompt, generation_config=None: fake.respond(prompt, generation_config))
+
+    def flagged(self, text):
+        # Stable per post, independent of call order
+        return random.Random(text).random() < self.flag_rate
+
+    def respond(self, prompt, generation_config):
+        is_audio = bool(generation_config and "response_modalities" in generation_config)
+        kind = "tts" if is_audio else self.kind(prompt)
+        self.calls.add(kind)
+        time.sleep(self.latency)
+        with self.lock:
+            roll = self.rng.random()
+        if roll < self.quota_rate:
+            self.calls.add("injected quota")
+            raise exceptions.ResourceExhausted("injected quota error")
+        if roll < self.quota_rate + self.error_rate:
+            self.calls.add("injected error")
+            raise exceptions.ServiceUnavailable("injected error")
+
+        if is_audio:
+            text = prompt.split("\n\n", 1)[-1]
+            seconds = max(0.5, 0.3 * len(text.split()))
+            pcm = b"\0\0" * int(24000 * seconds)
+            return SimpleNamespace(parts=[SimpleNamespace(inline_data=SimpleNamespace(mime_type="audio/L16;rate=24000", data=pcm))])
+        return SimpleNamespace(text=json.dumps(self.answer(kind, prompt)))
+
+    def kind(self, prompt):
+        if "safety classifier and short-video copywriter" in prompt:
+            return "fused"
+        if "### Post " in prompt:
+            return "moderate-batch"
+        if "safety classifier" in prompt:
+            return "moderate"
+        return "script"
+
+    def script(self, title):
+        lines = [title] + COMMENTS[:self.scenes - 2] + ["Follow for more"]
+        return {
+            "tone": "funny", "pacing": "fast", "cta": "Follow for more", "caption_style": "bold-large",
+            "length_seconds": 2 * len(lines),
+            "scenes": [{"text": line, "start": 2.0 * i, "duration": 2.0, "visual": "card"} for i, line in enumerate(lines)],
+        }
+
+    def answer(self, kind, prompt):
+        if kind == "moderate-batch":
+            blocks = re.findall(r"### Post (\S+)\n(.*?)(?=### Post |\Z)", prompt, re.S)
+            return [{"post_id": post_id, "flag": self.flagged(body), "reasons": []} for post_id, body in blocks]
+        title = (re.search(r"Title: (.*)", prompt) or re.search(r"Input: (.*?), OP:", prompt)).group(1)
+        if kind == "moderate":
+            return {"flag": self.flagged(prompt), "reasons": ["injected flag"] if self.flagged(prompt) else []}
+        if kind == "fused":
+            flag = self.flagged(prompt)
+            return {"flag": flag, "reasons": [], "script": None if flag else self.script(title)}
+        return self.script(title)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the full pipeline offline.")
+    parser.add_argument("--posts", type=int, default=12)
+    parser.add_argument("--mode", default="batch", choices=["stream", "batch", "queue"])
+    parser.add_argument("--keys", type=int, default=2, help="fake Gemini keys")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per fake Gemini request")
+    parser.add_argument("--reddit-latency", type=float, default=0.05, help="seconds per fake Reddit request")
+    parser.add_argument("--error-rate", type=float, default=0.02)
+    parser.add_argument("--quota-rate", type=float, default=0.02)
+    parser.add_argument("--flag-rate", type=float, default=0.1)
+    parser.add_argument("--quota-cooldown", help="seconds a key rests after a quota error (GEMINI_QUOTA_COOLDOWN)")
+    parser.add_argument("--scenes", type=int, default=4)
+    parser.add_argument("--profile", default="draft", help="render profile")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workspace:
+        # App modules read their configuration at import time
+        os.environ.update({
+            "WORKSPACE_DIR": os.path.join(workspace, "ws"),
+            "DB_PATH": os.path.join(workspace, "app.db"),
+            "LLM_CACHE_PATH": os.path.join(workspace, "llm_cache.db"),
+            "GEMINI_API_KEYS": json.dumps([f"bench-key-{i}" for i in range(args.keys)]),
+            "GEMINI_RPM_PER_KEY": os.environ.get("GEMINI_RPM_PER_KEY", "100000"),
+            "PIPELINE_MODE": args.mode,
+            "SELECT_TOP_K": str(args.posts),
+            "SELECT_PER_SUBREDDIT": "0",
+            "RENDER_PROFILE": args.profile,
+        })
+        if args.quota_cooldown:
+            os.environ["GEMINI_QUOTA_COOLDOWN"] = args.quota_cooldown
+        from app import worker, harvest, metrics
+        from app.db import init_db
+
+        reddit_calls = Counter()
+        reddit = FakeReddit(make_corpus(args.posts, args.seed), args.reddit_latency, reddit_calls)
+        gemini = FakeGemini(args.latency, args.error_rate, args.quota_rate, args.flag_rate, args.scenes, args.seed)
+        per_subreddit = -(-args.posts // len(SUBREDDITS))
+
+        init_db()
+        with patch("app.harvest.get_reddit_client", return_value=reddit), \
+                patch("app.genai_client.genai.GenerativeModel", side_effect=gemini.model), \
+                patch("app.genai_client.glm.GenerativeServiceClient", return_value=None), \
+                patch("app.worker.harvest", lambda: harvest.harvest(SUBREDDITS, limit=per_subreddit)), \
+                patch("builtins.print"):
+            start = time.monotonic()
+            worker.run_pipeline()
+            elapsed = time.monotonic() - start
+
+        output_dir = os.path.join(workspace, "ws", "output")
+        videos = len([f for f in os.listdir(output_dir) if f.endswith(".mp4")]) if os.path.exists(output_dir) else 0
+        series = metrics.registry.snapshot()
+
+    print(f"Pipeline benchmark: {args.posts} posts, mode {args.mode}, {args.keys} keys, "
+          f"Gemini latency {args.latency}s, error rate {args.error_rate}, quota rate {args.quota_rate}")
+    print(f"{'step':<12} {'seconds':>8}")
+    for name, labels, kind, data in series:
+        if name == "stage_seconds":
+            print(f"{labels['stage']:<12} {data['sum']:>8.2f}")
+    busy = [(labels["stage"], data) for name, labels, kind, data in series if name == "stage_item_seconds"]
+    if busy:
+        print(f"{'stage':<12} {'posts':>8} {'busy s':>8}")
+        for stage, data in busy:
+            print(f"{stage:<12} {data['count']:>8} {data['sum']:>8.2f}")
+    print(f"{'total':<12} {elapsed:>8.2f}")
+    print("Reddit calls: " + ", ".join(f"{name} {count}" for name, count in sorted(reddit_calls.counts.items())))
+    print("Gemini calls: " + ", ".join(f"{name} {count}" for name, count in sorted(gemini.calls.counts.items())))
+    print(f"Videos: {videos} of {args.posts} posts, {videos / elapsed * 3600:.0f} videos/hour")
+
+if __name__ == "__main__":
+    main()
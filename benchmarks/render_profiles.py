@@ -0,0 +1,78 @@
+"""
+Encodes a reference script with every render profile and reports encode time
+and output size. Needs ffmpeg on PATH; no network or API keys.
+
+    python -m benchmarks.render_profiles [--backend pipe|concat|segments] [--scenes 8]
+"""
+import os
+import sys
+import json
+import math
+import time
+import wave
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import render
+
+REFERENCE_LINES = [
+    "What's a small habit that changed your life?",
+    "Making my bed every morning. It sounds silly but it sets the tone.",
+    "Drinking a glass of water before coffee.",
+    "Putting my phone in another room at night.",
+    "Walking for ten minutes after every meal.",
+    "Writing down three things I need to do tomorrow.",
+    "Saying no to plans I don't actually want.",
+    "Follow for more",
+]
+
+def write_reference(workspace, post_id, scene_count, scene_seconds=3.75):
+    """Writes a reference script and a matching tone WAV into workspace."""
+    os.makedirs(os.path.join(workspace, "scripts"), exist_ok=True)
+    os.makedirs(os.path.join(workspace, "output"), exist_ok=True)
+
+    scenes = [
+        {"text": REFERENCE_LINES[i % len(REFERENCE_LINES)], "start": i * scene_seconds, "duration": scene_seconds}
+        for i in range(scene_count)
+    ]
+    with open(os.path.join(workspace, "scripts", f"{post_id}.json"), "w") as f:
+        json.dump({"caption_style": "bold-large", "scenes": scenes}, f)
+
+    # Quiet 220 Hz tone so the AAC encoder has real signal to work on
+    rate = 24000
+    frames = bytearray()
+    for n in range(int(scene_count * scene_seconds * rate)):
+        sample = int(3000 * math.sin(2 * math.pi * 220 * n / rate))
+        frames += sample.to_bytes(2, "little", signed=True)
+    with wave.open(os.path.join(workspace, "output", f"{post_id}.wav"), "wb") as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(rate)
+        wav_file.writeframes(bytes(frames))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark render profiles on a reference script.")
+    parser.add_argument("--backend", default=render.RENDER_BACKEND, choices=["pipe", "concat", "segments"])
+    parser.add_argument("--scenes", type=int, default=8)
+    args = parser.parse_args()
+
+    render.RENDER_BACKEND = args.backend
+    with tempfile.TemporaryDirectory() as workspace:
+        render.WORKSPACE_DIR = workspace
+        write_reference(workspace, "reference", args.scenes)
+        output_path = os.path.join(workspace, "output", "reference.mp4")
+
+        print(f"{'profile':<10} {'seconds':>8} {'size KiB':>10}")
+        for name in render.RENDER_PROFILES:
+            start = time.monotonic()
+            result = render.generate_video("reference", profile=name)
+            elapsed = time.monotonic() - start
+            if not result:
+                print(f"{name:<10} {'failed':>8}")
+                continue
+            print(f"{name:<10} {elapsed:>8.2f} {os.path.getsize(output_path) / 1024:>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Times candidate scoring on synthetic tables: the per-row loop (one
+compute_score call and one UPDATE per candidate) against the vectorized,
+chunked run_scoring. No network or API keys.
+
+    python -m benchmarks.scoring [--sizes 10000 100000 1000000] [--skip-row-loop]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import db
+from app.score import compute_score, run_scoring
+
+def populate(size, seed=0):
+    """Fills the candidates table with `size` synthetic posts from the last two days."""
+    rng = random.Random(seed)
+    now = time.time()
+    conn = db.get_db_connection()
+    conn.executemany(
+        "INSERT INTO candidates (post_id, upvotes, comments, age_hours, created_utc) VALUES (?, ?, ?, ?, ?)",
+        (
+            (f"p{i}", rng.randint(0, 50000), rng.randint(0, 5000), age, now - age * 3600)
+            for i, age in ((i, rng.uniform(0, 48)) for i in range(size))
+        )
+    )
+    conn.commit()
+    conn.close()
+
+def row_loop_scoring():
+    """The per-row scoring path run_scoring replaced."""
+    conn = db.get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute("SELECT post_id, upvotes, comments, age_hours FROM candidates")
+    for row in cursor.fetchall():
+        created_utc = time.time() - (row['age_hours'] * 3600)
+        score, _ = compute_score(row['upvotes'], row['comments'], created_utc)
+        cursor.execute("UPDATE candidates SET score = ? WHERE post_id = ?", (score, row['post_id']))
+    conn.commit()
+    conn.close()
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--skip-row-loop", action="store_true", help="only time run_scoring")
+    args = parser.parse_args()
+
+    print(f"{'candidates':>10}  {'row loop':>9}  {'vectorized':>10}  {'speedup':>7}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as workspace, \
+                patch.object(db, "DB_PATH", os.path.join(workspace, "app.db")):
+            db.init_db()
+            populate(size)
+            # Keep scoring output out of the table
+            with patch("builtins.print"):
+                loop_seconds = None if args.skip_row_loop else timed(row_loop_scoring)
+                vector_seconds = timed(run_scoring)
+
+        if loop_seconds is None:
+            print(f"{size:>10}  {'-':>9}  {vector_seconds:>9.2f}s  {'-':>7}")
+        else:
+            print(f"{size:>10}  {loop_seconds:>8.2f}s  {vector_seconds:>9.2f}s  {loop_seconds / vector_seconds:>6.1f}x")
+
+if __name__ == "__main__":
+    main()
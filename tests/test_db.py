@@ -0,0 +1,139 @@
+import os
+import time
+import pytest
+from unittest.mock import patch
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from app.db import init_db, get_db_connection, get_pool, db_session, get_schema_version, hash_files, get_pending, mark_done, MIGRATIONS
+
+def test_hash_files_changes_with_content(tmp_path):
+    path = tmp_path / "a.json"
+    path.write_text('{"title": "one"}')
+    h1 = hash_files(str(path))
+    
+    path.write_text('{"title": "two"}')
+    h2 = hash_files(str(path))
+    
+    assert h1 != h2
+    assert h2 == hash_files(str(path))
+
+def test_stage_ledger(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        
+        inputs = {"a": "hash_a", "b": "hash_b"}
+        assert get_pending("moderate", inputs) == ["a", "b"]
+        
+        mark_done("moderate", "a", "hash_a")
+        assert get_pending("moderate", inputs) == ["b"]
+        
+        # Changed input is pending again
+        assert get_pending("moderate", {"a": "hash_a2"}) == ["a"]
+        
+        # Stages are tracked independently
+        assert get_pending("script", inputs) == ["a", "b"]
+
+@pytest.fixture
+def local_tz():
+    """Runs the test on a host five hours behind UTC."""
+    old = os.environ.get("TZ")
+    os.environ["TZ"] = "EST+5"
+    time.tzset()
+    yield
+    if old is None:
+        del os.environ["TZ"]
+    else:
+        os.environ["TZ"] = old
+    time.tzset()
+
+def test_init_db_backfills_created_utc(tmp_path, local_tz):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        conn = get_db_connection()
+        conn.execute("""
+            CREATE TABLE candidates (
+                post_id TEXT PRIMARY KEY, subreddit TEXT, title TEXT, op TEXT, upvotes INTEGER,
+                comments INTEGER, fetched_at TIMESTAMP, age_hours REAL, score REAL, raw_path TEXT
+            )
+        """)
+        conn.execute("INSERT INTO candidates (post_id, fetched_at, age_hours) VALUES ('p1', '2026-01-01 12:00:00', 2.0)")
+        conn.commit()
+        conn.close()
+        
+        init_db()
+        
+        conn = get_db_connection()
+        created_utc = conn.execute("SELECT created_utc FROM candidates").fetchone()[0]
+        conn.close()
+    
+    # fetched_at is host-local: 12:00 at UTC-5 is 17:00 UTC, and the post was 2h old then
+    assert created_utc == datetime(2026, 1, 1, 15, tzinfo=timezone.utc).timestamp()
+
+def test_pool_reuses_tuned_connections(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        conn = get_db_connection()
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1  # NORMAL
+        assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+        conn.close()
+        
+        assert get_db_connection() is conn
+
+def test_released_connection_discards_uncommitted_work(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        conn = get_db_connection()
+        conn.execute("INSERT INTO flagged (post_id) VALUES ('p1')")
+        conn.close()
+        
+        with db_session() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM flagged").fetchone()[0] == 0
+            conn.execute("INSERT INTO flagged (post_id) VALUES ('p2')")
+        
+        with pytest.raises(ValueError):
+            with db_session() as conn:
+                conn.execute("INSERT INTO flagged (post_id) VALUES ('p3')")
+                raise ValueError("boom")
+        
+        conn = get_db_connection()
+        assert [row[0] for row in conn.execute("SELECT post_id FROM flagged")] == ["p2"]
+        conn.close()
+
+def test_pool_is_thread_safe(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        
+        def work(i):
+            with db_session() as conn:
+                conn.execute("INSERT INTO flagged (post_id) VALUES (?)", (f"p{i}",))
+        
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(work, range(50)))
+        
+        with db_session() as conn:
+            assert conn.execute("SELECT COUNT(*) FROM flagged").fetchone()[0] == 50
+        assert len(get_pool().idle) <= 8
+
+def test_init_db_applies_migrations_once(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        init_db()
+        
+        with db_session() as conn:
+            versions = [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+            indexes = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+            plan = conn.execute("EXPLAIN QUERY PLAN SELECT * FROM flagged ORDER BY flagged_at DESC").fetchall()
+        
+        assert versions == [version for version, _, _ in MIGRATIONS]
+        assert {"idx_candidates_score", "idx_flagged_flagged_at", "idx_candidates_subreddit", "idx_candidates_fetched_at"} <= indexes
+        assert "idx_flagged_flagged_at" in plan[0][3]
+
+def test_init_db_applies_new_migrations(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        migrations = MIGRATIONS + [(len(MIGRATIONS) + 1, "scripts.content_hash", ["ALTER TABLE scripts ADD COLUMN content_hash TEXT"])]
+        init_db(migrations)
+        
+        with db_session() as conn:
+            columns = [row['name'] for row in conn.execute("PRAGMA table_info(scripts)")]
+            assert get_schema_version(conn) == len(migrations)
+        assert "content_hash" in columns
@@ -0,0 +1,43 @@
+import pytest
+from unittest.mock import MagicMock, patch
+import json
+import os
+from app.fused_gen import run_fused_gen
+
+@patch('app.fused_gen.mark_done')
+@patch('app.fused_gen.get_pending', side_effect=lambda stage, inputs: list(inputs))
+@patch('app.fused_gen.save_script')
+@patch('app.moderate.flag_post')
+@patch('app.fused_gen.client')
+def test_run_fused_gen_routes_results(mock_client, mock_flag, mock_save, mock_pending, mock_mark, tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "canonical").mkdir(parents=True)
+    for post_id in ["clean", "flagged", "noscript"]:
+        data = {"subreddit": "AskReddit", "title": f"Title {post_id}", "op": "u", "selftext": "", "comments": []}
+        with open(workspace / "canonical" / f"{post_id}.json", "w") as f:
+            json.dump(data, f)
+    
+    script = {"tone": "funny", "pacing": "fast", "cta": "Follow", "scenes": [{"text": "Hi", "duration": 2}]}
+    responses = {
+        "clean": {"flag": False, "reasons": [], "script": script},
+        "flagged": {"flag": True, "reasons": ["Violence"], "script": None},
+        "noscript": {"flag": False, "reasons": []},
+    }
+    mock_client.generate_json_many.side_effect = lambda prompts, stage, validate=None: [
+        next(v for k, v in responses.items() if f"Title {k}\n" in p) for p in prompts
+    ]
+    
+    with patch('app.fused_gen.WORKSPACE_DIR', str(workspace)), \
+         patch('app.moderate.WORKSPACE_DIR', str(workspace)):
+        run_fused_gen()
+    
+    # One request per post
+    assert len(mock_client.generate_json_many.call_args[0][0]) == 3
+    
+    mock_save.assert_called_once_with("clean", script)
+    assert mock_flag.call_args[0][0] == "flagged"
+    
+    marked = sorted((c[0][0], c[0][1]) for c in mock_mark.call_args_list)
+    assert marked == [
+        ("moderate", "clean"), ("moderate", "flagged"), ("moderate", "noscript"), ("script", "clean")
+    ]
@@ -1,7 +1,9 @@
 import pytest
 import os
 from unittest.mock import MagicMock, patch
-from app.genai_client import GeminiClient
+from app.metrics import Registry
+from app.genai_client import GeminiClient, TokenBucket, KeyScheduler, KeysCoolingDown, bind_service_client
+from app.llm_cache import ResponseCache
 from google.api_core import exceptions
 
 def test_client_initialization_no_keys():
@@ -30,6 +32,76 @@ def test_key_rotation():
     assert client._get_next_key() == 'key2'
     assert client._get_next_key() == 'key1'
 
+def test_scheduler_skips_cooling_key_and_prefers_fast_keys():
+    scheduler = KeyScheduler(quota_cooldown=60, max_wait=0)
+    keys = ['a', 'b', 'c']
+    
+    for key, seconds in (('a', 0.1), ('b', 2.0), ('c', 0.5)):
+        assert scheduler.acquire([key]) == key
+        scheduler.release(key, "ok", seconds)
+    assert scheduler.acquire(keys) == 'a'
+    scheduler.release('a', "quota")
+    
+    # 'a' is cooling down; 'c' is faster than 'b'
+    assert scheduler.acquire(keys) == 'c'
+    stats = scheduler.stats(keys)
+    assert stats[0]["quota_errors"] == 1 and stats[0]["cooldown_remaining"] > 0
+    assert stats[2]["in_flight"] == 1
+
+def test_scheduler_fails_fast_when_all_keys_cooling():
+    scheduler = KeyScheduler(quota_cooldown=60, max_wait=5)
+    for key in ('a', 'b'):
+        scheduler.acquire([key])
+        assert scheduler.release(key, "quota") == 60
+    
+    with patch('app.genai_client.time.sleep') as sleep:
+        with pytest.raises(KeysCoolingDown) as info:
+            scheduler.acquire(['a', 'b'])
+    sleep.assert_not_called()
+    assert info.value.retry_after > 5
+
+def test_scheduler_waits_out_short_cooldown():
+    scheduler = KeyScheduler(error_cooldown=1, max_wait=5)
+    scheduler.acquire(['a'])
+    assert scheduler.release('a', "error") == 1
+    
+    with patch('app.genai_client.time.sleep') as sleep:
+        assert scheduler.acquire(['a']) == 'a'
+    assert 0 < sleep.call_args[0][0] <= 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_generate_content_single_key_waits_out_quota_cooldown(mock_model_cls):
+    mock_model_cls.return_value.generate_content.side_effect = [
+        exceptions.ResourceExhausted("Quota exceeded"),
+        MagicMock(text="Success"),
+    ]
+    
+    client = GeminiClient()
+    client.keys = ['key1']
+    client.scheduler.quota_cooldown = 10
+    client.scheduler.max_wait = 60
+    
+    with patch('app.genai_client.time.sleep') as sleep:
+        assert client.generate_content("prompt") == "Success"
+    # Slept until the only key came back, instead of giving up
+    assert sleep.call_count == 1 and 9 < sleep.call_args[0][0] <= 10
+    stats = client.key_stats()["key0"]
+    assert (stats["ok"], stats["quota_errors"], stats["in_flight"]) == (1, 1, 0)
+
+@patch('google.generativeai.GenerativeModel')
+def test_generate_content_fails_fast_on_long_cooldown_by_default(mock_model_cls):
+    mock_model_cls.return_value.generate_content.side_effect = exceptions.ResourceExhausted("Quota exceeded")
+    
+    client = GeminiClient()
+    client.keys = ['key1']
+    client.scheduler.quota_cooldown = 10
+    
+    with patch('app.genai_client.time.sleep') as sleep, pytest.raises(KeysCoolingDown):
+        client.generate_content("prompt")
+    # The stage gives up on this post for now instead of stalling the run
+    assert all(call.args[0] < 10 for call in sleep.call_args_list)
+    assert mock_model_cls.return_value.generate_content.call_count == 1
+
 @patch('google.generativeai.GenerativeModel')
 def test_generate_content_success(mock_model_cls):
     mock_model = MagicMock()
@@ -61,3 +133,153 @@ def test_generate_content_retry_on_429(mock_model_cls):
     
     assert result == "Success"
     assert mock_model.generate_content.call_count == 2
+
+@patch('google.generativeai.GenerativeModel')
+def test_generate_content_records_metrics_per_key(mock_model_cls):
+    mock_model = MagicMock()
+    mock_model.generate_content.side_effect = [
+        exceptions.ResourceExhausted("Quota exceeded"),
+        MagicMock(text="Success")
+    ]
+    mock_model_cls.return_value = mock_model
+    
+    client = GeminiClient()
+    client.keys = ['key1', 'key2']
+    
+    registry = Registry()
+    with patch('app.metrics.registry', registry), \
+            patch('app.metrics.inc', registry.inc), patch('app.metrics.observe', registry.observe), \
+            patch('time.sleep', return_value=None):
+        client.generate_content("prompt")
+    
+    counters = {(name, tuple(sorted(labels.items()))): value for name, labels, kind, value in registry.snapshot() if kind == "counter"}
+    assert counters[("gemini_requests_total", (("key", "key0"), ("kind", "text"), ("status", "quota")))] == 1
+    assert counters[("gemini_requests_total", (("key", "key1"), ("kind", "text"), ("status", "ok")))] == 1
+    assert counters[("gemini_retries_total", (("key", "key0"),))] == 1
+
+@patch('google.generativeai.GenerativeModel')
+def test_generate_json_many_keeps_order_and_errors(mock_model_cls):
+    def fake_generate(prompt, **kwargs):
+        if "bad" in prompt:
+            raise ValueError("boom")
+        return MagicMock(text='{"prompt": "%s"}' % prompt.split("\n")[0])
+    mock_model_cls.return_value.generate_content.side_effect = fake_generate
+    
+    client = GeminiClient()
+    client.keys = ['key1', 'key2']
+    client.cache = None
+    
+    with patch('time.sleep', return_value=None):
+        results = client.generate_json_many(["a", "bad", "c"], retries=1)
+    
+    assert results[0] == {"prompt": "a"}
+    assert isinstance(results[1], ValueError)
+    assert results[2] == {"prompt": "c"}
+
+def test_token_bucket_limits_rate():
+    clock = [100.0]
+    sleeps = []
+    def fake_sleep(seconds):
+        sleeps.append(seconds)
+        clock[0] += seconds
+    
+    with patch('app.genai_client.time.monotonic', side_effect=lambda: clock[0]), \
+         patch('app.genai_client.time.sleep', side_effect=fake_sleep):
+        bucket = TokenBucket(rate=2.0, capacity=1)
+        bucket.acquire()
+        # Bucket is empty, the next token arrives after 1 / rate seconds
+        bucket.acquire()
+    
+    assert sleeps == [0.5]
+
+@patch('google.generativeai.GenerativeModel')
+def test_generate_json_uses_cache(mock_model_cls, tmp_path):
+    mock_model_cls.return_value.generate_content.return_value.text = '```json\n{"flag": false}\n```'
+    
+    client = GeminiClient()
+    client.keys = ['key1']
+    client.cache = ResponseCache(path=str(tmp_path / "cache.db"))
+    
+    assert client.generate_json("prompt", stage="moderate") == {"flag": False}
+    assert client.generate_json("prompt", stage="moderate") == {"flag": False}
+    assert mock_model_cls.return_value.generate_content.call_count == 1
+    assert client.cache.stats["moderate"] == {"hits": 1, "misses": 1}
+    
+    # Bypass forces a fresh call
+    client.generate_json("prompt", stage="moderate", use_cache=False)
+    assert mock_model_cls.return_value.generate_content.call_count == 2
+
+@patch('google.generativeai.GenerativeModel')
+def test_generate_json_does_not_cache_invalid_response(mock_model_cls, tmp_path):
+    mock_model_cls.return_value.generate_content.side_effect = [
+        MagicMock(text='{"scenes": []}'),
+        MagicMock(text='{"flag": false}'),
+    ]
+    
+    client = GeminiClient()
+    client.keys = ['key1']
+    client.cache = ResponseCache(path=str(tmp_path / "cache.db"))
+    
+    def validate(result):
+        if "flag" not in result:
+            raise ValueError("missing flag")
+    
+    with pytest.raises(ValueError):
+        client.generate_json("prompt", stage="moderate", validate=validate)
+    # The rejected reply was not stored, so the model is asked again
+    assert client.generate_json("prompt", stage="moderate", validate=validate) == {"flag": False}
+    assert mock_model_cls.return_value.generate_content.call_count == 2
+    assert client.generate_json("prompt", stage="moderate", validate=validate) == {"flag": False}
+    assert mock_model_cls.return_value.generate_content.call_count == 2
+
+def test_generate_json_drops_cached_response_that_fails_validation(tmp_path):
+    client = GeminiClient()
+    client.keys = ['key1']
+    client.cache = ResponseCache(path=str(tmp_path / "cache.db"))
+    
+    with patch.object(client, 'generate_content', side_effect=['{"scenes": []}', '{"flag": true}']) as generate:
+        client.generate_json("prompt")
+        assert client.generate_json("prompt", validate=lambda r: r["flag"]) == {"flag": True}
+    assert generate.call_count == 2
+
+@patch('google.generativeai.GenerativeModel')
+def test_blocked_response_releases_key_once(mock_model_cls):
+    blocked = MagicMock()
+    type(blocked).text = property(lambda self: (_ for _ in ()).throw(ValueError("blocked candidate")))
+    mock_model_cls.return_value.generate_content.return_value = blocked
+    
+    client = GeminiClient()
+    client.keys = ['key1']
+    client.scheduler.error_cooldown = 0
+    
+    with pytest.raises(ValueError):
+        client.generate_content("prompt", retries=1)
+    stats = client.key_stats()["key0"]
+    assert (stats["ok"], stats["errors"], stats["in_flight"]) == (0, 1, 0)
+
+@patch('app.genai_client.glm.GenerativeServiceClient')
+def test_models_send_requests_through_their_keys_service_client(mock_service_cls):
+    # Uses the real GenerativeModel: fails if the library stops honouring a preset _client
+    from google.ai import generativelanguage as glm
+    service_clients = {}
+    def make_client(client_options):
+        service_client = MagicMock()
+        service_client.generate_content.return_value = glm.GenerateContentResponse(candidates=[
+            glm.Candidate(content=glm.Content(parts=[glm.Part(text=client_options["api_key"])], role="model"))
+        ])
+        service_clients[client_options["api_key"]] = service_client
+        return service_client
+    mock_service_cls.side_effect = make_client
+    
+    client = GeminiClient()
+    client.keys = ['key1', 'key2']
+    
+    assert client._get_model('key1', client.model_name).generate_content("prompt").text == 'key1'
+    assert client._get_model('key2', client.model_name).generate_content("prompt").text == 'key2'
+    assert client._get_model('key1', client.model_name).generate_content("prompt").text == 'key1'
+    assert mock_service_cls.call_count == 2
+    assert service_clients['key1'].generate_content.call_count == 2
+
+def test_bind_service_client_fails_loudly_without_private_client():
+    with pytest.raises(RuntimeError):
+        bind_service_client(object(), MagicMock())
@@ -0,0 +1,171 @@
+import pytest
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+from app.harvest import fetch_top_comments, fetch_comments_concurrently, harvest, refresh_candidates, RateLimitGate, KnownPostIds
+from app.db import init_db, get_db_connection
+
+def make_comment(body):
+    comment = MagicMock()
+    comment.body = body
+    comment.author = "user"
+    comment.score = 1
+    return comment
+
+def test_fetch_top_comments_requests_small_top_slice():
+    post = MagicMock()
+    post.comments.list.return_value = [make_comment(f"c{i}") for i in range(15)]
+    
+    comments = fetch_top_comments(post)
+    
+    assert post.comment_sort == "top"
+    assert post.comment_limit == 10
+    post.comments.replace_more.assert_called_once_with(limit=0)
+    assert [c["body"] for c in comments] == [f"c{i}" for i in range(10)]
+
+@patch('app.harvest.get_reddit_client')
+def test_fetch_comments_concurrently(mock_get_client):
+    reddit = MagicMock()
+    reddit.auth.limits = {"remaining": 500, "used": 100}
+    def submission(id):
+        if id == "bad":
+            raise Exception("boom")
+        post = MagicMock()
+        post.comments.list.return_value = [make_comment(f"{id} comment")]
+        return post
+    reddit.submission.side_effect = submission
+    mock_get_client.return_value = reddit
+    
+    results = fetch_comments_concurrently(["a", "bad", "b"], workers=3)
+    
+    assert set(results) == {"a", "b"}
+    assert results["a"][0]["body"] == "a comment"
+
+def test_rate_limit_gate_waits_for_window():
+    gate = RateLimitGate(reserve=2)
+    gate.update({"remaining": 5, "used": 595})
+    
+    with patch('app.harvest.time.sleep') as mock_sleep:
+        gate.wait()
+        gate.wait()
+        gate.wait()
+        mock_sleep.assert_not_called()
+        # Shared budget is down to the reserve
+        gate.wait()
+        mock_sleep.assert_called_once()
+
+def test_rate_limit_gate_sleeps_until_reported_reset():
+    gate = RateLimitGate(reserve=1)
+    now = 1_000_000.0
+    gate.update({"remaining": 1, "reset_timestamp": now + 42})
+    
+    with patch('app.harvest.time.time', return_value=now), patch('app.harvest.time.sleep') as mock_sleep:
+        gate.wait()
+    assert 42 <= mock_sleep.call_args[0][0] <= 43
+
+def test_rate_limit_gate_takes_fresh_budget_after_window_rolls_over():
+    gate = RateLimitGate(reserve=2)
+    gate.update({"remaining": 3})
+    # New window: the server reports a larger budget again
+    gate.update({"remaining": 600})
+    
+    with patch('app.harvest.time.sleep') as mock_sleep:
+        for _ in range(10):
+            gate.wait()
+    mock_sleep.assert_not_called()
+
+def make_post(post_id, subreddit="AskReddit"):
+    post = MagicMock()
+    post.id = post_id
+    post.title = f"Title {post_id}"
+    post.subreddit = subreddit
+    post.author = "op"
+    post.score = 10
+    post.num_comments = 2
+    post.created_utc = 0
+    return post
+
+def test_known_post_ids_bloom_mode(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        conn = get_db_connection()
+        conn.executemany("INSERT INTO candidates (post_id) VALUES (?)", [(f"p{i}",) for i in range(50)])
+        conn.commit()
+        
+        small = KnownPostIds(conn.cursor())
+        large = KnownPostIds(conn.cursor(), bloom_threshold=10)
+        assert small.ids is not None
+        assert large.bloom is not None
+        
+        for known in (small, large):
+            assert "p7" in known
+            assert "new" not in known
+            known.add("new")
+            assert "new" in known
+        conn.close()
+
+@patch('app.harvest.save_raw_post', return_value="/raw/path.json")
+@patch('app.harvest.fetch_comments_concurrently')
+@patch('app.harvest.get_reddit_client')
+def test_harvest_dedups_and_batches_inserts(mock_get_client, mock_fetch, mock_save, tmp_path):
+    reddit = MagicMock()
+    subreddit = reddit.subreddit.return_value
+    # "b" is both hot and top, "old" was harvested in an earlier run
+    subreddit.hot.return_value = [make_post("a"), make_post("b"), make_post("old")]
+    subreddit.top.return_value = [make_post("b"), make_post("c")]
+    mock_get_client.return_value = reddit
+    mock_fetch.side_effect = lambda ids, workers: {post_id: [] for post_id in ids}
+    
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        conn = get_db_connection()
+        conn.execute("INSERT INTO candidates (post_id) VALUES ('old')")
+        conn.commit()
+        conn.close()
+        
+        harvest(subreddits=["AskReddit"], workers=4)
+        
+        conn = get_db_connection()
+        ids = sorted(row[0] for row in conn.execute("SELECT post_id FROM candidates"))
+        conn.close()
+    
+    assert mock_fetch.call_args[0][0] == ["a", "b", "c"]
+    assert mock_save.call_count == 3
+    assert ids == ["a", "b", "c", "old"]
+
+@patch('app.harvest.get_reddit_client')
+def test_refresh_candidates_batches_unprocessed(mock_get_client, tmp_path):
+    reddit = MagicMock()
+    def info(fullnames):
+        posts = []
+        for fullname in fullnames:
+            post = make_post(fullname[3:])
+            post.score = 99
+            post.num_comments = 7
+            posts.append(post)
+        return posts
+    reddit.info.side_effect = info
+    mock_get_client.return_value = reddit
+    
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        conn = get_db_connection()
+        conn.executemany(
+            "INSERT INTO candidates (post_id, upvotes, comments, raw_path, fetched_at) VALUES (?, 1, 1, ?, ?)",
+            [(f"p{i}", f"/raw/20260101_000000_p{i}.json", datetime.now()) for i in range(5)]
+        )
+        # Past the retention window: never refreshed again
+        conn.execute("INSERT INTO candidates (post_id, upvotes, comments, raw_path, fetched_at) VALUES ('stale', 1, 1, ?, ?)",
+                     ("/raw/20250101_000000_stale.json", datetime.now() - timedelta(days=30)))
+        conn.execute("INSERT INTO scripts (post_id) VALUES ('20260101_000000_p0')")
+        conn.execute("INSERT INTO flagged (post_id) VALUES ('20260101_000000_p1')")
+        conn.commit()
+        conn.close()
+        
+        refresh_candidates(batch_size=2)
+        
+        conn = get_db_connection()
+        rows = {row[0]: row[1] for row in conn.execute("SELECT post_id, upvotes FROM candidates")}
+        conn.close()
+    
+    assert [call.kwargs["fullnames"] for call in reddit.info.call_args_list] == [["t3_p2", "t3_p3"], ["t3_p4"]]
+    assert rows == {"p0": 1, "p1": 1, "p2": 99, "p3": 99, "p4": 99, "stale": 1}
@@ -0,0 +1,113 @@
+import time
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+from app.db import init_db, db_session
+from app.jobs import enqueue, claim, heartbeat, complete, fail, process_job, queue_counts
+
+@pytest.fixture
+def db(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        yield
+
+def job_row(job_id):
+    with db_session() as conn:
+        return dict(conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+def test_enqueue_is_idempotent_per_input(db):
+    assert enqueue("moderate", "p1", "h1")
+    assert not enqueue("moderate", "p1", "h1")
+    assert enqueue("moderate", "p1", "h2")
+    assert queue_counts() == {"moderate": {"queued": 2}}
+
+def test_concurrent_claims_never_share_a_job(db):
+    for i in range(20):
+        enqueue("tts", f"p{i}", "h")
+    
+    def claim_all(worker):
+        claimed = []
+        while True:
+            job = claim(worker, ["tts"])
+            if job is None:
+                return claimed
+            claimed.append(job["post_id"])
+    
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(pool.map(claim_all, [f"w{i}" for i in range(4)]))
+    
+    claimed = [post_id for batch in results for post_id in batch]
+    assert sorted(claimed) == sorted(f"p{i}" for i in range(20))
+
+def test_claim_prefers_later_stages(db):
+    enqueue("moderate", "p1", "h")
+    enqueue("render", "p2", "h")
+    assert claim("w1", ["render", "moderate"])["stage"] == "render"
+
+def test_expired_lease_is_reclaimed(db):
+    enqueue("render", "p1", "h")
+    job = claim("crashed", ["render"], lease_seconds=-1)
+    
+    # Lease already lapsed, so the next claim hands the job to a live worker
+    reclaimed = claim("w2", ["render"])
+    assert reclaimed["id"] == job["id"]
+    assert reclaimed["attempts"] == 2
+    # The dead worker can no longer touch it
+    assert not heartbeat(job["id"], "crashed")
+    assert heartbeat(job["id"], "w2")
+
+def test_fail_backs_off_then_gives_up(db):
+    enqueue("script", "p1", "h")
+    with patch('app.jobs.JOB_MAX_ATTEMPTS', 2):
+        job = claim("w1", ["script"])
+        fail(job, "w1", "boom")
+        row = job_row(job["id"])
+        assert row["status"] == "queued"
+        assert row["available_at"] > time.time()
+        assert claim("w1", ["script"]) is None
+        
+        with patch('app.jobs.time.time', return_value=time.time() + 3600):
+            job = claim("w1", ["script"])
+            fail(job, "w1", "boom again")
+    
+    row = job_row(job["id"])
+    assert row["status"] == "failed"
+    assert row["last_error"] == "boom again"
+
+def test_failed_job_can_be_requeued_after_cool_off(db):
+    enqueue("tts", "p1", "h")
+    with patch('app.jobs.JOB_MAX_ATTEMPTS', 1):
+        job = claim("w1", ["tts"])
+        fail(job, "w1", "outage")
+    assert job_row(job["id"])["status"] == "failed"
+    
+    # Too soon: the failure stands
+    assert not enqueue("tts", "p1", "h")
+    assert enqueue("tts", "p1", "h", retry_failed_after=0)
+    row = job_row(job["id"])
+    assert (row["status"], row["attempts"]) == ("queued", 0)
+    assert claim("w1", ["tts"])["id"] == job["id"]
+
+def test_process_job_chains_next_stage(db):
+    enqueue("moderate", "p1", "h")
+    job = claim("w1", ["moderate"])
+    
+    with patch.dict('app.jobs.STEPS', {"moderate": lambda post_id: True}), \
+            patch('app.jobs.stage_input_hash', return_value="script-hash"):
+        assert process_job(job, "w1")
+    
+    assert job_row(job["id"])["status"] == "done"
+    assert queue_counts() == {"moderate": {"done": 1}, "script": {"queued": 1}}
+
+def test_process_job_retries_failed_step(db):
+    enqueue("tts", "p1", "h")
+    job = claim("w1", ["tts"])
+    
+    with patch.dict('app.jobs.STEPS', {"tts": lambda post_id: False}):
+        assert not process_job(job, "w1")
+    
+    row = job_row(job["id"])
+    assert row["status"] == "queued"
+    assert "tts did not complete" in row["last_error"]
+    complete(job["id"], "w1")  # no longer leased: a no-op
+    assert job_row(job["id"])["status"] == "queued"
@@ -0,0 +1,41 @@
+import pytest
+import time
+from unittest.mock import patch
+from app.llm_cache import ResponseCache, cache_key
+
+def test_cache_key_depends_on_inputs():
+    k1 = cache_key("gemini-2.0-flash", "prompt")
+    assert k1 == cache_key("gemini-2.0-flash", "prompt", {})
+    assert k1 != cache_key("gemini-2.0-flash", "other prompt")
+    assert k1 != cache_key("other-model", "prompt")
+    assert k1 != cache_key("gemini-2.0-flash", "prompt", {"temperature": 0.2})
+
+def test_cache_ttl_expiry(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "cache.db"), ttl_hours=1)
+    cache.put("k", "model", '{"a": 1}')
+    assert cache.get("k") == '{"a": 1}'
+    
+    with patch('app.llm_cache.time.time', return_value=time.time() + 2 * 3600):
+        assert cache.get("k") is None
+    
+    assert cache.stats["default"] == {"hits": 1, "misses": 1}
+
+def test_cache_lru_eviction(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "cache.db"), max_entries=2)
+    now = time.time()
+    with patch('app.llm_cache.time.time', side_effect=[now, now + 1, now + 2, now + 3]):
+        cache.put("a", "model", "1")
+        cache.put("b", "model", "2")
+        # Touch "a" so "b" becomes least recently used
+        cache.get("a")
+        cache.put("c", "model", "3")
+    
+    assert cache.get("a") == "1"
+    assert cache.get("b") is None
+    assert cache.get("c") == "3"
+
+def test_cache_bypass(tmp_path):
+    cache = ResponseCache(path=str(tmp_path / "cache.db"), bypass=True)
+    cache.put("k", "model", "1")
+    assert cache.get("k", stage="script") is None
+    assert cache.stats["script"] == {"hits": 0, "misses": 1}
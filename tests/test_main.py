@@ -35,3 +35,13 @@ def test_resolve_flag(mock_remove, mock_db):
     assert response.status_code == 200
     mock_remove.assert_called_once_with("/tmp/1.json")
     assert "DELETE FROM flagged" in mock_cursor.execute.call_args_list[1][0][0]
+
+@patch('app.main.metrics.load_published')
+def test_get_metrics(mock_load):
+    mock_load.return_value = [("items_total", {"stage": "tts", "outcome": "processed", "source": "worker"}, "counter", 5)]
+    
+    response = client.get("/metrics")
+    
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'reelsmith_items_total{stage="tts",outcome="processed",source="worker"} 5' in response.text
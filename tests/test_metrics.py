@@ -0,0 +1,45 @@
+from unittest.mock import patch
+from app import metrics
+from app.db import init_db
+from app.metrics import Registry, format_prometheus
+
+def test_histogram_buckets_are_cumulative():
+    registry = Registry()
+    registry.observe("stage_seconds", 0.3, stage="tts")
+    registry.observe("stage_seconds", 7, stage="tts")
+    
+    [(name, labels, kind, data)] = registry.snapshot()
+    buckets = dict(zip(metrics.BUCKETS, data["buckets"]))
+    
+    assert (name, labels, kind) == ("stage_seconds", {"stage": "tts"}, "histogram")
+    assert buckets[0.25] == 0
+    assert buckets[0.5] == 1
+    assert buckets[10] == 2
+    assert data["count"] == 2
+    assert data["sum"] == 7.3
+
+def test_format_prometheus():
+    registry = Registry()
+    registry.inc("items_total", 3, stage="script", outcome="processed")
+    registry.observe("ffmpeg_encode_seconds", 4.2, backend="pipe")
+    
+    text = format_prometheus(registry.snapshot())
+    
+    assert "# TYPE reelsmith_items_total counter" in text
+    assert 'reelsmith_items_total{outcome="processed",stage="script"} 3' in text
+    assert 'reelsmith_ffmpeg_encode_seconds_bucket{backend="pipe",le="5"} 1' in text
+    assert 'reelsmith_ffmpeg_encode_seconds_bucket{backend="pipe",le="+Inf"} 1' in text
+    assert 'reelsmith_ffmpeg_encode_seconds_count{backend="pipe"} 1' in text
+
+def test_flush_publishes_snapshot_per_source(tmp_path):
+    registry = Registry()
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")), patch('app.metrics.registry', registry):
+        init_db()
+        registry.inc("gemini_requests_total", key="key0", kind="text", status="ok")
+        metrics.flush(source="worker-1")
+        registry.inc("gemini_requests_total", key="key0", kind="text", status="ok")
+        metrics.flush(source="worker-1")
+        
+        published = metrics.load_published()
+    
+    assert published == [("gemini_requests_total", {"key": "key0", "kind": "text", "status": "ok", "source": "worker-1"}, "counter", 2)]
@@ -2,7 +2,7 @@ import pytest
 from unittest.mock import MagicMock, patch
 import json
 import os
-from app.moderate import moderate_post, flag_post
+from app.moderate import moderate_post, flag_post, parse_batch_verdicts, validate_batch_verdicts, run_moderation, PreFilter
 
 @patch('app.moderate.client')
 @patch('app.moderate.get_db_connection')
@@ -74,3 +74,151 @@ def test_moderate_post_safe(mock_client, tmp_path):
         
     # Verify file NOT moved
     assert (workspace / "canonical" / f"{post_id}.json").exists()
+
+def test_parse_batch_verdicts():
+    result = [
+        {"post_id": "a", "flag": False, "reasons": []},
+        {"post_id": "b", "flag": "maybe"},
+        {"post_id": "zzz", "flag": True, "reasons": ["unknown post"]},
+        {"post_id": "c", "flag": True, "reasons": "Hate speech"},
+    ]
+    verdicts = parse_batch_verdicts(result, ["a", "b", "c", "d"])
+    
+    assert verdicts == {
+        "a": {"flag": False, "reasons": []},
+        "c": {"flag": True, "reasons": ["Hate speech"]},
+    }
+    assert parse_batch_verdicts({"flag": False}, ["a"]) == {}
+
+def test_validate_batch_verdicts_keeps_partly_valid_batches():
+    # One verdict without a post_id must not throw away the others
+    validate_batch_verdicts([{"post_id": "a", "flag": False, "reasons": []}, {"flag": True, "reasons": []}])
+    
+    for result in [{"flag": False}, [], [{"flag": True}], [{"post_id": "a", "flag": "maybe"}]]:
+        with pytest.raises(ValueError):
+            validate_batch_verdicts(result)
+
+@patch('app.moderate.mark_done')
+@patch('app.moderate.get_pending', side_effect=lambda stage, inputs: list(inputs))
+@patch('app.moderate.flag_post')
+@patch('app.moderate.client')
+def test_run_moderation_batches_and_requeues(mock_client, mock_flag, mock_pending, mock_mark, tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "canonical").mkdir(parents=True)
+    for post_id in ["p1", "p2", "p3"]:
+        data = {"title": f"Title {post_id}", "op": "user", "selftext": "", "comments": []}
+        with open(workspace / "canonical" / f"{post_id}.json", "w") as f:
+            json.dump(data, f)
+    
+    # Batch answers p1 and p2 only; p3 must be re-queued on its own
+    mock_client.generate_json_many.side_effect = [
+        [[{"post_id": "p1", "flag": False, "reasons": []},
+          {"post_id": "p2", "flag": True, "reasons": ["Violence"]}]],
+        [{"flag": False, "reasons": []}],
+    ]
+    
+    with patch('app.moderate.WORKSPACE_DIR', str(workspace)), \
+         patch('app.moderate.MODERATION_BATCH_SIZE', 5):
+        run_moderation()
+    
+    batch_prompts = mock_client.generate_json_many.call_args_list[0][0][0]
+    assert len(batch_prompts) == 1
+    assert batch_prompts[0].count("Platform rules") == 1
+    assert all(f"### Post {pid}" in batch_prompts[0] for pid in ["p1", "p2", "p3"])
+    
+    single_prompts = mock_client.generate_json_many.call_args_list[1][0][0]
+    assert len(single_prompts) == 1
+    assert "Title p3" in single_prompts[0]
+    
+    assert mock_flag.call_count == 1
+    assert mock_flag.call_args[0][0] == "p2"
+    assert sorted(c[0][1] for c in mock_mark.call_args_list) == ["p1", "p2", "p3"]
+
+def test_prefilter_tiers():
+    pf = PreFilter({
+        "block_terms": ["porn", "self harm"],
+        "review_terms": ["kill"],
+        "deny_subreddits": ["gonewild"],
+        "allow_subreddits": ["Showerthoughts"],
+    })
+    base = {"title": "", "selftext": "", "comments": []}
+    
+    assert pf.check(dict(base, subreddit="GoneWild"))[0] == "flag"
+    
+    decision, reasons = pf.check(dict(base, subreddit="AskReddit", comments=[{"body": "talk about Self Harm"}]))
+    assert decision == "flag"
+    assert reasons == ["Blocked term: self harm"]
+    
+    # Word boundaries: "skills" is not "kill"
+    assert pf.check(dict(base, subreddit="Showerthoughts", title="New skills"))[0] == "pass"
+    assert pf.check(dict(base, subreddit="Showerthoughts", title="I could kill for pizza"))[0] == "escalate"
+    assert pf.check(dict(base, subreddit="AskReddit", title="Nice day"))[0] == "escalate"
+
+def test_default_prefilter_escalates_ambiguous_terms():
+    from app.moderate import DEFAULT_PREFILTER_RULES
+    pf = PreFilter(DEFAULT_PREFILTER_RULES)
+    # A name, not graphic violence: the model decides instead of an automatic flag
+    decision, reasons = pf.check({"subreddit": "Showerthoughts", "title": "Al Gore invented the internet",
+                                  "selftext": "", "comments": []})
+    assert (decision, reasons) == ("escalate", [])
+    # History and news mention drugs without promoting them
+    for title in ["Coca-Cola contained cocaine until 1903", "Bayer sold heroin as a cough medicine",
+                  "TIL meth was given to soldiers in WW2", "Fentanyl deaths fell last year"]:
+        assert pf.check({"subreddit": "todayilearned", "title": title, "selftext": "", "comments": []})[0] == "escalate"
+
+@patch('app.moderate.mark_done')
+@patch('app.moderate.get_pending', side_effect=lambda stage, inputs: list(inputs))
+@patch('app.moderate.flag_post')
+@patch('app.moderate.client')
+def test_run_moderation_prefilter_skips_llm(mock_client, mock_flag, mock_pending, mock_mark, tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "canonical").mkdir(parents=True)
+    posts = {
+        "safe": {"subreddit": "Showerthoughts", "title": "Clouds are soft", "op": "u", "selftext": "", "comments": []},
+        "bad": {"subreddit": "AskReddit", "title": "Where to find free porn", "op": "u", "selftext": "", "comments": []},
+    }
+    for post_id, data in posts.items():
+        with open(workspace / "canonical" / f"{post_id}.json", "w") as f:
+            json.dump(data, f)
+    mock_client.generate_json_many.return_value = []
+    
+    with patch('app.moderate.WORKSPACE_DIR', str(workspace)):
+        run_moderation()
+    
+    assert mock_flag.call_count == 1
+    assert mock_flag.call_args[0][0] == "bad"
+    assert mock_client.generate_json_many.call_args[0][0] == []
+    assert sorted(c[0][1] for c in mock_mark.call_args_list) == ["bad", "safe"]
+
+@patch('app.script_gen.client')
+@patch('app.moderate.client')
+def test_flagged_post_gets_no_script_after_reextraction(mock_moderate_client, mock_script_client, tmp_path):
+    from app.db import init_db
+    from app.extract import run_extraction
+    from app.script_gen import run_script_gen
+    workspace = tmp_path / "workspace"
+    (workspace / "raw").mkdir(parents=True)
+    raw = {"id": "p1", "subreddit": "AskReddit", "title": "A question", "author": "op",
+           "selftext": "", "comments_data": [{"body": "An answer", "author": "c", "score": 3}]}
+    with open(workspace / "raw" / "20240101_000000_p1.json", "w") as f:
+        json.dump(raw, f)
+    mock_moderate_client.generate_json_many.return_value = [{"flag": True, "reasons": ["unsafe"]}]
+    mock_script_client.generate_json_many.return_value = []
+    
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")), \
+            patch('app.extract.WORKSPACE_DIR', str(workspace)), \
+            patch('app.moderate.WORKSPACE_DIR', str(workspace)), \
+            patch('app.script_gen.WORKSPACE_DIR', str(workspace)):
+        init_db()
+        run_extraction()
+        run_moderation()
+        assert (workspace / "flagged" / "20240101_000000_p1.json").exists()
+        
+        run_extraction()
+        assert not (workspace / "canonical" / "20240101_000000_p1.json").exists()
+        # Even with a canonical back in place (e.g. from an older run), script gen skips it
+        with open(workspace / "canonical" / "20240101_000000_p1.json", "w") as f:
+            json.dump({"title": "A question", "op": "op", "selftext": "", "comments": []}, f)
+        run_script_gen()
+    
+    assert mock_script_client.generate_json_many.call_args[0][0] == []
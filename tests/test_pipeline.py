@@ -0,0 +1,67 @@
+import threading
+from unittest.mock import patch
+from app.pipeline import Stage, run_stages, script_step, tts_step
+
+def test_run_stages_streams_passes_and_drops():
+    seen = {"a": [], "b": []}
+    lock = threading.Lock()
+    
+    def stage_a(post_id):
+        with lock:
+            seen["a"].append(post_id)
+        if post_id == "bad":
+            raise ValueError("boom")
+        return post_id != "flagged"
+    
+    def stage_b(post_id):
+        with lock:
+            seen["b"].append(post_id)
+        return True
+    
+    stats = run_stages(["p1", "flagged", "bad", "p2"], [Stage("a", stage_a, 2), Stage("b", stage_b, 1)])
+    
+    assert sorted(seen["a"]) == ["bad", "flagged", "p1", "p2"]
+    assert sorted(seen["b"]) == ["p1", "p2"]
+    assert stats["a"]["passed"] == 2
+    assert stats["a"]["dropped"] == 1
+    assert stats["a"]["failed"] == 1
+    assert stats["b"]["passed"] == 2
+    assert stats["b"]["first"] is not None
+
+def test_run_stages_finishes_first_post_before_feed_drains():
+    # The last stage has to finish p0 before stage one may take p3: no barrier between stages
+    first_finished = threading.Event()
+    
+    def first(post_id):
+        if post_id == "p3":
+            assert first_finished.wait(timeout=5)
+        return True
+    
+    def last(post_id):
+        if post_id == "p0":
+            first_finished.set()
+        return True
+    
+    stats = run_stages([f"p{i}" for i in range(6)], [Stage("first", first, 1, queue_size=1), Stage("last", last, 1, queue_size=1)])
+    
+    assert stats["first"]["passed"] == 6
+    assert stats["last"]["passed"] == 6
+
+def test_steps_skip_work_recorded_in_ledger(tmp_path):
+    workspace = tmp_path / "ws"
+    (workspace / "canonical").mkdir(parents=True)
+    (workspace / "scripts").mkdir()
+    (workspace / "canonical" / "p1.json").write_text("{}")
+    (workspace / "scripts" / "p1.json").write_text("{}")
+    
+    with patch('app.pipeline.WORKSPACE_DIR', str(workspace)), \
+            patch('app.pipeline.get_pending', side_effect=[["p1"], []]), \
+            patch('app.pipeline.mark_done') as mock_mark, \
+            patch('app.pipeline.generate_script', return_value=True) as mock_script, \
+            patch('app.pipeline.generate_tts') as mock_tts:
+        assert script_step("p1")
+        assert tts_step("p1")
+    
+    mock_script.assert_called_once_with("p1")
+    mock_mark.assert_called_once()
+    mock_tts.assert_not_called()
@@ -0,0 +1,89 @@
+import json
+import threading
+from unittest.mock import patch
+from app import profiling
+
+def busy_card_work():
+    return [bytearray(1024) for _ in range(200)]
+
+def test_stage_profile_writes_reports_including_worker_threads(tmp_path):
+    with patch('app.profiling.PROFILE', True), patch('app.profiling.WORKSPACE_DIR', str(tmp_path)):
+        run_id = profiling.start_run("run1")
+        with profiling.stage_profile("render"):
+            def worker():
+                with profiling.thread_profile():
+                    busy_card_work()
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+    
+    run_dir = tmp_path / "profiles" / run_id
+    assert (run_dir / "render.prof").exists()
+    report = (run_dir / "render.txt").read_text()
+    assert "2 profiled thread(s)" in report
+    assert "busy_card_work" in report
+    assert "peak traced memory" in (run_dir / "render.alloc.txt").read_text()
+
+def test_spans_carry_run_id_and_status(tmp_path):
+    with patch('app.profiling.PROFILE', True), patch('app.profiling.WORKSPACE_DIR', str(tmp_path)):
+        profiling.start_run("run2")
+        with profiling.span("tts", post_id="p1", attempt=1):
+            pass
+        try:
+            with profiling.span("render", post_id="p1"):
+                raise ValueError("boom")
+        except ValueError:
+            pass
+    
+    spans = [json.loads(line) for line in (tmp_path / "profiles" / "run2" / "traces.jsonl").read_text().splitlines()]
+    assert [(s["run_id"], s["span"], s["post_id"], s["status"]) for s in spans] == [
+        ("run2", "tts", "p1", "ok"), ("run2", "render", "p1", "error")
+    ]
+    assert spans[0]["attempt"] == 1
+
+def test_disabled_profiling_writes_nothing(tmp_path):
+    with patch('app.profiling.PROFILE', False), patch('app.profiling.WORKSPACE_DIR', str(tmp_path)):
+        profiling.start_run("run3")
+        with profiling.stage_profile("render"), profiling.span("render", post_id="p1"):
+            busy_card_work()
+    
+    assert not (tmp_path / "profiles").exists()
+
+def test_profile_stages_filter():
+    with patch('app.profiling.PROFILE', True), patch('app.profiling.PROFILE_STAGES', ["render"]):
+        assert profiling.enabled("render")
+        assert not profiling.enabled("harvest")
+
+def test_client_pool_threads_join_the_stage_profile(tmp_path):
+    from app.genai_client import GeminiClient
+    client = GeminiClient()
+    client.keys = ['key1', 'key2']
+    with patch('app.profiling.PROFILE', True), patch('app.profiling.WORKSPACE_DIR', str(tmp_path)):
+        run_id = profiling.start_run("run4")
+        with profiling.stage_profile("script"):
+            client._map(lambda item: busy_card_work(), range(4))
+    
+    report = (tmp_path / "profiles" / run_id / "script.txt").read_text()
+    assert "busy_card_work" in report
+    assert "1 profiled thread(s)" not in report
+
+def test_batch_stages_emit_per_post_spans(tmp_path):
+    from app.script_gen import run_script_gen
+    workspace = tmp_path / "workspace"
+    (workspace / "canonical").mkdir(parents=True)
+    for post_id in ["p1", "p2"]:
+        (workspace / "canonical" / f"{post_id}.json").write_text(
+            json.dumps({"title": "t", "op": "o", "selftext": "", "comments": []}))
+    script = {"tone": "funny", "pacing": "fast", "cta": "Follow", "scenes": []}
+    
+    with patch('app.profiling.PROFILE', True), patch('app.profiling.WORKSPACE_DIR', str(tmp_path)), \
+            patch('app.script_gen.WORKSPACE_DIR', str(workspace)), \
+            patch('app.script_gen.get_pending', side_effect=lambda stage, inputs: sorted(inputs)), \
+            patch('app.script_gen.save_script'), patch('app.script_gen.mark_done'), \
+            patch('app.script_gen.client') as mock_client:
+        mock_client.generate_json_many.return_value = [script, ValueError("bad reply")]
+        profiling.start_run("run5")
+        run_script_gen()
+    
+    spans = [json.loads(line) for line in (tmp_path / "profiles" / "run5" / "traces.jsonl").read_text().splitlines()]
+    assert [(s["span"], s["post_id"], s["status"]) for s in spans] == [("script", "p1", "ok"), ("script", "p2", "error")]
@@ -2,7 +2,8 @@ import pytest
 from unittest.mock import MagicMock, patch
 import json
 import os
-from app.render import generate_video
+import wave
+from app.render import generate_video, run_render, scene_frame_counts, build_output_args, get_profile, get_font, get_template, render_card, text_width, wrap_text
 
 @patch('app.render.subprocess.run')
 @patch('app.render.create_card')
@@ -27,7 +28,8 @@ def test_generate_video_success(mock_create_card, mock_subprocess, tmp_path):
         f.write(b"fake_audio")
         
     # Run render
-    with patch('app.render.WORKSPACE_DIR', str(workspace)):
+    with patch('app.render.WORKSPACE_DIR', str(workspace)), \
+         patch('app.render.RENDER_BACKEND', "concat"):
         generate_video(post_id)
         
     # Verify create_card called
@@ -50,3 +52,229 @@ def test_generate_video_missing_files(mock_subprocess, tmp_path):
         
     # Verify FFmpeg NOT called
     mock_subprocess.assert_not_called()
+
+@patch('app.render.subprocess.Popen')
+def test_generate_video_pipe_backend(mock_popen, tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "scripts").mkdir(parents=True)
+    (workspace / "output").mkdir(parents=True)
+    
+    post_id = "test_pipe"
+    data = {"scenes": [{"text": "Scene 1", "duration": 1.0}, {"text": "Scene 2", "duration": 0.4}]}
+    with open(workspace / "scripts" / f"{post_id}.json", "w") as f:
+        json.dump(data, f)
+    with open(workspace / "output" / f"{post_id}.wav", "wb") as f:
+        f.write(b"fake_audio")
+    
+    mock_popen.return_value.wait.return_value = 0
+    with patch('app.render.WORKSPACE_DIR', str(workspace)), \
+         patch('app.render.RENDER_BACKEND', "pipe"), \
+         patch('app.render.RENDER_PIPE_FPS', 5):
+        result = generate_video(post_id)
+    
+    assert result == str(workspace / "output" / f"{post_id}.mp4")
+    cmd = mock_popen.call_args[0][0]
+    assert cmd[cmd.index("-f") + 1] == "rawvideo"
+    assert cmd[cmd.index("-i") + 1] == "-"
+    
+    # 5 frames for scene 1 and 2 for scene 2, each a full RGB frame
+    writes = mock_popen.return_value.stdin.write.call_args_list
+    assert len(writes) == 7
+    assert all(len(c[0][0]) == 1080 * 1920 * 3 for c in writes)
+    
+    # No PNG frames on disk
+    assert not (workspace / "frames").exists()
+
+def test_scene_frame_counts():
+    scenes = [{"duration": 0.3}, {"duration": 0.3}, {"duration": 0.3}]
+    # Cumulative rounding keeps the total exact
+    assert sum(scene_frame_counts(scenes, 5)) == round(0.9 * 5)
+    # Last scene is held until the audio ends
+    assert scene_frame_counts([{"duration": 1.0}, {"duration": 1.0}], 5, min_duration=3.0) == [5, 10]
+
+def test_wrap_text_uses_measured_widths():
+    font = get_font("DejaVuSans-Bold.ttf", 60)
+    assert get_font("DejaVuSans-Bold.ttf", 60) is font
+    
+    text = "Narrow iiii words and WWWW wide ones plus a Supercalifragilisticexpialidocious token"
+    lines = wrap_text(text, font, 400)
+    
+    assert " ".join(lines).replace(" ", "") == text.replace(" ", "")
+    assert all(text_width(font, line) <= 400 for line in lines)
+
+def test_render_card_reuses_clean_template():
+    template = get_template("minimal", 200, 300)
+    before = template.tobytes()
+    
+    img = render_card("Hello", 200, 300, caption_style="minimal")
+    
+    assert get_template("minimal", 200, 300) is template
+    assert template.tobytes() == before
+    assert img.tobytes() != before
+
+@patch('app.render.print_render_summary')
+@patch('app.render.mark_done')
+@patch('app.render.get_pending', side_effect=lambda stage, inputs: list(inputs))
+@patch('app.render.generate_video')
+def test_run_render_budgets_threads(mock_generate, mock_pending, mock_mark, mock_summary, tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "scripts").mkdir(parents=True)
+    (workspace / "output").mkdir(parents=True)
+    for post_id in ["a", "b"]:
+        (workspace / "scripts" / f"{post_id}.json").write_text("{}")
+        (workspace / "output" / f"{post_id}.wav").write_bytes(b"audio")
+    (workspace / "scripts" / "no_audio.json").write_text("{}")
+    
+    mock_generate.side_effect = lambda post_id, threads, timeout: f"{post_id}.mp4" if post_id == "a" else None
+    
+    # Single job runs inline so the patched generate_video is used
+    with patch('app.render.WORKSPACE_DIR', str(workspace)), \
+         patch('app.render.RENDER_JOBS', 1), \
+         patch('app.render.RENDER_TIMEOUT', 30):
+        run_render()
+    
+    assert sorted(c[0][0] for c in mock_generate.call_args_list) == ["a", "b"]
+    assert all(c[1] == {"threads": None, "timeout": 30} for c in mock_generate.call_args_list)
+    mock_mark.assert_called_once()
+    assert mock_mark.call_args[0][1] == "a"
+    
+    timings = mock_summary.call_args[0][0]
+    assert sorted((t[0], t[1]) for t in timings) == [("a", "a.mp4"), ("b", None)]
+
+@patch('app.render.print_render_summary')
+@patch('app.render.mark_done')
+@patch('app.render.get_pending', side_effect=lambda stage, inputs: list(inputs))
+@patch('app.render.ProcessPoolExecutor')
+def test_run_render_survives_broken_worker(mock_pool_cls, mock_pending, mock_mark, mock_summary, tmp_path):
+    from concurrent.futures import Future
+    from concurrent.futures.process import BrokenProcessPool
+    workspace = tmp_path / "workspace"
+    (workspace / "scripts").mkdir(parents=True)
+    (workspace / "output").mkdir(parents=True)
+    for post_id in ["a", "b"]:
+        (workspace / "scripts" / f"{post_id}.json").write_text("{}")
+        (workspace / "output" / f"{post_id}.wav").write_bytes(b"audio")
+    
+    def submit(fn, post_id, threads, timeout):
+        future = Future()
+        if post_id == "a":
+            future.set_result((post_id, f"{post_id}.mp4", 1.0))
+        else:
+            future.set_exception(BrokenProcessPool("worker died"))
+        return future
+    mock_pool_cls.return_value.__enter__.return_value.submit.side_effect = submit
+    
+    with patch('app.render.WORKSPACE_DIR', str(workspace)), patch('app.render.RENDER_JOBS', 2):
+        run_render()
+    
+    assert mock_pool_cls.call_args[1]["mp_context"].get_start_method() == "spawn"
+    mock_mark.assert_called_once()
+    assert mock_mark.call_args[0][1] == "a"
+    timings = mock_summary.call_args[0][0]
+    assert sorted((t[0], t[1]) for t in timings) == [("a", "a.mp4"), ("b", None)]
+
+@patch('app.render.subprocess.run')
+def test_generate_video_passes_thread_budget(mock_subprocess, tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "scripts").mkdir(parents=True)
+    (workspace / "output").mkdir(parents=True)
+    (workspace / "scripts" / "p.json").write_text(json.dumps({"scenes": [{"text": "Hi", "duration": 1}]}))
+    (workspace / "output" / "p.wav").write_bytes(b"audio")
+    
+    with patch('app.render.WORKSPACE_DIR', str(workspace)), \
+         patch('app.render.RENDER_BACKEND', "concat"), \
+         patch('app.render.create_card'):
+        generate_video("p", threads=4, timeout=60)
+    
+    cmd = mock_subprocess.call_args[0][0]
+    assert cmd[cmd.index("-threads") + 1] == "4"
+    assert mock_subprocess.call_args[1]["timeout"] == 60
+
+def test_build_output_args_from_profile():
+    args = build_output_args(get_profile("draft"), threads=2)
+    
+    assert args[args.index("-preset") + 1] == "ultrafast"
+    assert args[args.index("-tune") + 1] == "stillimage"
+    assert args[args.index("-r") + 1] == "10"
+    assert args[args.index("-g") + 1] == "100"
+    assert args[args.index("-threads") + 1] == "2"
+    
+    with pytest.raises(ValueError):
+        get_profile("nope")
+
+@patch('app.render.subprocess.run')
+def test_segments_backend_reuses_cached_scenes(mock_subprocess, tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "scripts").mkdir(parents=True)
+    (workspace / "output").mkdir(parents=True)
+    (workspace / "output" / "p.wav").write_bytes(b"audio")
+    
+    def fake_ffmpeg(cmd, **kwargs):
+        # Segment encodes write their output file; the final mux is a no-op
+        if "-an" in cmd:
+            with open(cmd[-1], "wb") as f:
+                f.write(b"segment")
+    mock_subprocess.side_effect = fake_ffmpeg
+    
+    def render(texts):
+        scenes = [{"text": t, "duration": 2.0} for t in texts]
+        (workspace / "scripts" / "p.json").write_text(json.dumps({"scenes": scenes}))
+        mock_subprocess.reset_mock()
+        with patch('app.render.WORKSPACE_DIR', str(workspace)), \
+             patch('app.render.RENDER_BACKEND', "segments"):
+            assert generate_video("p", profile="draft")
+        return [c[0][0] for c in mock_subprocess.call_args_list]
+    
+    calls = render(["Intro", "Follow for more"])
+    assert sum("-an" in cmd for cmd in calls) == 2
+    
+    # Only the edited scene is re-encoded; the rest is a stream-copy remux
+    calls = render(["Changed intro", "Follow for more"])
+    assert sum("-an" in cmd for cmd in calls) == 1
+    mux = calls[-1]
+    assert mux[mux.index("-c:v") + 1] == "copy"
+    assert len(list((workspace / "segments").rglob("*.mp4"))) == 3
+
+@patch('app.render.subprocess.run')
+def test_segments_backend_holds_last_card_with_shared_segment(mock_subprocess, tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "scripts").mkdir(parents=True)
+    (workspace / "output").mkdir(parents=True)
+    scenes = [{"text": "Intro", "duration": 2.0}, {"text": "Follow for more", "duration": 2.0}]
+    
+    concat_lists = []
+    def fake_ffmpeg(cmd, **kwargs):
+        if "-an" in cmd:
+            with open(cmd[-1], "wb") as f:
+                f.write(b"segment")
+        else:
+            concat_lists.append(open(cmd[cmd.index("-i") + 1]).read().splitlines())
+    mock_subprocess.side_effect = fake_ffmpeg
+    
+    def render(post_id, audio_seconds):
+        (workspace / "scripts" / f"{post_id}.json").write_text(json.dumps({"scenes": scenes}))
+        with wave.open(str(workspace / "output" / f"{post_id}.wav"), "wb") as w:
+            w.setnchannels(1)
+            w.setsampwidth(2)
+            w.setframerate(24000)
+            w.writeframes(b"\0\0" * int(24000 * audio_seconds))
+        mock_subprocess.reset_mock()
+        with patch('app.render.WORKSPACE_DIR', str(workspace)), \
+             patch('app.render.RENDER_BACKEND', "segments"), \
+             patch('app.render.RENDER_HOLD_SECONDS', 5.0):
+            assert generate_video(post_id, profile="draft")
+        return [c[0][0] for c in mock_subprocess.call_args_list]
+    
+    # 4s of scenes, 6.05s of narration at 10 fps: 61 frames, the last card held
+    calls = render("a", 6.05)
+    assert sum("-an" in cmd for cmd in calls) == 3
+    mux = calls[-1]
+    assert mux[mux.index("-frames:v") + 1] == "61"
+    assert "-shortest" not in mux
+    hold = concat_lists[-1][-1]
+    
+    # A longer narration reuses the same hold segment, repeated, with nothing re-encoded
+    calls = render("b", 13.2)
+    assert sum("-an" in cmd for cmd in calls) == 0
+    assert calls[-1][calls[-1].index("-frames:v") + 1] == "132"
+    assert concat_lists[-1][2:] == [hold, hold]
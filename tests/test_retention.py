@@ -2,7 +2,9 @@ import pytest
 import os
 import time
 from unittest.mock import patch
-from app.retention import cleanup_workspace
+from datetime import datetime, timedelta
+from app.db import init_db, db_session
+from app.retention import cleanup_workspace, prune_jobs
 
 def test_cleanup_workspace(tmp_path):
     # Setup mock workspace
@@ -49,3 +51,17 @@ def test_cleanup_nested_dirs(tmp_path):
     
     # Verify empty dir removed
     assert not frames_dir.exists()
+
+def test_prune_jobs_keeps_recent_and_unfinished(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        old = datetime.now() - timedelta(hours=200)
+        with db_session() as conn:
+            for post_id, status, updated_at in [("a", "done", old), ("b", "failed", old),
+                                                ("c", "queued", old), ("d", "done", datetime.now())]:
+                conn.execute("INSERT INTO jobs (stage, post_id, input_hash, status, updated_at) VALUES ('tts', ?, 'h', ?, ?)",
+                             (post_id, status, updated_at))
+        
+        assert prune_jobs(max_age_hours=168) == 2
+        with db_session() as conn:
+            assert sorted(row[0] for row in conn.execute("SELECT post_id FROM jobs")) == ["c", "d"]
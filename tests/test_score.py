@@ -1,5 +1,7 @@
 import pytest
-from app.score import compute_score
+from unittest.mock import patch
+from app.score import compute_score, compute_scores, run_scoring, run_selection
+from app.db import init_db, get_db_connection, get_pending, rank_selected
 import time
 
 def test_compute_score_basic():
@@ -37,3 +39,87 @@ def test_compute_score_decay():
     s2, _ = compute_score(upvotes, comments, time.time() - (48 * 3600))
     
     assert s1 > s2
+
+def test_compute_scores_matches_scalar():
+    now = time.time()
+    upvotes = [1000, 0, 50]
+    comments = [100, 0, 5]
+    created = [now - 3600, now, now - 48 * 3600]
+    
+    scores, ages = compute_scores(upvotes, comments, created, now=now)
+    
+    for i in range(3):
+        expected, _ = compute_score(upvotes[i], comments[i], created[i])
+        assert scores[i] == pytest.approx(expected, rel=1e-3)
+    assert ages[0] == pytest.approx(1.0)
+
+def test_run_scoring_streams_chunks(tmp_path):
+    now = time.time()
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        conn = get_db_connection()
+        conn.executemany(
+            "INSERT INTO candidates (post_id, upvotes, comments, age_hours, created_utc) VALUES (?, ?, ?, ?, ?)",
+            [(f"p{i}", 100 * i, 10 * i, 1.0, now - i * 3600) for i in range(5)]
+            # Legacy row without created_utc scores from its stored age
+            + [("legacy", 100, 10, 2.0, None)]
+        )
+        conn.commit()
+        conn.close()
+        
+        run_scoring(chunk_size=2)
+        
+        conn = get_db_connection()
+        rows = {row['post_id']: row for row in conn.execute("SELECT post_id, score, age_hours FROM candidates")}
+        conn.close()
+    
+    for i in range(5):
+        expected, _ = compute_score(100 * i, 10 * i, now - i * 3600)
+        assert rows[f"p{i}"]['score'] == pytest.approx(expected, rel=1e-3)
+        assert rows[f"p{i}"]['age_hours'] == pytest.approx(i, abs=0.01)
+    assert rows["legacy"]['age_hours'] == pytest.approx(2.0, abs=0.01)
+
+def test_run_selection_ranks_with_subreddit_caps(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        conn = get_db_connection()
+        conn.executemany(
+            "INSERT INTO candidates (post_id, subreddit, score, raw_path) VALUES (?, ?, ?, ?)",
+            [
+                ("a1", "AskReddit", 9.0, "/raw/t_a1.json"),
+                ("a2", "AskReddit", 8.0, "/raw/t_a2.json"),
+                ("a3", "AskReddit", 7.0, "/raw/t_a3.json"),
+                ("s1", "Showerthoughts", 6.0, "/raw/t_s1.json"),
+                ("s2", "Showerthoughts", 5.0, "/raw/t_s2.json"),
+                ("done", "LifeProTips", 10.0, "/raw/t_done.json"),
+            ]
+        )
+        conn.execute("INSERT INTO stage_state (post_id, stage, input_hash) VALUES ('t_done', 'render', 'h')")
+        conn.commit()
+        conn.close()
+        
+        run_selection(top_k=3, per_subreddit=2)
+        
+        assert rank_selected(["t_s1", "t_a3", "t_a2", "t_a1", "t_s2"]) == ["t_a1", "t_a2", "t_s1"]
+        assert get_pending("script", {"t_s1": "h", "t_a1": "h", "t_s2": "h"}) == ["t_a1", "t_s1"]
+        
+        # Disabled selection lets everything through in input order
+        run_selection(top_k=0)
+        assert rank_selected(["t_s2", "t_a3"]) == ["t_s2", "t_a3"]
+
+def test_rank_selected_empty_selection_passes_nothing(tmp_path):
+    with patch('app.db.DB_PATH', str(tmp_path / "app.db")):
+        init_db()
+        # Selection never ran yet
+        assert rank_selected(["t_a1"]) == ["t_a1"]
+        
+        conn = get_db_connection()
+        conn.execute("INSERT INTO candidates (post_id, subreddit, score, raw_path) VALUES ('a1', 'AskReddit', 9.0, '/raw/t_a1.json')")
+        conn.execute("INSERT INTO flagged (post_id) VALUES ('t_a1')")
+        conn.commit()
+        conn.close()
+        
+        # Every candidate is finished, so the selection ran but came out empty
+        run_selection(top_k=3)
+        assert rank_selected(["t_a1", "t_other"]) == []
+        assert get_pending("moderate", {"t_other": "h"}) == []
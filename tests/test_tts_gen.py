@@ -2,6 +2,7 @@ import pytest
 from unittest.mock import MagicMock, patch
 import json
 import os
+import wave
 from app.tts_gen import generate_tts
 
 @patch('app.tts_gen.client')
@@ -22,8 +23,9 @@ def test_generate_tts_success(mock_client, tmp_path):
     with open(workspace / "scripts" / f"{post_id}.json", "w") as f:
         json.dump(data, f)
         
-    # Mock Gemini response
-    mock_client.generate_audio.return_value = b"fake_audio_bytes"
+    # Mock Gemini response, one PCM chunk per scene
+    mock_client.tts_model_name = "tts-model"
+    mock_client.generate_audio_many.return_value = [b"aaaa", b"bbbb"]
     
     # Run TTS
     with patch('app.tts_gen.WORKSPACE_DIR', str(workspace)):
@@ -35,11 +37,10 @@ def test_generate_tts_success(mock_client, tmp_path):
         # Check for RIFF header
         assert f.read(4) == b"RIFF"
     
-    # Verify client call
-    mock_client.generate_audio.assert_called_once()
-    args = mock_client.generate_audio.call_args[0][0]
-    assert "Hello world" in args
-    assert "This is a test" in args
+    # Verify scenes are synthesized separately
+    mock_client.generate_audio_many.assert_called_once()
+    args = mock_client.generate_audio_many.call_args[0][0]
+    assert args == ["Hello world", "This is a test"]
 
 @patch('app.tts_gen.client')
 def test_generate_tts_no_text(mock_client, tmp_path):
@@ -59,4 +60,31 @@ def test_generate_tts_no_text(mock_client, tmp_path):
         
     # Verify client NOT called
     mock_client.generate_audio.assert_not_called()
+    mock_client.generate_audio_many.assert_not_called()
     assert not (workspace / "output" / f"{post_id}.wav").exists()
+
+@patch('app.tts_gen.client')
+def test_generate_tts_reuses_cached_scenes(mock_client, tmp_path):
+    workspace = tmp_path / "workspace"
+    (workspace / "scripts").mkdir(parents=True)
+    mock_client.tts_model_name = "tts-model"
+    
+    def write_script(post_id, texts):
+        with open(workspace / "scripts" / f"{post_id}.json", "w") as f:
+            json.dump({"scenes": [{"text": t} for t in texts]}, f)
+    
+    write_script("p1", ["Intro one", "Follow for more"])
+    mock_client.generate_audio_many.return_value = [b"1111", b"2222"]
+    with patch('app.tts_gen.WORKSPACE_DIR', str(workspace)):
+        generate_tts("p1")
+    
+    # Shared CTA (with different whitespace) comes from the cache
+    write_script("p2", ["Intro two", "Follow  for more "])
+    mock_client.generate_audio_many.return_value = [b"3333"]
+    with patch('app.tts_gen.WORKSPACE_DIR', str(workspace)), \
+         patch('app.tts_gen.TTS_SCENE_GAP_MS', 0):
+        generate_tts("p2")
+    
+    assert mock_client.generate_audio_many.call_args[0][0] == ["Intro two"]
+    with wave.open(str(workspace / "output" / "p2.wav"), "rb") as wav_file:
+        assert wav_file.readframes(wav_file.getnframes()) == b"33332222"
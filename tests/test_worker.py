@@ -1,20 +1,76 @@
+import pytest
 from unittest.mock import patch
 from app.worker import run_pipeline
 
+@pytest.fixture(autouse=True)
+def mock_flush():
+    # run_pipeline ends by writing metrics to the DB
+    with patch('app.worker.metrics.flush') as flush:
+        yield flush
+
+@patch('app.worker.PIPELINE_MODE', 'batch')
+@patch('app.worker.run_retention')
 @patch('app.worker.harvest')
+@patch('app.worker.refresh_candidates')
 @patch('app.worker.run_scoring')
+@patch('app.worker.run_selection')
 @patch('app.worker.run_extraction')
 @patch('app.worker.run_moderation')
 @patch('app.worker.run_script_gen')
 @patch('app.worker.run_tts')
 @patch('app.worker.run_render')
-def test_run_pipeline(mock_render, mock_tts, mock_script, mock_mod, mock_extract, mock_score, mock_harvest):
+def test_run_pipeline(mock_render, mock_tts, mock_script, mock_mod, mock_extract, mock_select, mock_score, mock_refresh, mock_harvest, mock_retention):
     run_pipeline()
     
     mock_harvest.assert_called_once()
+    mock_refresh.assert_called_once()
     mock_score.assert_called_once()
+    mock_select.assert_called_once()
     mock_extract.assert_called_once()
     mock_mod.assert_called_once()
     mock_script.assert_called_once()
     mock_tts.assert_called_once()
     mock_render.assert_called_once()
+    mock_retention.assert_called_once()
+
+def test_run_pipeline_flushes_metrics(mock_flush):
+    with patch('app.worker.PIPELINE_MODE', 'batch'), patch('app.worker.run_step'):
+        run_pipeline()
+    
+    mock_flush.assert_called_once()
+
+@patch('app.worker.run_retention')
+@patch('app.worker.run_streaming')
+@patch('app.worker.run_selection')
+@patch('app.worker.run_scoring')
+@patch('app.worker.refresh_candidates')
+@patch('app.worker.harvest')
+@patch('app.worker.run_extraction')
+@patch('app.worker.run_render')
+def test_run_pipeline_streaming(mock_render, mock_extract, mock_harvest, mock_refresh, mock_score, mock_select, mock_stream, mock_retention):
+    with patch('app.worker.PIPELINE_MODE', 'stream'):
+        run_pipeline()
+    
+    mock_select.assert_called_once()
+    mock_stream.assert_called_once()
+    mock_extract.assert_not_called()
+    mock_render.assert_not_called()
+    mock_retention.assert_called_once()
+
+@patch('app.worker.run_retention')
+@patch('app.worker.run_job_worker')
+@patch('app.worker.enqueue_selected')
+@patch('app.worker.run_extraction')
+@patch('app.worker.run_selection')
+@patch('app.worker.run_scoring')
+@patch('app.worker.refresh_candidates')
+@patch('app.worker.harvest')
+@patch('app.worker.run_render')
+def test_run_pipeline_queue(mock_render, mock_harvest, mock_refresh, mock_score, mock_select, mock_extract, mock_enqueue, mock_jobs, mock_retention):
+    with patch('app.worker.PIPELINE_MODE', 'queue'):
+        run_pipeline()
+    
+    mock_extract.assert_called_once()
+    mock_enqueue.assert_called_once()
+    mock_jobs.assert_called_once_with(exit_when_idle=True)
+    mock_render.assert_not_called()